@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步拓扑采集引擎（asyncio）
+功能：
+1. 单事件循环、单 UDP socket 承载成千上万个在途 SNMP 请求
+2. 全局在途请求上限 + 单设备在途请求上限（避免压垮小交换机 CPU）
+3. 复用 TopologyDiscovery 的采集流程（collection_steps）、邻居表定义与解析逻辑，只实现 I/O，输出相同的 topology
+
+说明：pysnmp 4.4.12 的 asyncio hlapi 依赖 Python 3.11 已移除的
+asyncio.coroutine，因此这里直接使用 pysnmp 的 v2c 协议 API 编解码报文，
+由 asyncio 数据报端点收发。
+"""
+
+import asyncio
+import logging
+import random
+import socket
+import time
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api
+from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
+
+from lldp_discovery import CircuitOpenError, SnmpRequestError, count_collection_stat
+
+logger = logging.getLogger(__name__)
+
+pMod = api.protoModules[api.protoVersion2c]
+
+
+class SnmpTimeout(SnmpRequestError):
+    """SNMP 请求超时"""
+
+    def __init__(self, message='No SNMP response received before timeout'):
+        super().__init__('timeout', message)
+
+
+def raise_for_status(response):
+    """响应 PDU 带 error-status 时抛出 SnmpRequestError"""
+    error_status = pMod.apiPDU.getErrorStatus(response)
+    if error_status:
+        raise SnmpRequestError(error_status.prettyPrint(), error_status.prettyPrint())
+
+
+class AsyncSnmpClient(asyncio.DatagramProtocol):
+    """基于单个 UDP socket 的异步 SNMPv2c 客户端（按 request-id 分发响应）"""
+
+    def __init__(self, max_in_flight=1000, per_device_limit=2, health=None):
+        self.transport = None
+        self.health = health  # DeviceHealthTracker：熔断 + 自适应超时
+        self.pending = {}
+        self.request_id = random.randrange(1, 1 << 30)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.per_device_limit = per_device_limit
+        self.device_limits = {}
+        self.addresses = {}
+        self.stats = {
+            'snmp_engines_created': 0,
+            'snmp_sockets_created': 0,
+            'snmp_transports_created': 0,
+            'snmp_requests_sent': 0
+        }
+
+    async def open(self):
+        """打开共享 UDP socket（调大接收缓冲区以承受突发响应）"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        sock.bind(('0.0.0.0', 0))
+        sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.stats['snmp_sockets_created'] += 1
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg, _ = decoder.decode(data, asn1Spec=pMod.Message())
+            pdu = pMod.apiMessage.getPDU(msg)
+            request_id = int(pMod.apiPDU.getRequestID(pdu))
+        except Exception as e:
+            logger.debug(f"丢弃无法解析的 SNMP 报文 {addr}: {e}")
+            return
+
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result((pdu, len(data)))
+
+    def error_received(self, exc):
+        logger.debug(f"SNMP socket 错误: {exc}")
+
+    async def resolve(self, device):
+        """解析设备地址（每个设备只解析一次）"""
+        key = (device['host'], device.get('snmp_port', 161))
+        address = self.addresses.get(key)
+        if address is None:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(key[0], key[1], family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = self.addresses[key] = infos[0][4]
+            self.stats['snmp_transports_created'] += 1
+        return address
+
+    def device_limit(self, device):
+        limit = self.device_limits.get(device['name'])
+        if limit is None:
+            limit = self.device_limits[device['name']] = asyncio.Semaphore(self.per_device_limit)
+        return limit
+
+    async def request(self, device, pdu, timeout=5, retries=1):
+        """发送请求 PDU 并等待响应（超时后按 retries 重传）
+
+        设置了 health 时：熔断中的设备直接抛出 CircuitOpenError；超时按设备 RTT 自适应；
+        每个响应的 RTT 计入健康统计（超时由调用方计入熔断）。
+        """
+        health = self.health
+        if health is not None:
+            if not health.allow(device['name']):
+                raise CircuitOpenError(device['name'])
+            timeout = health.timeout(device['name'], timeout)
+
+        address = await self.resolve(device)
+        message = pMod.Message()
+        pMod.apiMessage.setDefaults(message)
+        pMod.apiMessage.setCommunity(message, device.get('snmp_community', 'public'))
+
+        async with self.device_limit(device), self.in_flight:
+            for _ in range(retries + 1):
+                self.request_id = self.request_id % 0x7fffffff + 1
+                request_id = self.request_id
+                pMod.apiPDU.setRequestID(pdu, request_id)
+                pMod.apiMessage.setPDU(message, pdu)
+
+                future = asyncio.get_running_loop().create_future()
+                self.pending[request_id] = future
+                self.transport.sendto(encoder.encode(message), address)
+                self.stats['snmp_requests_sent'] += 1
+                count_collection_stat('requests')
+                sent = time.monotonic()
+                try:
+                    response, size = await asyncio.wait_for(future, timeout)
+                    count_collection_stat('bytes_received', size)
+                    if health is not None:
+                        health.record_success(device['name'], time.monotonic() - sent)
+                    return response
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.pending.pop(request_id, None)
+
+        raise SnmpTimeout()
+
+    async def get(self, device, oids, timeout=3, retries=1):
+        """一次 GET 获取多个 OID，返回与 oids 顺序一致的值列表（不支持的 OID 为 None）"""
+        pdu = pMod.GetRequestPDU()
+        pMod.apiPDU.setDefaults(pdu)
+        pMod.apiPDU.setVarBinds(pdu, [(oid, pMod.null) for oid in oids])
+
+        response = await self.request(device, pdu, timeout, retries)
+        raise_for_status(response)
+
+        return [None if isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance)) else value
+                for _, value in pMod.apiPDU.getVarBinds(response)]
+
+    async def get_next(self, device, oids, timeout=3, retries=1):
+        """一次 GETNEXT 获取多个 OID 各自的下一个对象，返回与 oids 顺序一致的 (OID, 值) 列表"""
+        pdu = pMod.GetNextRequestPDU()
+        pMod.apiPDU.setDefaults(pdu)
+        pMod.apiPDU.setVarBinds(pdu, [(oid, pMod.null) for oid in oids])
+
+        response = await self.request(device, pdu, timeout, retries)
+        raise_for_status(response)
+
+        return list(pMod.apiPDU.getVarBinds(response))
+
+    async def bulk_columns(self, device, columns, max_repetitions, timeout=5, retries=1):
+        """GETBULK 并行推进多列，返回 {列名: {行索引后缀: 值}}（与 snmp_bulk_columns 一致）
+
+        已结束的列不再出现在后续请求中。
+        """
+        names = list(columns)
+        prefixes = {name: tuple(int(x) for x in columns[name].split('.')) for name in names}
+        positions = dict(prefixes)
+        results = {name: {} for name in names}
+        active = names
+
+        while active:
+            pdu = pMod.GetBulkRequestPDU()
+            pMod.apiBulkPDU.setDefaults(pdu)
+            pMod.apiBulkPDU.setNonRepeaters(pdu, 0)
+            pMod.apiBulkPDU.setMaxRepetitions(pdu, max_repetitions)
+            pMod.apiBulkPDU.setVarBinds(pdu, [(positions[name], pMod.null) for name in active])
+
+            response = await self.request(device, pdu, timeout, retries)
+            raise_for_status(response)
+
+            finished = set()
+            table = pMod.apiBulkPDU.getVarBindTable(pdu, response)
+            for row in table:
+                for name, (oid, value) in zip(active, row):
+                    if name in finished:
+                        continue
+                    oid = tuple(oid)
+                    prefix = prefixes[name]
+                    if (isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance))
+                            or oid[:len(prefix)] != prefix or oid <= positions[name]):
+                        finished.add(name)
+                        continue
+                    results[name]['.'.join(str(x) for x in oid[len(prefix):])] = str(value)
+                    positions[name] = oid
+
+            if not table:
+                break
+            active = [name for name in active if name not in finished]
+
+        return results
+
+
+class AsyncDiscoveryEngine:
+    """异步采集引擎：复用 TopologyDiscovery 的配置、指标与解析逻辑"""
+
+    def __init__(self, discovery, max_in_flight=1000, per_device_limit=2):
+        self.discovery = discovery
+        self.max_in_flight = max_in_flight
+        self.per_device_limit = per_device_limit
+        self.client = None
+
+    async def snmp_bulk_columns(self, device, columns, max_retries=3):
+        """异步版 snmp_bulk_columns（重试、熔断与错误计数语义相同）"""
+        discovery = self.discovery
+        max_repetitions = int(device.get('snmp_max_repetitions', discovery.max_repetitions))
+
+        for attempt in range(max_retries):
+            if not discovery.snmp_allowed(device):
+                break
+            if attempt:
+                count_collection_stat('retries')
+            try:
+                return await self.client.bulk_columns(device, columns, max_repetitions)
+            except CircuitOpenError:
+                break
+            except SnmpRequestError as e:
+                if discovery.snmp_attempt_failed(device, e.reason, e, attempt == max_retries - 1):
+                    break
+            except Exception as e:
+                if discovery.snmp_attempt_failed(device, 'exception', f"bulk 查询失败: {e}",
+                                                 attempt == max_retries - 1):
+                    break
+                else:
+                    # 指数退避（不阻塞事件循环）
+                    wait_time = 2 ** attempt
+                    logger.warning(f"{device['name']} 查询失败，{wait_time}秒后重试 ({attempt + 1}/{max_retries})")
+                    await asyncio.sleep(wait_time)
+
+        return {name: {} for name in columns}
+
+    async def snmp_get_many(self, device, oids):
+        """异步版 snmp_get_many（不重试，失败计入熔断并返回 None）"""
+        discovery = self.discovery
+        if not discovery.snmp_allowed(device):
+            return None
+        try:
+            return await self.client.get(device, oids)
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            logger.debug(f"{device['name']} SNMP get 失败: {e}")
+            discovery.snmp_attempt_failed(device, getattr(e, 'reason', 'exception'), e, False)
+            return None
+
+    async def snmp_get_next_many(self, device, oids):
+        """异步版 snmp_get_next_many（不重试，失败计入熔断并返回 None）"""
+        discovery = self.discovery
+        if not discovery.snmp_allowed(device):
+            return None
+        try:
+            return await self.client.get_next(device, oids)
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            logger.debug(f"{device['name']} SNMP getnext 失败: {e}")
+            discovery.snmp_attempt_failed(device, getattr(e, 'reason', 'exception'), e, False)
+            return None
+
+    async def snmp_request(self, device, kind, argument):
+        if kind == 'get':
+            return await self.snmp_get_many(device, argument)
+        if kind == 'getnext':
+            return await self.snmp_get_next_many(device, argument)
+        return await self.snmp_bulk_columns(device, argument)
+
+    async def run_steps(self, device, steps):
+        """异步版 run_steps：采集流程与线程池引擎共用（TopologyDiscovery.collection_steps），这里只做 I/O"""
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = await self.snmp_request(device, *request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+    async def collect_device_neighbors(self, device):
+        return await self.run_steps(device, self.discovery.collection_steps(device))
+
+    async def collect_all(self):
+        self.client = AsyncSnmpClient(self.max_in_flight, self.per_device_limit,
+                                      health=self.discovery.device_health)
+        await self.client.open()
+        try:
+            return await asyncio.gather(*[
+                self.collect_device_neighbors(device) for device in self.discovery.devices
+            ])
+        finally:
+            self.client.close()
+
+    def run(self):
+        """运行一次完整采集，返回与 devices 顺序一致的邻居列表"""
+        start = time.time()
+        results = asyncio.run(self.collect_all())
+        self.discovery.metrics.update(self.client.stats)
+        logger.debug(f"异步采集耗时 {time.time() - start:.2f} 秒")
+        return list(results)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+拓扑发现端到端基准测试
+功能：在回环地址上启动 SNMP 模拟器（snmp_simulator.py），用 TopologyDiscovery.discover_topology
+采集模拟拓扑，按配置（拓扑模型 × 规模 × 引擎 × 延迟 × 丢包 × 超时设备比例）记录：
+- 墙钟时间、SNMP 往返次数（发现侧发出的请求数，含重传）、CPU 时间（用户态 + 内核态）、峰值 RSS
+- 发现的节点/连接数与模型应有的连接数
+- 模拟器侧收到/应答/丢弃的请求数和 CPU 时间（确认瓶颈不在模拟器）
+
+每个配置的模拟器和发现各在一个新的子进程（spawn）中运行，峰值 RSS 和 CPU 时间互不影响。
+结果写成 JSON 报告；指定 --baseline 时与之前的报告逐项比较，超出容差的回归以非 0 退出码返回。
+
+用法：
+    python3 discovery_benchmark.py --topologies fat-tree,ring,star --sizes 100,500 \\
+        --engines thread,async --latency-ms 0,2 --output report.json
+    python3 discovery_benchmark.py --topologies fat-tree,ring,star --sizes 100,500 \\
+        --engines thread,async --latency-ms 0,2 --baseline report.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from snmp_simulator import TOPOLOGY_MODELS, SnmpSimulator, TopologyModel, device_configs
+
+logger = logging.getLogger(__name__)
+
+# 参与回归比较的结果项 -> 忽略的绝对差值（避免小数值上的计时噪声被当成回归）
+COMPARE_METRICS = {
+    'wall_seconds': 0.2,
+    'cpu_seconds': 0.2,
+    'round_trips': 0,
+    'peak_rss_mb': 2.0,
+}
+
+# 决定配置身份的字段（报告之间按这些字段配对比较）
+CONFIG_FIELDS = ('topology', 'size', 'engine', 'workers', 'max_in_flight', 'per_device_limit',
+                 'latency_ms', 'jitter_ms', 'loss', 'timeout_ratio', 'disabled_ratio', 'responders', 'seed',
+                 'merge_protocols', 'port_aliases')
+
+# 后来增加的配置字段在旧报告中的取值
+CONFIG_DEFAULTS = {'merge_protocols': False, 'port_aliases': False}
+
+
+def config_key(config):
+    return ' '.join(f"{field}={config.get(field, CONFIG_DEFAULTS.get(field))}" for field in CONFIG_FIELDS)
+
+
+def build_configs(args):
+    """按命令行参数展开配置矩阵"""
+    configs = []
+    for topology, size, engine, latency, loss, timeout_ratio in itertools.product(
+            args.topologies, args.sizes, args.engines, args.latency_ms, args.loss, args.timeout_ratio):
+        configs.append({
+            'topology': topology,
+            'size': size,
+            'engine': engine,
+            'workers': args.workers,
+            'max_in_flight': args.max_in_flight,
+            'per_device_limit': args.per_device_limit,
+            'latency_ms': latency,
+            'jitter_ms': args.jitter_ms,
+            'loss': loss,
+            'timeout_ratio': timeout_ratio,
+            'disabled_ratio': args.disabled_ratio,
+            'responders': args.responders,
+            'seed': args.seed,
+            'merge_protocols': args.merge_protocols,
+            'port_aliases': args.port_aliases
+        })
+    return configs
+
+
+def build_model(config):
+    return TopologyModel(config['topology'], config['size'], config['seed'], config['disabled_ratio'],
+                         config.get('port_aliases', False))
+
+
+def max_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_simulator(config, conn, stop):
+    """模拟器子进程：启动应答器，把端口发回主进程，收到停止信号后发回统计"""
+    logging.basicConfig(level=logging.WARNING)
+    simulator = SnmpSimulator(build_model(config), config['responders'], config['latency_ms'] / 1000,
+                              config['jitter_ms'] / 1000, config['loss'], config['timeout_ratio'],
+                              config['seed'])
+
+    async def serve():
+        conn.send(await simulator.start())
+        try:
+            while not stop.is_set():
+                await asyncio.sleep(0.05)
+        finally:
+            simulator.close()
+
+    asyncio.run(serve())
+    conn.send(simulator.stats())
+
+
+def run_discovery(config, ports, results, log_level):
+    """发现子进程：用模拟设备配置运行一次 discover_topology，把测量结果放入队列"""
+    from lldp_discovery import TopologyDiscovery
+    logging.getLogger().setLevel(log_level)
+
+    model = build_model(config)
+    with tempfile.TemporaryDirectory() as state_dir:
+        discovery = TopologyDiscovery(load_state=False, incremental=False,
+                                      state_file=os.path.join(state_dir, 'discovery-state.json'),
+                                      merge_protocols=config.get('merge_protocols', False))
+        discovery.devices = device_configs(model, ports)
+
+        baseline_rss = max_rss_mb()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        discovery.discover_topology(max_workers=config['workers'], engine=config['engine'],
+                                    max_in_flight=config['max_in_flight'],
+                                    per_device_limit=config['per_device_limit'])
+        wall = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+    metrics = discovery.metrics
+    results.put({
+        'devices': len(model.devices),
+        'nodes': len(discovery.topology['nodes']),
+        'edges': len(discovery.topology['edges']),
+        'edges_expected': model.expected_edges(),
+        'wall_seconds': round(wall, 3),
+        'round_trips': metrics['snmp_requests_sent'],
+        'cpu_seconds': round(after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime, 3),
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': max_rss_mb(),
+        'devices_discovered': metrics['devices_discovered'],
+        'devices_failed': metrics['devices_failed'],
+        'snmp_errors': metrics['snmp_errors'],
+        'snmp_errors_by_reason': metrics['snmp_errors_by_reason']
+    })
+
+
+def run_configuration(config, log_level, run_timeout):
+    """运行一个配置：模拟器子进程 + 发现子进程，返回结果（失败时带 error 字段）"""
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    stop = context.Event()
+    simulator = context.Process(target=run_simulator, args=(config, child_conn, stop), daemon=True)
+    simulator.start()
+    result = dict(config)
+    try:
+        if not conn.poll(120):
+            raise RuntimeError("模拟器启动超时")
+        ports = conn.recv()
+
+        results = context.Queue()
+        discovery = context.Process(target=run_discovery, args=(config, ports, results, log_level))
+        discovery.start()
+        try:
+            result.update(results.get(timeout=run_timeout))
+        except queue.Empty:
+            discovery.terminate()
+            raise RuntimeError(f"发现超过 {run_timeout} 秒未完成")
+        finally:
+            discovery.join()
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        stop.set()
+        if conn.poll(30):
+            result['simulator'] = conn.recv()
+        simulator.join(10)
+        if simulator.is_alive():
+            simulator.terminate()
+    return result
+
+
+def best_of(runs):
+    """多次运行取墙钟时间最短的一次（CPU 时间同样取最小值）"""
+    ok = [run for run in runs if 'error' not in run]
+    if not ok:
+        return runs[-1]
+    best = dict(min(ok, key=lambda run: run['wall_seconds']))
+    best['cpu_seconds'] = min(run['cpu_seconds'] for run in ok)
+    best['repeat'] = len(runs)
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """与基线报告逐项比较，返回回归列表"""
+    previous = {config_key(result): result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        old = previous.get(config_key(result))
+        if old is None or 'error' in old:
+            continue
+        if 'error' in result:
+            regressions.append({'config': config_key(result), 'metric': 'error', 'current': result['error']})
+            continue
+        for metric, slack in COMPARE_METRICS.items():
+            if metric not in old:
+                continue
+            if result[metric] > old[metric] * (1 + tolerance) + slack:
+                regressions.append({
+                    'config': config_key(result),
+                    'metric': metric,
+                    'baseline': old[metric],
+                    'current': result[metric],
+                    'change': round(result[metric] / old[metric] - 1, 3) if old[metric] else None
+                })
+    return regressions
+
+
+def log_result(result):
+    name = (f"{result['topology']}/{result['size']} {result['engine']} 延迟 {result['latency_ms']}ms "
+            f"丢包 {result['loss']} 超时设备 {result['timeout_ratio']}")
+    if 'error' in result:
+        logger.error(f"{name}: 失败 - {result['error']}")
+        return
+    logger.info(f"{name}: {result['devices']} 台设备, 连接 {result['edges']}/{result['edges_expected']}, "
+                f"耗时 {result['wall_seconds']} 秒, 往返 {result['round_trips']} 次, "
+                f"CPU {result['cpu_seconds']} 秒, 峰值 RSS {result['peak_rss_mb']} MB "
+                f"（模拟器 CPU {result.get('simulator', {}).get('cpu_seconds')} 秒）")
+
+
+def split_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='拓扑发现端到端基准测试（本地 SNMP 模拟器）')
+    parser.add_argument('--topologies', type=split_list, default=list(TOPOLOGY_MODELS),
+                        help=f"拓扑模型，逗号分隔（{', '.join(TOPOLOGY_MODELS)}）")
+    parser.add_argument('--sizes', type=lambda v: split_list(v, int), default=[100],
+                        help='设备数，逗号分隔（fat-tree 取不超过该值的最大规模，最多约 5000）')
+    parser.add_argument('--engines', type=split_list, default=['thread', 'async'], help='采集引擎，逗号分隔')
+    parser.add_argument('--latency-ms', type=lambda v: split_list(v, float), default=[1.0],
+                        help='模拟器响应延迟（毫秒），逗号分隔')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='响应延迟抖动（毫秒）')
+    parser.add_argument('--loss', type=lambda v: split_list(v, float), default=[0.0], help='丢包率，逗号分隔')
+    parser.add_argument('--timeout-ratio', type=lambda v: split_list(v, float), default=[0.0],
+                        help='完全无响应的设备比例，逗号分隔')
+    parser.add_argument('--disabled-ratio', type=float, default=0.0,
+                        help='私有协议（CDP/NDP/LNP）被关闭、只剩 LLDP 的设备比例')
+    parser.add_argument('--merge-protocols', action='store_true', help='发现时开启多协议合并采集')
+    parser.add_argument('--port-aliases', action='store_true',
+                        help='模拟设备各协议的本地端口名不一致（检验多协议合并的端口归一）')
+    parser.add_argument('--workers', type=int, default=10, help='线程池并发数（thread 引擎）')
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='全局在途请求上限（async 引擎）')
+    parser.add_argument('--per-device-limit', type=int, default=2, help='单设备在途请求上限（async 引擎）')
+    parser.add_argument('--responders', type=int, default=1, help='模拟器应答端口数')
+    parser.add_argument('--seed', type=int, default=0, help='拓扑模型随机种子')
+    parser.add_argument('--repeat', type=int, default=1, help='每个配置的运行次数（取最快一次）')
+    parser.add_argument('--run-timeout', type=float, default=1800, help='单次发现的最长时间（秒）')
+    parser.add_argument('--output', help='JSON 报告路径（默认输出到 stdout）')
+    parser.add_argument('--baseline', help='与之比较的基线报告')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的相对退化（0.2 表示 20%%）')
+    parser.add_argument('--log-level', default='CRITICAL', help='发现子进程的日志级别')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for topology in args.topologies:
+        if topology not in TOPOLOGY_MODELS:
+            sys.exit(f"未知的拓扑模型: {topology}")
+
+    results = []
+    for config in build_configs(args):
+        runs = [run_configuration(config, args.log_level, args.run_timeout) for _ in range(max(1, args.repeat))]
+        result = best_of(runs)
+        log_result(result)
+        results.append(result)
+
+    report = {
+        'generated': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+    exit_code = 1 if any('error' in result for result in results) else 0
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report['baseline'] = args.baseline
+        report['regressions'] = regressions
+        for regression in regressions:
+            logger.warning(f"回归: {regression['config']} {regression['metric']} "
+                           f"{regression.get('baseline')} -> {regression['current']}")
+        if regressions:
+            exit_code = 1
+        else:
+            logger.info("与基线相比没有超出容差的回归")
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        logger.info(f"报告已写入: {args.output}")
+    else:
+        print(text)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻拓扑发现守护进程
+功能：
+1. 进程常驻，避免每轮重新启动解释器、导入 pysnmp、解析 YAML
+2. 每台设备独立调度下一次轮询时间（带抖动），负载均匀分布在整个周期内
+3. 核心层轮询更频繁，连续失败的设备指数退避
+4. 内存中的拓扑持续更新，定期（仅在内容变化时）写出输出文件
+"""
+
+import heapq
+import logging
+import os
+import random
+import signal
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 各层级轮询间隔系数（相对于基础间隔）
+TIER_INTERVAL_FACTORS = {
+    'core': 0.5,
+    'aggregation': 1.0,
+    'access': 1.5
+}
+
+
+class DiscoveryDaemon:
+    """按设备调度的常驻发现服务"""
+
+    def __init__(self, discovery, interval=300, workers=10, publish_interval=30,
+                 jitter=0.1, max_interval=3600, vmagent_url=None):
+        self.discovery = discovery
+        self.interval = interval
+        self.workers = workers
+        self.publish_interval = publish_interval
+        self.jitter = jitter
+        self.max_interval = max_interval
+        self.vmagent_url = vmagent_url
+        # 阶段耗时和设备采集耗时按发布周期统计，每次写出指标后清零
+        discovery.reset_metrics_on_save = True
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.schedule = []          # (下一次轮询时间, 序号, 设备名)
+        self.sequence = 0
+        self.in_flight = set()
+        self.results = {}           # 设备名 -> 最近一次邻居列表
+        self.failures = defaultdict(int)  # 设备名 -> 连续失败次数
+        self.devices = {}
+        self.redfish_servers = []
+        self.config_mtime = None
+        self.last_digest = None
+        self.dirty = False
+
+    def device_tier(self, name):
+        """设备层级：优先使用配置，其次使用上一次计算出的层级"""
+        device = self.devices.get(name, {})
+        tier = device.get('tier', 'unknown')
+        if tier in ('unknown', None):
+            tier = self.discovery.topology['nodes'].get(name, {}).get('tier', 'unknown')
+        return tier
+
+    def next_delay(self, name):
+        """计算设备下一次轮询的间隔（层级系数 + 失败退避 + 抖动）"""
+        delay = self.interval * TIER_INTERVAL_FACTORS.get(self.device_tier(name), 1.0)
+        failures = self.failures.get(name, 0)
+        if failures:
+            delay = min(delay * 2 ** min(failures, 5), self.max_interval)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule_device(self, name, due):
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.schedule, (due, self.sequence, name))
+
+    def load_devices(self):
+        """加载（或重新加载）设备配置，新设备加入调度，删除的设备移出"""
+        discovery = self.discovery
+        with discovery.phase('config_load'):
+            discovery.load_config()
+        with discovery.phase('redfish_load'):
+            self.redfish_servers = discovery.load_redfish_servers()
+        try:
+            self.config_mtime = os.stat(discovery.config_file).st_mtime
+        except OSError:
+            self.config_mtime = None
+
+        devices = {device['name']: device for device in discovery.devices}
+        now = time.monotonic()
+        for name in devices:
+            if name in self.devices:
+                continue
+            previous = discovery.previous_state.get(name)
+            if previous is not None:
+                # 用上一次保存的邻居预热，首次轮询分散在整个周期内
+                self.results[name] = previous.get('neighbors', [])
+                self.dirty = True
+                self.schedule_device(name, now + random.uniform(0, self.next_delay(name)))
+            else:
+                self.schedule_device(name, now + random.uniform(0, self.publish_interval))
+
+        with self.lock:
+            for name in set(self.devices) - set(devices):
+                self.dirty = True
+                self.results.pop(name, None)
+                self.failures.pop(name, None)
+                discovery.device_nodes.pop(name, None)
+                with discovery.lock:
+                    discovery.metrics['device_stats'].pop(name, None)
+        self.devices = devices
+        logger.info(f"调度 {len(devices)} 个设备，基础间隔 {self.interval} 秒")
+
+    def config_changed(self):
+        try:
+            return os.stat(self.discovery.config_file).st_mtime != self.config_mtime
+        except OSError:
+            return False
+
+    def poll(self, name):
+        """轮询单个设备（在工作线程中执行）"""
+        discovery = self.discovery
+        device = self.devices.get(name)
+        if device is None:
+            return
+
+        # 熔断中的设备到了调度时间（已按失败次数退避）就放行一次探测
+        discovery.device_health.half_open(name)
+        errors_before = discovery.device_errors.get(name, 0)
+        neighbors = discovery.collect_device_neighbors(device)
+        failed = discovery.device_errors.get(name, 0) != errors_before
+
+        with self.lock:
+            if failed:
+                self.failures[name] += 1
+            else:
+                self.failures.pop(name, None)
+            if neighbors != self.results.get(name):
+                self.dirty = True
+            self.results[name] = neighbors
+            # 下一次轮询时以本次状态作为增量判断的基准
+            if name in discovery.device_state:
+                discovery.previous_state[name] = discovery.device_state[name]
+
+    def on_done(self, name, future):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"{name} 轮询异常: {e}")
+            with self.lock:
+                self.failures[name] += 1
+        with self.lock:
+            self.in_flight.discard(name)
+        if name in self.devices and not self.stopping.is_set():
+            self.schedule_device(name, time.monotonic() + self.next_delay(name))
+
+    def refresh_metrics(self):
+        """把累加型计数换算为当前状态（常驻模式下各轮采集计数会不断累加）"""
+        discovery = self.discovery
+        counts = defaultdict(int)
+        with self.lock:
+            for neighbors in self.results.values():
+                for neighbor in neighbors:
+                    counts[neighbor.get('protocol', 'unknown')] += 1
+            failed = sum(1 for name in self.devices if self.failures.get(name))
+            discovered = sum(1 for name in self.devices if name in discovery.device_nodes)
+            circuit_open = sum(1 for name in self.devices if discovery.device_health.is_open(name))
+        with discovery.lock:
+            for protocol in ('lldp', 'cdp', 'ndp', 'lnp'):
+                discovery.metrics[f'{protocol}_neighbors'] = counts[protocol]
+            discovery.metrics['devices_failed'] = failed
+            discovery.metrics['devices_circuit_open'] = circuit_open
+            discovery.metrics['devices_discovered'] = discovered + len(self.redfish_servers)
+            discovery.metrics.update(discovery.snmp_pool.stats)
+
+    def publish(self):
+        """用当前内存中的邻居重建拓扑；内容有变化时写出输出文件"""
+        discovery = self.discovery
+        start = time.time()
+
+        with self.lock:
+            results = [self.results.get(device['name'], []) for device in discovery.devices]
+            self.dirty = False
+
+        previous = discovery.topology
+        discovery.topology = {
+            'nodes': {},
+            'edges': [],
+            'aggregations': [],
+            'loops': [],
+            'updated': None
+        }
+        discovery.add_redfish_nodes(self.redfish_servers)
+        with discovery.phase('dedup'):
+            discovery.merge_collection_results(results)
+        digest = discovery.topology_digest()
+        self.refresh_metrics()
+
+        if digest == self.last_digest:
+            # 拓扑未变化：保留已计算层级的拓扑，只刷新设备状态（指纹可能已变化）和自身指标
+            # （end_time 标识一轮指标，导出器据此累积阶段耗时直方图）
+            discovery.topology = previous
+            with discovery.phase('write_device_state'):
+                discovery.save_device_state()
+            discovery.metrics['end_time'] = time.time()
+            discovery.save_metrics(f"{os.path.dirname(discovery.state_file)}/metrics.json")
+            return False
+
+        discovery.previous_topology = previous
+        discovery.topology['updated'] = datetime.now().isoformat()
+        discovery.analyze_topology()
+        with discovery.phase('tiers'):
+            discovery.calculate_tiers()
+        discovery.metrics['topology_digest'] = digest
+        discovery.metrics['end_time'] = time.time()
+        discovery.metrics['discovery_duration_seconds'] = discovery.metrics['end_time'] - start
+        file_sd_changed = discovery.write_outputs()
+        self.last_digest = digest
+
+        logger.info(f"拓扑已更新: {len(discovery.topology['nodes'])} 个节点, "
+                    f"{len(discovery.topology['edges'])} 条连接")
+        # 只有 file_sd 文件内容变化时才需要 vmagent 重载（例如只有端口变化时标签不变）
+        if file_sd_changed:
+            self.reload_vmagent()
+        return True
+
+    def reload_vmagent(self):
+        """通知 vmagent 重新读取 file_sd"""
+        if not self.vmagent_url:
+            return
+        try:
+            request = urllib.request.Request(f"{self.vmagent_url}/-/reload", method='POST')
+            urllib.request.urlopen(request, timeout=5).close()
+            logger.info("vmagent 配置重载成功")
+        except Exception as e:
+            logger.warning(f"vmagent 重载失败（可能服务未启动）: {e}")
+
+    def stop(self, *args):
+        logger.info("收到停止信号，正在关闭...")
+        self.stopping.set()
+
+    def run(self):
+        """主循环：取出到期设备提交给线程池，定期发布拓扑"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.discovery.metrics['start_time'] = time.time()
+        self.load_devices()
+        next_publish = time.monotonic() + self.publish_interval
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping.is_set():
+                now = time.monotonic()
+
+                while True:
+                    with self.lock:
+                        if not self.schedule or self.schedule[0][0] > now or \
+                                len(self.in_flight) >= self.workers * 2:
+                            break
+                        _, _, name = heapq.heappop(self.schedule)
+                        if name not in self.devices or name in self.in_flight:
+                            continue
+                        self.in_flight.add(name)
+                    future = executor.submit(self.poll, name)
+                    future.add_done_callback(lambda f, name=name: self.on_done(name, f))
+
+                if now >= next_publish:
+                    if self.config_changed():
+                        logger.info("设备配置已变化，重新加载")
+                        self.load_devices()
+                    if self.dirty:
+                        self.publish()
+                    else:
+                        self.refresh_metrics()
+                    next_publish = now + self.publish_interval
+
+                # 最多睡眠 1 秒，保证新完成的设备能及时重新调度
+                with self.lock:
+                    next_due = self.schedule[0][0] if self.schedule else next_publish
+                wait = min(next_due, next_publish) - time.monotonic()
+                self.stopping.wait(min(max(wait, 0.05), 1.0))
+
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if self.dirty:
+            self.publish()
+        self.discovery.snmp_pool.close()
+        logger.info("拓扑发现守护进程已停止")
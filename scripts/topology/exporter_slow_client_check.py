@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exporter 慢客户端自检
+功能：
+1. 建立与工作线程数相同的空闲连接（只建连不发请求），检查 /health 仍在 1 秒内响应
+2. 建立与工作线程数相同的慢速发送连接（逐字节发送请求行），检查 /health 在 header_timeout 附近响应
+3. 检查空闲连接在 header_timeout 后被服务端关闭
+
+用法：
+    python3 exporter_slow_client_check.py --workers 16 --header-timeout 2
+"""
+
+import argparse
+import json
+import logging
+import socket
+import sys
+import tempfile
+import time
+from threading import Event, Thread
+
+from topology_exporter import BoundedThreadingHTTPServer, MetricsHandler, TopologyExporter
+
+logger = logging.getLogger(__name__)
+
+
+def health_latency(port, timeout=30):
+    """发送一次 /health 请求，返回 (状态行, 耗时秒)"""
+    start = time.monotonic()
+    with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+        sock.sendall(b'GET /health HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        status = sock.makefile('rb').readline().decode('latin-1').strip()
+    return status, time.monotonic() - start
+
+
+def open_idle(port, count):
+    return [socket.create_connection(('127.0.0.1', port)) for _ in range(count)]
+
+
+def trickle(port, stop):
+    """每 0.2 秒发送一个字节，直到服务端关闭连接或 stop 被设置"""
+    try:
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            for byte in b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n' * 10:
+                if stop.is_set():
+                    return
+                sock.sendall(bytes([byte]))
+                time.sleep(0.2)
+    except OSError:
+        pass
+
+
+def closed_after(sock, timeout):
+    """等待服务端关闭连接，返回耗时（超时返回 None）"""
+    start = time.monotonic()
+    sock.settimeout(timeout)
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.timeout:
+        return None
+    except OSError:
+        pass
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exporter 慢客户端自检')
+    parser.add_argument('--workers', type=int, default=16, help='工作线程数')
+    parser.add_argument('--header-timeout', type=float, default=2, help='请求头读取超时（秒）')
+    parser.add_argument('--max-latency', type=float, default=1.0, help='空闲连接存在时 /health 允许的最大耗时（秒）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    workdir = tempfile.mkdtemp(prefix='exporter-check-')
+    exporter = TopologyExporter(topology_file=f'{workdir}/topology.json', metrics_file=f'{workdir}/metrics.json')
+
+    def handler(*handler_args):
+        MetricsHandler(exporter, *handler_args)
+
+    # 单客户端连接上限放开，所有测试连接都来自 127.0.0.1
+    server = BoundedThreadingHTTPServer(('127.0.0.1', 0), handler, exporter.request_stats, workers=args.workers,
+                                        header_timeout=args.header_timeout,
+                                        max_client_connections=args.workers * 4)
+    port = server.server_address[1]
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    failures = []
+    report = {'workers': args.workers, 'header_timeout': args.header_timeout}
+
+    idle = open_idle(port, args.workers)
+    time.sleep(0.2)
+    status, latency = health_latency(port)
+    report['health_with_idle_connections'] = {'status': status, 'seconds': round(latency, 3)}
+    if ' 200 ' not in status or latency >= args.max_latency:
+        failures.append(f"{args.workers} 个空闲连接时 /health 耗时 {latency:.2f} 秒（{status}）")
+
+    waited = closed_after(idle[0], args.header_timeout + 5)
+    report['idle_connection_closed_after'] = round(waited, 3) if waited is not None else None
+    if waited is None:
+        failures.append(f"空闲连接在 {args.header_timeout + 5} 秒内未被关闭")
+    for sock in idle:
+        sock.close()
+
+    stop = Event()
+    trickles = [Thread(target=trickle, args=(port, stop), daemon=True) for _ in range(args.workers)]
+    for thread in trickles:
+        thread.start()
+    time.sleep(0.5)
+    status, latency = health_latency(port)
+    stop.set()
+    report['health_with_trickle_connections'] = {'status': status, 'seconds': round(latency, 3)}
+    if ' 200 ' not in status or latency >= args.header_timeout + args.max_latency:
+        failures.append(f"{args.workers} 个慢速发送连接时 /health 耗时 {latency:.2f} 秒（{status}）")
+
+    server.shutdown()
+    server.server_close()
+    report['failures'] = failures
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if failures:
+        logger.error(f"发现 {len(failures)} 个失败用例")
+        sys.exit(1)
+    logger.info("所有用例通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Telegraf 标签注入器吞吐量基准测试
+功能：用合成的 vSphere 风格 line protocol 对比原实现（完整解析 → 注入 → 排序重建，
+每行 print + flush）与当前实现（bytes 批处理 + 快速路径 + 改写缓存 + 缓冲输出）的每秒处理行数
+
+用法：
+    python3 injector_benchmark.py --lines 200000 --series 20000 --hosts 2000 --match-ratio 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+from telegraf_label_injector import READ_CHUNK_SIZE, TopologyLabelInjector
+
+logger = logging.getLogger(__name__)
+
+MEASUREMENTS = (
+    ('vsphere_vm_cpu', 'usage_average={:.2f},ready_summation={}i'),
+    ('vsphere_vm_mem', 'usage_average={:.2f},active_average={}i'),
+    ('vsphere_host_net', 'bytesRx_average={:.2f},bytesTx_average={}i'),
+    ('vsphere_datastore_disk', 'used_latest={:.2f},provisioned_latest={}i'),
+)
+
+
+def build_label_map(hosts):
+    """与 generate_telegraf_labels 相同结构的标签映射（IP、设备名、FQDN 三种 key）"""
+    label_map = {}
+    for i in range(hosts):
+        name = f"esx-{i:05d}"
+        labels = {
+            'device_name': name,
+            'device_type': 'server',
+            'device_tier': 'access',
+            'device_location': f"dc1-rack-{i % 40:02d}",
+            'connected_switch': f"Switch-Access-{i % 200:03d}",
+            'connected_port': f"Gi1/0/{i % 48 + 1}"
+        }
+        label_map[f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"] = labels
+        label_map[name] = labels
+        label_map[f"{name}.local"] = labels
+    return label_map
+
+
+def build_lines(count, series_count, hosts, match_ratio, seed=0):
+    """合成 vSphere 风格的 metrics：series_count 个 series 轮流出现（模拟每个采集周期），
+    match_ratio 比例的 series 带有可匹配的 host"""
+    rng = random.Random(seed)
+    series = []
+    for i in range(series_count):
+        measurement, fields = MEASUREMENTS[i % len(MEASUREMENTS)]
+        if rng.random() < match_ratio:
+            source = f"esx-{rng.randrange(hosts):05d}"
+        else:
+            source = f"vm-{rng.randrange(hosts * 10):06d}"
+        tags = (f"clustername=cluster-{i % 8},dcname=dc1,host=telegraf-01,"
+                f"moid=vm-{i},source={source},vcenter=vc01.example.com")
+        series.append((f"{measurement},{tags}", fields))
+
+    lines = []
+    for i in range(count):
+        key, fields = series[i % series_count]
+        lines.append(f"{key} {fields.format(rng.random() * 100, rng.randrange(10 ** 6))} "
+                     f"{1700000000000000000 + i}")
+    return lines
+
+
+def legacy_parse_line_protocol(line):
+    """原实现的切分方式：按第一个空格/逗号分割，不处理转义和带引号的字符串字段"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    parts = line.split(' ', 2)
+    if len(parts) < 2:
+        return None
+    measurement_parts = parts[0].split(',', 1)
+    tags = {}
+    if len(measurement_parts) > 1:
+        for tag in measurement_parts[1].split(','):
+            if '=' in tag:
+                k, v = tag.split('=', 1)
+                tags[k] = v
+    return {
+        'measurement': measurement_parts[0],
+        'tags': tags,
+        'fields': parts[1],
+        'timestamp': parts[2] if len(parts) == 3 else ''
+    }
+
+
+def baseline_line(injector, line):
+    """原实现的单行处理：完整解析、合并标签、排序重建"""
+    metric_data = legacy_parse_line_protocol(line)
+    new_line = injector.build_line_protocol(injector.inject_labels(metric_data)) if metric_data else None
+    return new_line if new_line else line
+
+
+def run_baseline(injector, lines, out):
+    """原实现：每行完整解析、注入、排序重建，print 后立即 flush"""
+    for line in lines:
+        print(baseline_line(injector, line), file=out)
+        out.flush()
+
+
+def run_current(injector, chunks, out):
+    """当前实现：与 run_batch 相同，按块处理完整的行（bytes），输出缓冲后统一 flush"""
+    for chunk in chunks:
+        out.write(injector.process_chunk(chunk[:-1]))
+        out.write(b'\n')
+    out.flush()
+
+
+def chunk_lines(lines, chunk_size=READ_CHUNK_SIZE):
+    """把行切成不超过 chunk_size 的块，每块以换行结尾（模拟从 stdin 读到的数据）"""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        encoded = line.encode('utf-8') + b'\n'
+        if size + len(encoded) > chunk_size and current:
+            chunks.append(b''.join(current))
+            current, size = [], 0
+        current.append(encoded)
+        size += len(encoded)
+    if current:
+        chunks.append(b''.join(current))
+    return chunks
+
+
+def measure(func, injector, data, repeat, binary=False):
+    best = None
+    with open(os.devnull, 'wb' if binary else 'w') as out:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(injector, data, out)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_benchmark(lines=200000, series=20000, hosts=2000, match_ratio=0.2, repeat=3, seed=0):
+    injector = TopologyLabelInjector(label_file=os.devnull)
+    injector.set_label_map(build_label_map(hosts))
+    data = build_lines(lines, series, hosts, match_ratio, seed)
+
+    # 两种实现对匹配行的输出必须一致；未匹配的行当前实现原样输出
+    for line in data[:2000]:
+        if injector.find_host_key(line[:line.find(' ')].encode('utf-8')) is not None:
+            assert injector.process_line(line) == baseline_line(injector, line), line
+        else:
+            assert injector.process_line(line) == line, line
+    injector.set_label_map(injector.label_map)
+    injector.cache_hits = injector.cache_misses = 0
+
+    results = {}
+    inputs = {'baseline': (run_baseline, data, False), 'current': (run_current, chunk_lines(data), True)}
+    for name, (func, lines_input, binary) in inputs.items():
+        seconds = measure(func, injector, lines_input, repeat, binary)
+        results[name] = {
+            'seconds': round(seconds, 4),
+            'lines_per_second': round(len(data) / seconds)
+        }
+    results['speedup'] = round(results['baseline']['seconds'] / results['current']['seconds'], 2)
+    results['cache'] = {'hits': injector.cache_hits, 'misses': injector.cache_misses,
+                        'evictions': injector.cache_evictions}
+    results.update({'lines': lines, 'series': series, 'hosts': hosts, 'match_ratio': match_ratio})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telegraf 标签注入器吞吐量基准测试')
+    parser.add_argument('--lines', type=int, default=200000, help='合成的 metrics 行数')
+    parser.add_argument('--series', type=int, default=20000, help='不同 series 的数量')
+    parser.add_argument('--hosts', type=int, default=2000, help='标签映射中的主机数')
+    parser.add_argument('--match-ratio', type=float, default=0.2, help='带可匹配 host 的行比例')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数（取最快一次）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = run_benchmark(args.lines, args.series, args.hosts, args.match_ratio, args.repeat)
+    for name in ('baseline', 'current'):
+        logger.info(f"{name}: {results[name]['lines_per_second']} 行/秒（{results[name]['seconds']} 秒）")
+    logger.info(f"加速比: {results['speedup']}x")
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
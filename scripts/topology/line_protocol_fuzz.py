@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Line protocol 词法的模糊/性质测试与吞吐量对比
+功能：
+1. 固定语料：转义空格/逗号/等号、带引号的字符串字段、注释、缺少时间戳等边界情况
+2. 随机生成（含转义和字符串字段的）合法行，检查性质：
+   - tokenize_line 切分结果与生成时的各部分一致
+   - 未匹配的行 process_line 原样输出
+   - 匹配的行只改动 tag：measurement、fields、时间戳不变，原有 tag（被拓扑标签覆盖的除外）全部保留
+   - 不含转义的行与原实现输出一致
+3. 对比 tokenize_line 与原切分方式（legacy_parse_line_protocol）的吞吐量
+
+用法：
+    python3 line_protocol_fuzz.py --iterations 20000 --seed 0
+"""
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from injector_benchmark import baseline_line, build_lines, legacy_parse_line_protocol
+from telegraf_label_injector import MATCH_TAGS, TopologyLabelInjector, escape_tag, tokenize_line, unescape_tag
+
+logger = logging.getLogger(__name__)
+
+LABEL_MAP = {
+    'esx-1': {'device_name': 'esx-1', 'connected_switch': 'Switch-Access-01', 'device_location': 'dc1 rack,A01'},
+    'esx 2': {'device_name': 'esx 2', 'connected_switch': 'Switch-Access-02'},
+    'host': {'device_name': 'host', 'source': 'topology'},
+}
+
+# (输入行, tokenize_line 的期望结果)
+TOKENIZE_CORPUS = [
+    ('cpu,host=esx-1 usage=1.5 1700000000000000000',
+     ('cpu', [('host', 'esx-1')], 'usage=1.5', '1700000000000000000')),
+    ('cpu usage=1.5',
+     ('cpu', [], 'usage=1.5', '')),
+    (r'disk\ io,datastore=DS\ 01 used=1i 1',
+     (r'disk\ io', [('datastore', r'DS\ 01')], 'used=1i', '1')),
+    (r'disk,datastore=DS\,01\=a,host=esx-1 used=1i',
+     ('disk', [('datastore', r'DS\,01\=a'), ('host', 'esx-1')], 'used=1i', '')),
+    (r'm\,x,k\ 1=v\ 1 f=1',
+     (r'm\,x', [(r'k\ 1', r'v\ 1')], 'f=1', '')),
+    ('m,host=esx-1 msg="hello world, a=b",v=2i 5',
+     ('m', [('host', 'esx-1')], 'msg="hello world, a=b",v=2i', '5')),
+    (r'm,host=esx-1 msg="quote \" and \\ backslash" 5',
+     ('m', [('host', 'esx-1')], r'msg="quote \" and \\ backslash"', '5')),
+    ('m,host=esx-1 msg="unterminated 5',
+     ('m', [('host', 'esx-1')], 'msg="unterminated 5', '')),
+    ('  m,host=esx-1 v=1 7  \r',
+     ('m', [('host', 'esx-1')], 'v=1', '7')),
+    ('m,notag,host=esx-1 v=1',
+     ('m', [('host', 'esx-1')], 'v=1', '')),
+    ('温度,位置=机房\\ 一 值=1 9',
+     ('温度', [('位置', '机房\\ 一')], '值=1', '9')),
+    ('', None),
+    ('   ', None),
+    ('# comment line', None),
+    ('measurement_only', None),
+    (r'm\ only\ escaped', None),
+]
+
+# (输入行, process_line 的期望输出)
+INJECT_CORPUS = [
+    # 未匹配：原样输出（包括 tag 顺序和多余空格）
+    ('cpu,z=1,a=2 v=1  9', 'cpu,z=1,a=2 v=1  9'),
+    (r'cpu,note=a\,host=esx-1 v=1', r'cpu,note=a\,host=esx-1 v=1'),
+    ('# comment', '# comment'),
+    ('', ''),
+    # 匹配：拓扑标签转义后合并，按 key 排序
+    ('cpu,host=esx-1 v=1 9',
+     r'cpu,connected_switch=Switch-Access-01,device_location=dc1\ rack\,A01,device_name=esx-1,host=esx-1 v=1 9'),
+    (r'cpu,note=a\,host=evil,host=esx-1 v=1',
+     r'cpu,connected_switch=Switch-Access-01,device_location=dc1\ rack\,A01,device_name=esx-1,'
+     r'host=esx-1,note=a\,host=evil v=1'),
+    (r'cpu,source=esx\ 2 msg="x y" 3',
+     r'cpu,connected_switch=Switch-Access-02,device_name=esx\ 2,source=esx\ 2 msg="x y" 3'),
+    # 同名 tag 以拓扑标签为准
+    ('cpu,instance=host,source=orig v=1',
+     'cpu,device_name=host,instance=host,source=topology v=1'),
+    (r'disk\ io,host=esx-1,datastore=DS\ 01 used=1i',
+     r'disk\ io,connected_switch=Switch-Access-01,datastore=DS\ 01,device_location=dc1\ rack\,A01,'
+     r'device_name=esx-1,host=esx-1 used=1i'),
+]
+
+NAME_ALPHABET = 'abcxyz019_-. ,=\\"中é'
+STRING_ALPHABET = 'ab ,=\\"中é'
+
+
+def tokenize_text(line):
+    """tokenize_line 处理 bytes，这里按 str 输入/输出方便与语料比较"""
+    tokens = tokenize_line(line.encode('utf-8'))
+    if tokens is None:
+        return None
+    measurement, tags, fields, timestamp = tokens
+    return (measurement.decode(), [(key.decode(), value.decode()) for key, value in tags],
+            fields.decode(), timestamp.decode())
+
+
+def unescape_text(value):
+    return unescape_tag(value.encode('utf-8')).decode('utf-8')
+
+
+def random_text(rng, alphabet, min_length=1, max_length=8):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(min_length, max_length)))
+
+
+def escape_measurement(value):
+    return value.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def random_name(rng):
+    # 名称中的反斜杠后面紧跟分隔符时有歧义（line protocol 不转义反斜杠本身），
+    # 生成时让每个反斜杠后面都跟一个普通字符
+    return random_text(rng, NAME_ALPHABET).replace('\\', '\\x')
+
+
+def random_field_value(rng):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return f"{rng.randint(-10 ** 6, 10 ** 6)}i"
+    if kind == 1:
+        return repr(rng.uniform(-1000, 1000))
+    if kind == 2:
+        return rng.choice(['true', 'false', 't', 'F'])
+    text = random_text(rng, STRING_ALPHABET, 0, 12)
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def random_line(rng):
+    """生成一条合法的 line protocol 及其各部分（保留转义的形式）"""
+    measurement = escape_measurement(random_name(rng))
+    tags = []
+    used = set()
+    for _ in range(rng.randint(0, 5)):
+        if rng.random() < 0.3:
+            key = rng.choice(['host', 'source', 'esxi_host', 'instance'])
+            value = rng.choice(list(LABEL_MAP) + ['unknown-host'])
+        else:
+            key, value = random_name(rng), random_name(rng)
+        if key in used:
+            continue
+        used.add(key)
+        tags.append((escape_tag(key), escape_tag(value)))
+    fields = ','.join(f"{escape_tag(random_name(rng))}={random_field_value(rng)}"
+                      for _ in range(rng.randint(1, 3)))
+    timestamp = str(rng.randint(0, 2 ** 62)) if rng.random() < 0.7 else ''
+
+    line = measurement + ''.join(f",{k}={v}" for k, v in tags) + ' ' + fields
+    if timestamp:
+        line += ' ' + timestamp
+    return line, (measurement, tags, fields, timestamp)
+
+
+def expected_host(tags):
+    """按 MATCH_TAGS 优先级找出应匹配的 host（生成时已知各 tag 的原值）"""
+    values = {unescape_text(key): unescape_text(value) for key, value in tags}
+    for tag in MATCH_TAGS:
+        if values.get(tag) in LABEL_MAP:
+            return values[tag]
+    return None
+
+
+def check_injected(line, expected, host, output, failures):
+    """匹配行的性质：只改动 tag，原有 tag（除被覆盖的）全部保留，拓扑标签全部加入"""
+    measurement, tags, fields, timestamp = expected
+    result = tokenize_text(output)
+    if result is None:
+        failures.append(('inject_unparseable', line, output))
+        return
+    labels = {escape_tag(k): escape_tag(v) for k, v in LABEL_MAP[host].items()}
+    expected_tags = dict(tags)
+    expected_tags.update(labels)
+    if result[0] != measurement or result[2] != fields or result[3] != timestamp:
+        failures.append(('inject_changed_fields', line, output))
+    elif dict(result[1]) != expected_tags or len(result[1]) != len(expected_tags):
+        failures.append(('inject_tags', line, output))
+
+
+def run_corpus(injector):
+    failures = []
+    for line, expected in TOKENIZE_CORPUS:
+        result = tokenize_text(line)
+        if result != expected:
+            failures.append(('tokenize_corpus', line, result))
+    for line, expected in INJECT_CORPUS:
+        output = injector.process_line(line)
+        if output != expected:
+            failures.append(('inject_corpus', line, output))
+    return failures
+
+
+def run_fuzz(injector, iterations, seed):
+    rng = random.Random(seed)
+    failures = []
+    matched = 0
+    for _ in range(iterations):
+        line, expected = random_line(rng)
+        result = tokenize_text(line)
+        if result != expected:
+            failures.append(('tokenize', line, result))
+            continue
+
+        output = injector.process_line(line)
+        host = expected_host(expected[1])
+        if host is None:
+            if output != line:
+                failures.append(('unmatched_changed', line, output))
+            continue
+
+        matched += 1
+        check_injected(line, expected, host, output, failures)
+        # 不含转义和字符串字段的行，与原实现的输出一致
+        if '\\' not in line and '"' not in line and output != baseline_line(injector, line):
+            failures.append(('legacy_mismatch', line, output))
+    return failures, matched
+
+
+def throughput(func, lines, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            func(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(len(lines) / best)
+
+
+def compare_throughput(lines_count, seed):
+    """原切分方式 vs tokenize_line：普通 vSphere 行与含转义/字符串字段的行"""
+    plain = build_lines(lines_count, lines_count // 10 or 1, 2000, 0.2, seed)
+    rng = random.Random(seed)
+    escaped = [random_line(rng)[0] for _ in range(lines_count)]
+    results = {}
+    for name, lines in (('plain', plain), ('escaped', escaped)):
+        results[name] = {
+            'legacy_lines_per_second': throughput(legacy_parse_line_protocol, lines),
+            'tokenizer_lines_per_second': throughput(tokenize_line, [line.encode('utf-8') for line in lines])
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Line protocol 词法模糊测试与吞吐量对比')
+    parser.add_argument('--iterations', type=int, default=20000, help='随机生成的行数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--throughput-lines', type=int, default=100000, help='吞吐量对比的行数（0 表示跳过）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    injector = TopologyLabelInjector(label_file='/dev/null')
+    injector.set_label_map(LABEL_MAP)
+
+    failures = run_corpus(injector)
+    fuzz_failures, matched = run_fuzz(injector, args.iterations, args.seed)
+    failures.extend(fuzz_failures)
+
+    report = {
+        'corpus_cases': len(TOKENIZE_CORPUS) + len(INJECT_CORPUS),
+        'fuzz_iterations': args.iterations,
+        'fuzz_matched': matched,
+        'failures': len(failures),
+        'failure_samples': [list(failure) for failure in failures[:20]]
+    }
+    if args.throughput_lines:
+        report['throughput'] = compare_throughput(args.throughput_lines, args.seed)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if failures:
+        logger.error(f"发现 {len(failures)} 个失败用例")
+        sys.exit(1)
+    logger.info("所有用例通过")
+
+
+if __name__ == '__main__':
+    main()
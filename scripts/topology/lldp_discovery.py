@@ -23,14 +23,19 @@
 - 国外：Cisco、Arista、Juniper、HPE 等
 """
 
+import argparse
+import contextvars
+import copy
 import json
 import yaml
 import time
 import logging
 import hashlib
+from bisect import bisect_left
+from contextlib import contextmanager
 from datetime import datetime
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pysnmp.hlapi import (
     SnmpEngine,
     CommunityData,
@@ -39,11 +44,24 @@ from pysnmp.hlapi import (
     ObjectType,
     ObjectIdentity,
     nextCmd,
-    getCmd
+    getCmd,
+    bulkCmd
 )
+from pysnmp.proto.errind import RequestTimedOut
+from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
 import threading
+import math
 import os
 
+from topology_snapshot import (
+    DEFAULT_SNAPSHOT_FORMAT,
+    SNAPSHOT_FORMATS,
+    read_topology,
+    write_file_atomic,
+    write_json_atomic,
+    write_topology
+)
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -67,12 +85,442 @@ VENDOR_PROTOCOLS = {
     'default': ['lldp']
 }
 
+# 各协议邻居表需要的列（列名 -> 列 OID），由 snmp_bulk_columns 一次性批量获取
+NEIGHBOR_COLUMNS = {
+    'lldp': {
+        'rem_sys_name': '1.0.8802.1.1.2.1.4.1.1.9',       # 远端系统名称
+        'rem_port_id': '1.0.8802.1.1.2.1.4.1.1.7',        # 远端端口 ID
+        'loc_port_desc': '1.0.8802.1.1.2.1.3.7.1.4'       # 本地端口描述（按本地端口号索引）
+    },
+    'cdp': {
+        'device_id': '1.3.6.1.4.1.9.9.23.1.2.1.1.6',      # cdpCacheDeviceId
+        'device_port': '1.3.6.1.4.1.9.9.23.1.2.1.1.7',    # cdpCacheDevicePort
+        'platform': '1.3.6.1.4.1.9.9.23.1.2.1.1.8',       # cdpCachePlatform
+        'if_descr': '1.3.6.1.2.1.2.2.1.2'                 # ifDescr（按 ifIndex 索引）
+    },
+    'ndp': {
+        'neighbor_name': '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.3',
+        'neighbor_port': '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.4',
+        'local_port': '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.2'
+    },
+    'lnp': {
+        'neighbor_name': '1.3.6.1.4.1.25506.2.12.1.1.2.1.3',
+        'neighbor_port': '1.3.6.1.4.1.25506.2.12.1.1.2.1.4',
+        'local_port': '1.3.6.1.4.1.25506.2.12.1.1.2.1.2'
+    }
+}
+
+# 增量发现：设备指纹 OID（一次 GET 同时获取）
+SYS_UPTIME = '1.3.6.1.2.1.1.3.0'                          # sysUpTime
+LLDP_REM_TABLES_LAST_CHANGE = '1.0.8802.1.1.2.1.2.1.0'    # lldpStatsRemTablesLastChangeTime
+
+# 没有“最后变化时间”的协议，用远端名称/端口两列的哈希作为指纹
+FINGERPRINT_COLUMNS = {
+    'lldp': ('rem_sys_name', 'rem_port_id'),
+    'cdp': ('device_id', 'device_port'),
+    'ndp': ('neighbor_name', 'neighbor_port'),
+    'lnp': ('neighbor_name', 'neighbor_port')
+}
+
+# 多协议合并采集时把各协议的本地端口统一到 ifIndex：LLDP 的 lldpLocPortDesc 常是接口描述，
+# CDP 用 ifDescr，NDP/LNP 用各自的端口名，直接比较名称会把同一物理端口当成不同端口
+INTERFACE_COLUMNS = {
+    'if_name': '1.3.6.1.2.1.31.1.1.1.1',   # ifName
+    'if_descr': '1.3.6.1.2.1.2.2.1.2'       # ifDescr
+}
+LLDP_LOC_PORT_ID = '1.0.8802.1.1.2.1.3.7.1.3'  # lldpLocPortId（多数设备为 ifName）
+
+# 协议能力探测：各协议 MIB 的根 OID。一次 GETNEXT 携带设备所有候选协议，
+# 返回的下一个 OID 仍在该协议的 MIB 子树内则视为支持，否则本设备不再采集该协议
+PROTOCOL_MIB_ROOTS = {
+    'lldp': '1.0.8802.1.1.2',               # LLDP-MIB
+    'cdp': '1.3.6.1.4.1.9.9.23',            # CISCO-CDP-MIB
+    'ndp': '1.3.6.1.4.1.2011.5.25.41',      # 华为 NDP
+    'lnp': '1.3.6.1.4.1.25506.2.12'         # 华三 LNP
+}
+
+# 协议能力缓存的有效期（秒，0 表示不探测、按顺序尝试所有协议）；sysUpTime 回退（设备重启）时立即重新探测
+DEFAULT_PROBE_INTERVAL = 86400
+
+# 按轮统计的计数：常驻模式下每次保存指标后清零（熔断设备数在常驻模式下按当前状态重新计算）
+CYCLE_COUNTERS = ('devices_polled', 'devices_skipped', 'snmp_requests_short_circuited', 'protocol_probes',
+                  'protocol_walks_skipped', 'protocol_overlap_ports', 'protocol_overlap_conflicts')
+
+# GETBULK 默认 max-repetitions（可在 devices.yml 中按设备用 snmp_max_repetitions 覆盖）
+DEFAULT_MAX_REPETITIONS = 25
+
+# 熔断：连续失败多少次后本次运行不再访问该设备
+DEFAULT_CIRCUIT_THRESHOLD = 3
+
+# 层级推断：auto 模式下节点数超过阈值时使用近似中心性（采样 pivot 数可配置）
+DEFAULT_TIER_MODE = 'auto'
+DEFAULT_TIER_SAMPLE_SIZE = 256
+FAST_TIER_NODE_THRESHOLD = 1000
+
+# 单设备采集耗时直方图的桶上界（秒）
+DEVICE_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# 每台设备按协议记录的采集统计（fingerprint 为增量判断的 GET/指纹列查询）
+COLLECTION_STAT_FIELDS = ('duration_seconds', 'requests', 'bytes_received', 'retries', 'timeouts', 'neighbors')
+
+# 当前正在采集的设备/协议的统计（线程和协程各自独立），SNMP 层据此按设备和协议计数
+current_collection_stats = contextvars.ContextVar('current_collection_stats', default=None)
+
+# 可选的性能剖析：cpu 使用 cProfile，memory 使用 tracemalloc
+PROFILE_MODES = ('cpu', 'memory')
+DEFAULT_PROFILE_TOP = 40
+
+class CircuitOpenError(Exception):
+    """设备处于熔断状态，请求未发出"""
+    reason = 'circuit_open'
+
+class SnmpRequestError(Exception):
+    """SNMP 请求失败（reason 为分类后的错误原因）"""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+def count_collection_stat(key, value=1):
+    """累加到当前设备/协议的采集统计（不在采集上下文中时忽略）"""
+    stats = current_collection_stats.get()
+    if stats is not None:
+        stats[key] += value
+
+def snmp_error_reason(error_indication=None, error_status=None):
+    """把 pysnmp 的 errorIndication / errorStatus 归类为错误原因标签"""
+    if error_indication:
+        return 'timeout' if isinstance(error_indication, RequestTimedOut) else 'transport'
+    if error_status:
+        return error_status.prettyPrint()
+    return 'snmp_error'
+
+class DeviceHealthTracker:
+    """按设备跟踪 SNMP 健康状态：熔断 + 基于 RTT 分位数的自适应超时
+
+    - closed: 正常访问；连续失败 failure_threshold 次后转为 open
+    - open: 本次运行剩余时间内跳过该设备的所有请求
+    - half_open: 上一次运行结束时处于 open 的设备，本次运行先放行一次探测，
+      成功则恢复 closed，失败立即重新 open
+    超时 = RTT 的 rtt_percentile 分位数 × timeout_multiplier，限制在
+    [min_timeout, 默认超时] 之间，并向上取整到 0.5 秒（限制传输对象缓存数量）。
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_CIRCUIT_THRESHOLD, rtt_window=50, rtt_percentile=0.95,
+                 timeout_multiplier=4, min_timeout=0.5, min_samples=5):
+        self.failure_threshold = failure_threshold
+        self.rtt_window = rtt_window
+        self.rtt_percentile = rtt_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def _get(self, name):
+        health = self.devices.get(name)
+        if health is None:
+            health = self.devices[name] = {'state': 'closed', 'failures': 0, 'rtts': []}
+        return health
+
+    def allow(self, name):
+        """是否允许向设备发送请求"""
+        with self.lock:
+            return self._get(name)['state'] != 'open'
+
+    def is_open(self, name):
+        with self.lock:
+            return name in self.devices and self.devices[name]['state'] == 'open'
+
+    def half_open(self, name):
+        """把熔断中的设备转为半开（常驻模式下每次调度轮询前调用）"""
+        with self.lock:
+            health = self.devices.get(name)
+            if health and health['state'] == 'open':
+                health['state'] = 'half_open'
+
+    def record_success(self, name, rtt=None):
+        with self.lock:
+            health = self._get(name)
+            if health['state'] == 'half_open':
+                logger.info(f"{name} 探测成功，恢复访问")
+            health['state'] = 'closed'
+            health['failures'] = 0
+            if rtt is not None:
+                health['rtts'].append(round(rtt, 4))
+                del health['rtts'][:-self.rtt_window]
+
+    def record_failure(self, name):
+        """记录一次请求失败，返回该设备是否因此进入熔断"""
+        with self.lock:
+            health = self._get(name)
+            health['failures'] += 1
+            if health['state'] != 'open' and (health['state'] == 'half_open' or
+                                              health['failures'] >= self.failure_threshold):
+                health['state'] = 'open'
+                logger.warning(f"{name} 连续失败 {health['failures']} 次，熔断（本次运行跳过）")
+                return True
+            return False
+
+    def rtt_quantile(self, name, q=None):
+        """设备 RTT 分位数（样本不足时返回 None）"""
+        with self.lock:
+            rtts = sorted(self.devices.get(name, {}).get('rtts', []))
+        if len(rtts) < self.min_samples:
+            return None
+        q = self.rtt_percentile if q is None else q
+        return rtts[min(len(rtts) - 1, int(q * len(rtts)))]
+
+    def timeout(self, name, default):
+        """按设备 RTT 计算本次请求的超时时间"""
+        rtt = self.rtt_quantile(name)
+        if rtt is None:
+            return default
+        timeout = max(self.min_timeout, rtt * self.timeout_multiplier)
+        return min(default, math.ceil(timeout * 2) / 2)
+
+    def open_devices(self):
+        with self.lock:
+            return sorted(name for name, health in self.devices.items() if health['state'] == 'open')
+
+    def load(self, data):
+        """加载上一次运行保存的状态（处于 open 的设备转为 half_open，等待本次探测）"""
+        self.merge({name: dict(health, state='half_open' if health.get('state') == 'open'
+                               else health.get('state', 'closed'))
+                    for name, health in (data or {}).items()})
+
+    def merge(self, data):
+        """合并其它进程（分片）的设备状态"""
+        with self.lock:
+            for name, health in data.items():
+                self.devices[name] = {
+                    'state': health.get('state', 'closed'),
+                    'failures': health.get('failures', 0),
+                    'rtts': list(health.get('rtts', []))[-self.rtt_window:]
+                }
+
+    def dump(self, names=None):
+        with self.lock:
+            return {name: {'state': health['state'], 'failures': health['failures'], 'rtts': list(health['rtts'])}
+                    for name, health in self.devices.items() if names is None or name in names}
+
+class SnmpSessionPool:
+    """SNMP 会话池（每个工作线程复用一个 SnmpEngine 及其 UDP socket）
+
+    SnmpEngine 不是线程安全的，因此按线程各持有一个引擎；同一线程内
+    所有设备、所有 OID 共用该引擎。CommunityData / UdpTransportTarget
+    按参数缓存，避免每次查询都重建 MIB 状态和重新解析地址。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._engines = []
+        self._context = ContextData()
+        self.stats = {
+            'snmp_engines_created': 0,
+            'snmp_sockets_created': 0,
+            'snmp_transports_created': 0,
+            'snmp_requests_sent': 0
+        }
+
+    def _incr(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _on_send_pdu(self, snmpEngine, execpoint, variables, cbCtx):
+        """pysnmp observer 回调：统计实际发出的请求（含 pysnmp 内部重传）"""
+        self._incr('snmp_requests_sent')
+        count_collection_stat('requests')
+        self._local.sent = time.monotonic()
+
+    def _on_response(self, snmpEngine, execpoint, variables, cbCtx):
+        """pysnmp observer 回调：记录最近一次请求的往返时间（不含 MIB 加载等本地开销）和响应字节数"""
+        count_collection_stat('bytes_received', len(variables['wholeMsg']))
+        sent = getattr(self._local, 'sent', None)
+        if sent is not None:
+            self._local.rtt = time.monotonic() - sent
+
+    def take_rtt(self):
+        """取出当前线程最近一次响应的 RTT（没有新响应时返回 None）"""
+        rtt = getattr(self._local, 'rtt', None)
+        self._local.rtt = None
+        return rtt
+
+    def _get_local(self):
+        local = self._local
+        if not hasattr(local, 'engine'):
+            local.engine = SnmpEngine()
+            local.engine.observer.registerObserver(self._on_send_pdu, 'rfc3412.sendPdu')
+            local.engine.observer.registerObserver(self._on_response, 'rfc3412.receiveMessage:response')
+            local.communities = {}
+            local.targets = {}
+            with self._lock:
+                self._engines.append(local.engine)
+                self.stats['snmp_engines_created'] += 1
+        return local
+
+    def session(self, device, timeout, retries=1):
+        """返回 (engine, auth, transport, context)，可直接传给 hlapi 命令"""
+        local = self._get_local()
+
+        community = device.get('snmp_community', 'public')
+        auth = local.communities.get(community)
+        if auth is None:
+            auth = local.communities[community] = CommunityData(community)
+
+        key = (device['host'], device.get('snmp_port', 161), timeout, retries)
+        transport = local.targets.get(key)
+        if transport is None:
+            transport = UdpTransportTarget(key[:2], timeout=timeout, retries=retries)
+            local.targets[key] = transport
+            self._incr('snmp_transports_created')
+
+        # 引擎首次发送请求时才会打开 UDP socket
+        if local.engine.transportDispatcher is None:
+            self._incr('snmp_sockets_created')
+
+        return local.engine, auth, transport, self._context
+
+    def close(self):
+        """关闭所有引擎的 socket"""
+        with self._lock:
+            engines, self._engines = self._engines, []
+        for engine in engines:
+            try:
+                if engine.transportDispatcher is not None:
+                    engine.transportDispatcher.closeDispatcher()
+            except Exception as e:
+                logger.debug(f"关闭 SNMP 引擎失败: {e}")
+        self._local = threading.local()
+
+class TopologyIndex:
+    """拓扑索引：合并阶段一次性构建，供链路聚合、环路检测、层级计算共用
+
+    - adjacency: 设备 -> 邻居 -> 两者之间的所有连接（保留并行链路）
+    - incident: 设备 -> [(对端设备, 本端端口)]，按连接顺序排列
+    - owners: 设备对（排序后）-> 最先上报该设备对的本端设备
+    - multigraph() / graph(): 按需构建一次 NetworkX 图并缓存
+    - labels(): 按节点缓存的拓扑标签，供 file_sd 与 Telegraf 映射共用
+    """
+
+    def __init__(self, topology):
+        self.topology = topology
+        self.adjacency = defaultdict(dict)
+        self.incident = defaultdict(list)
+        self.owners = {}
+        self.links = {}
+        self.label_cache = {}
+        self._multigraph = None
+        self._graph = None
+        for edge in topology['edges']:
+            self.add_edge(edge)
+
+    def pair_key(self, device1, device2):
+        return (device1, device2) if device1 <= device2 else (device2, device1)
+
+    def accepts(self, local_device, local_port, remote_device, remote_port):
+        """判断一条邻居记录是否是新链路
+
+        同一设备对只采用最先上报一侧的记录（两侧端口命名往往不一致，无法逐条配对），
+        该侧的多条不同端口记录都保留，即并行链路。
+        """
+        pair = self.pair_key(local_device, remote_device)
+        owner = self.owners.get(pair)
+        if owner is not None and owner != local_device:
+            return False
+        return (local_port, remote_port) not in self.links.get(pair, ())
+
+    def add_edge(self, edge):
+        source, target = edge['source'], edge['target']
+        pair = self.pair_key(source, target)
+        self.owners.setdefault(pair, source)
+        self.links.setdefault(pair, set()).add((edge['source_port'], edge['target_port']))
+        self.adjacency[source].setdefault(target, []).append(edge)
+        self.adjacency[target].setdefault(source, []).append(edge)
+        self.incident[source].append((target, edge['source_port']))
+        if target != source:
+            self.incident[target].append((source, edge['target_port']))
+        self._multigraph = self._graph = None
+        self.label_cache.clear()
+
+    def pairs(self):
+        """所有有连接的设备对（排序后）"""
+        return set(self.owners)
+
+    def neighbor_count(self, device):
+        """不同邻居设备的数量（并行链路只算一次）"""
+        return len(self.adjacency.get(device, ()))
+
+    def labels(self, device_name):
+        """设备的拓扑标签（首次访问时计算并缓存；层级变化后需调用 invalidate_labels）"""
+        labels = self.label_cache.get(device_name)
+        if labels is not None:
+            return labels
+
+        node = self.topology['nodes'][device_name]
+        incident = self.incident.get(device_name, ())
+
+        # 生成标签（统一的标签集）
+        labels = {
+            'device_name': device_name,
+            'device_type': node.get('type', 'unknown'),
+            'device_tier': node.get('tier', 'unknown'),
+            'device_location': node.get('location', 'unknown'),
+            'device_vendor': node.get('vendor', 'unknown'),
+            'topology_discovered': 'true'
+        }
+
+        # 添加连接信息（统一命名）
+        if incident:
+            labels['connected_switch'] = incident[0][0]
+            labels['connected_switches'] = ','.join(neighbor for neighbor, _ in incident)
+            labels['connected_switch_port'] = incident[0][1]
+
+        self.label_cache[device_name] = labels
+        return labels
+
+    def invalidate_labels(self):
+        self.label_cache.clear()
+
+    def multigraph(self):
+        """包含并行链路的 MultiGraph（需要 NetworkX）"""
+        if self._multigraph is None:
+            import networkx as nx
+            G = nx.MultiGraph()
+            for device_name, node in self.topology['nodes'].items():
+                G.add_node(device_name, **node)
+            for edge in self.topology['edges']:
+                G.add_edge(edge['source'], edge['target'])
+            self._multigraph = G
+        return self._multigraph
+
+    def graph(self):
+        """并行链路折叠后的简单图（环路检测与中心性计算使用）"""
+        if self._graph is None:
+            import networkx as nx
+            self._graph = nx.Graph(self.multigraph())
+        return self._graph
+
 class TopologyDiscovery:
     """网络拓扑发现类（支持 LLDP、CDP、NDP、LNP）"""
 
-    def __init__(self, config_file='/etc/topology/devices.yml'):
-        """初始化"""
+    def __init__(self, config_file='/etc/topology/devices.yml', max_repetitions=DEFAULT_MAX_REPETITIONS,
+                 load_state=True, state_file='/data/topology/discovery-state.json', incremental=True,
+                 circuit_threshold=DEFAULT_CIRCUIT_THRESHOLD, tier_mode=DEFAULT_TIER_MODE,
+                 tier_sample_size=DEFAULT_TIER_SAMPLE_SIZE, snapshot_format=DEFAULT_SNAPSHOT_FORMAT,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, merge_protocols=False):
+        """初始化（load_state=False 时不读取配置、上一次拓扑和设备状态，供分片子进程使用）"""
         self.config_file = config_file
+        self.max_repetitions = max_repetitions
+        self.state_file = state_file
+        self.incremental = incremental  # 邻居表未变化的设备复用上一次的邻居
+        self.probe_interval = probe_interval  # 协议能力缓存有效期（秒）
+        self.merge_protocols = merge_protocols  # 同时采集设备的所有协议并按本地端口合并
+        self.previous_state = {}  # 上一次运行的设备状态（指纹 + 邻居）
+        self.device_state = {}    # 本次运行的设备状态
+        self.device_errors = defaultdict(int)  # 本次运行每个设备的 SNMP 错误数
+        self.device_health = DeviceHealthTracker(circuit_threshold)  # 熔断 + 自适应超时
         self.devices = []
         self.topology = {
             'nodes': {},      # 设备节点
@@ -82,6 +530,11 @@ class TopologyDiscovery:
             'updated': None   # 更新时间
         }
         self.previous_topology = {}  # 上一次的拓扑（用于变化检测）
+        self.topology_index = None   # 当前拓扑的索引（合并阶段构建，分析阶段共用）
+        self.tier_mode = tier_mode   # exact / fast / auto
+        self.tier_sample_size = tier_sample_size
+        self.centrality_cache = {}   # 上一次的中心性结果（图未变化时直接复用）
+        self.snapshot_format = snapshot_format  # topology.json 的写出格式：json / compact / msgpack
         self.metrics = {
             'discovery_duration_seconds': 0,
             'devices_discovered': 0,
@@ -91,15 +544,99 @@ class TopologyDiscovery:
             'ndp_neighbors': 0,
             'lnp_neighbors': 0,
             'snmp_errors': 0,
+            'snmp_errors_by_device': {},
+            'snmp_errors_by_reason': {},
+            'snmp_requests_short_circuited': 0,
+            'devices_circuit_open': 0,
             'lacp_links': 0,
             'loops_detected': 0,
             'topology_changes': 0,
+            'tier_calculation_seconds': 0,
+            'tier_centrality_reused': 0,
+            'devices_polled': 0,
+            'devices_skipped': 0,
+            'protocol_probes': 0,
+            'protocol_walks_skipped': 0,
+            'protocol_overlap_ports': 0,
+            'protocol_overlap_conflicts': 0,
+            'snmp_engines_created': 0,
+            'snmp_sockets_created': 0,
+            'snmp_transports_created': 0,
+            'snmp_requests_sent': 0,
+            'phase_seconds': {},    # 各阶段耗时（同名阶段累加，协议采集为各设备耗时之和）
+            'device_collection_seconds': new_histogram(),  # 单设备采集耗时直方图
+            'device_stats': {},     # 设备名 -> 最近一次采集的耗时、厂商和按协议的统计
             'start_time': None,
             'end_time': None
         }
         self.lock = threading.Lock()
-        self.load_config()
-        self.load_previous_topology()
+        self.snmp_pool = SnmpSessionPool()  # 整个运行期间复用的 SNMP 引擎/传输
+        self.device_nodes = {}  # 本轮采集成功的设备节点
+        self.reset_metrics_on_save = False  # 常驻模式：每次写出指标后清零按轮统计的耗时
+        if load_state:
+            with self.phase('config_load'):
+                self.load_config()
+            with self.phase('state_load'):
+                self.load_previous_topology()
+                self.load_device_state()
+                self.load_centrality_cache()
+
+    @contextmanager
+    def phase(self, name):
+        """记录一个阶段的耗时（写入 metrics['phase_seconds']）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            phases = self.metrics['phase_seconds']
+            phases[name] = round(phases.get(name, 0) + seconds, 6)
+
+    def start_device_stats(self, device):
+        """开始记录设备的一次采集（覆盖上一次的统计）"""
+        with self.lock:
+            self.metrics['device_stats'][device['name']] = {
+                'vendor': device.get('vendor', 'unknown'),
+                'duration_seconds': 0,
+                'protocols': {}
+            }
+
+    @contextmanager
+    def collection_stats(self, device, protocol):
+        """在此上下文中发出的 SNMP 请求计入该设备该协议的统计（请求数、接收字节、重试、超时）"""
+        entry = self.metrics['device_stats'].get(device['name'])
+        if entry is None:
+            yield dict.fromkeys(COLLECTION_STAT_FIELDS, 0)
+            return
+        with self.lock:
+            stats = entry['protocols'].get(protocol)
+            if stats is None:
+                stats = entry['protocols'][protocol] = dict.fromkeys(COLLECTION_STAT_FIELDS, 0)
+        token = current_collection_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            current_collection_stats.reset(token)
+            stats['duration_seconds'] = round(stats['duration_seconds'] + time.perf_counter() - start, 6)
+
+    def observe_device_latency(self, device, seconds):
+        """记录单个设备一次采集的耗时"""
+        with self.lock:
+            observe_histogram(self.metrics['device_collection_seconds'], seconds)
+            entry = self.metrics['device_stats'].get(device['name'])
+            if entry is not None:
+                entry['duration_seconds'] = round(seconds, 6)
+
+    def reset_cycle_metrics(self):
+        """清空按轮统计的阶段耗时、设备采集耗时和各项按轮计数（调用方持有 self.lock）"""
+        self.metrics['phase_seconds'] = {}
+        self.metrics['device_collection_seconds'] = new_histogram()
+        for key in CYCLE_COUNTERS:
+            self.metrics[key] = 0
 
     def load_config(self):
         """加载设备配置"""
@@ -146,13 +683,65 @@ class TopologyDiscovery:
         try:
             topology_file = '/data/topology/topology.json'
             if os.path.exists(topology_file):
-                with open(topology_file, 'r') as f:
-                    self.previous_topology = json.load(f)
+                # 自动识别快照格式（json / compact / msgpack）
+                self.previous_topology = read_topology(topology_file)
                 logger.debug(f"加载上一次拓扑: {len(self.previous_topology.get('nodes', {}))} 个节点")
         except Exception as e:
             logger.warning(f"加载上一次拓扑失败: {e}")
             self.previous_topology = {}
 
+    def load_device_state(self):
+        """加载上一次运行保存的设备状态（用于增量发现）"""
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r') as f:
+                    state = json.load(f)
+                self.previous_state = state.get('devices', {})
+                self.device_health.load(state.get('health', {}))
+                logger.debug(f"加载设备状态: {len(self.previous_state)} 个设备")
+        except Exception as e:
+            logger.warning(f"加载设备状态失败: {e}")
+            self.previous_state = {}
+
+    def save_device_state(self, output_file=None):
+        """保存设备状态（指纹 + 邻居 + 健康状态），供下一次运行判断是否需要重新采集"""
+        output_file = output_file or self.state_file
+        try:
+            written = write_json_atomic(output_file, {'devices': self.device_state,
+                                                      'health': self.device_health.dump()}, indent=None)
+            logger.info(f"设备状态已保存: {output_file}" if written else f"设备状态未变化: {output_file}")
+            return written
+        except Exception as e:
+            logger.error(f"保存设备状态失败: {e}")
+            return False
+
+    def centrality_cache_file(self):
+        return os.path.join(os.path.dirname(self.state_file), 'centrality-cache.json')
+
+    def load_centrality_cache(self):
+        """加载上一次的中心性结果"""
+        try:
+            if os.path.exists(self.centrality_cache_file()):
+                with open(self.centrality_cache_file(), 'r') as f:
+                    self.centrality_cache = json.load(f)
+        except Exception as e:
+            logger.warning(f"加载中心性缓存失败: {e}")
+            self.centrality_cache = {}
+
+    def save_centrality_cache(self, output_file=None):
+        """保存中心性结果，供下一次运行（图未变化时）复用"""
+        if not self.centrality_cache:
+            return False
+        output_file = output_file or self.centrality_cache_file()
+        try:
+            written = write_json_atomic(output_file, self.centrality_cache, indent=None)
+            if written:
+                logger.debug(f"中心性缓存已保存: {output_file}")
+            return written
+        except Exception as e:
+            logger.error(f"保存中心性缓存失败: {e}")
+            return False
+
     def get_vendor_protocols(self, device):
         """根据厂商获取支持的协议列表"""
         vendor = device.get('vendor', '').lower()
@@ -176,363 +765,568 @@ class TopologyDiscovery:
             logger.error(f"加载配置失败: {e}")
             self.devices = []
 
+    def record_snmp_error(self, device, reason='snmp_error'):
+        """记录一次 SNMP 错误（重试耗尽或设备熔断后），同时按设备和原因分类计数"""
+        with self.lock:
+            self.metrics['snmp_errors'] += 1
+            self.device_errors[device['name']] += 1
+            by_device = self.metrics['snmp_errors_by_device']
+            by_device[device['name']] = by_device.get(device['name'], 0) + 1
+            by_reason = self.metrics['snmp_errors_by_reason']
+            by_reason[reason] = by_reason.get(reason, 0) + 1
+
+    def snmp_allowed(self, device):
+        """熔断检查：设备熔断中则不发请求"""
+        if self.device_health.allow(device['name']):
+            return True
+        with self.lock:
+            self.metrics['snmp_requests_short_circuited'] += 1
+        return False
+
+    def snmp_attempt_failed(self, device, reason, message, last_attempt):
+        """一次尝试失败：计入熔断；重试耗尽或设备刚被熔断时记为 SNMP 错误
+
+        返回 True 表示不再重试。
+        """
+        if reason == 'timeout':
+            count_collection_stat('timeouts')
+        opened = self.device_health.record_failure(device['name'])
+        if opened:
+            with self.lock:
+                self.metrics['devices_circuit_open'] += 1
+        if last_attempt or opened:
+            logger.error(f"{device['name']} SNMP 错误: {message}")
+            self.record_snmp_error(device, reason)
+            return True
+        return False
+
     def snmp_walk_with_retry(self, device, oid, max_retries=3):
         """SNMP Walk 查询（带重试机制）"""
-        results = []
+        name = device['name']
 
         for attempt in range(max_retries):
+            if not self.snmp_allowed(device):
+                break
+            if attempt:
+                count_collection_stat('retries')
+            results = []
+            error = None
             try:
+                engine, auth, transport, context = self.snmp_pool.session(
+                    device, timeout=self.device_health.timeout(name, 5))
+                self.snmp_pool.take_rtt()
                 for (errorIndication,
                      errorStatus,
                      errorIndex,
-                     varBinds) in nextCmd(SnmpEngine(),
-                                          CommunityData(device.get('snmp_community', 'public')),
-                                          UdpTransportTarget((device['host'], device.get('snmp_port', 161)), timeout=5, retries=1),
-                                          ContextData(),
+                     varBinds) in nextCmd(engine, auth, transport, context,
                                           ObjectType(ObjectIdentity(oid)),
                                           lexicographicMode=False):
 
-                    if errorIndication:
-                        if attempt == max_retries - 1:
-                            logger.error(f"{device['name']} SNMP 错误: {errorIndication}")
-                            with self.lock:
-                                self.metrics['snmp_errors'] += 1
-                        break
-                    elif errorStatus:
-                        if attempt == max_retries - 1:
-                            logger.error(f"{device['name']} SNMP 错误: {errorStatus}")
-                            with self.lock:
-                                self.metrics['snmp_errors'] += 1
+                    if errorIndication or errorStatus:
+                        error = (snmp_error_reason(errorIndication, errorStatus),
+                                 errorIndication or errorStatus.prettyPrint())
                         break
-                    else:
-                        for varBind in varBinds:
-                            results.append(varBind)
 
-                # 成功则返回
-                if results:
+                    self.device_health.record_success(name, self.snmp_pool.take_rtt())
+                    results.extend(varBinds)
+
+                if error is None:
                     return results
+                if self.snmp_attempt_failed(device, error[0], error[1], attempt == max_retries - 1):
+                    break
 
             except Exception as e:
-                if attempt == max_retries - 1:
-                    logger.error(f"{device['name']} SNMP 查询失败: {e}")
-                    with self.lock:
-                        self.metrics['snmp_errors'] += 1
-                else:
-                    # 指数退避
-                    wait_time = 2 ** attempt
-                    logger.warning(f"{device['name']} 查询失败，{wait_time}秒后重试 ({attempt + 1}/{max_retries})")
-                    time.sleep(wait_time)
+                if self.snmp_attempt_failed(device, 'exception', e, attempt == max_retries - 1):
+                    break
+                # 指数退避
+                wait_time = 2 ** attempt
+                logger.warning(f"{name} 查询失败，{wait_time}秒后重试 ({attempt + 1}/{max_retries})")
+                time.sleep(wait_time)
 
-        return results
+        return []
 
     def snmp_get_with_retry(self, device, oid, max_retries=3):
         """SNMP Get 查询（带重试机制）"""
         for attempt in range(max_retries):
+            if not self.snmp_allowed(device):
+                break
+            if attempt:
+                count_collection_stat('retries')
             try:
-                errorIndication, errorStatus, errorIndex, varBinds = next(
-                    getCmd(SnmpEngine(),
-                          CommunityData(device.get('snmp_community', 'public')),
-                          UdpTransportTarget((device['host'], device.get('snmp_port', 161)), timeout=3, retries=1),
-                          ContextData(),
-                          ObjectType(ObjectIdentity(oid)))
-                )
-
-                if errorIndication or errorStatus:
-                    if attempt == max_retries - 1:
-                        return None
-                else:
-                    return str(varBinds[0][1]) if varBinds else None
-
+                values = self.snmp_get_many(device, [oid], raise_errors=True)
+                return str(values[0]) if values[0] is not None else None
+            except SnmpRequestError as e:
+                if self.snmp_attempt_failed(device, e.reason, e, attempt == max_retries - 1):
+                    break
             except Exception as e:
-                if attempt == max_retries - 1:
-                    logger.error(f"{device['name']} SNMP get 失败: {e}")
-                else:
-                    wait_time = 2 ** attempt
-                    time.sleep(wait_time)
+                if self.snmp_attempt_failed(device, 'exception', e, attempt == max_retries - 1):
+                    break
+                wait_time = 2 ** attempt
+                time.sleep(wait_time)
 
         return None
-                    
-        return None
 
-    def get_lldp_neighbors(self, device):
-        """获取设备的 LLDP 邻居信息"""
-        # LLDP MIB OIDs
-        LLDP_REM_CHASSIS_ID = '1.0.8802.1.1.2.1.4.1.1.5'      # 远端设备 Chassis ID
-        LLDP_REM_PORT_ID = '1.0.8802.1.1.2.1.4.1.1.7'         # 远端端口 ID
-        LLDP_REM_SYS_NAME = '1.0.8802.1.1.2.1.4.1.1.9'        # 远端系统名称
-        LLDP_REM_PORT_DESC = '1.0.8802.1.1.2.1.4.1.1.8'       # 远端端口描述
-        LLDP_LOC_PORT_DESC = '1.0.8802.1.1.2.1.3.7.1.4'       # 本地端口描述
+    def snmp_get_many(self, device, oids, timeout=3, raise_errors=False):
+        """一次 GET 请求获取多个 OID（不重试，失败返回 None）
 
-        neighbors = []
+        返回与 oids 顺序一致的值列表，设备不支持的 OID 对应 None。
+        失败会计入设备熔断；raise_errors=True 时失败抛出异常而不是返回 None。
+        """
+        name = device['name']
+        if not self.snmp_allowed(device):
+            if raise_errors:
+                raise CircuitOpenError(name)
+            return None
 
         try:
-            # 获取远端系统名称
-            logger.debug(f"正在采集 {device['name']} 的 LLDP 邻居...")
-            rem_sys_names = self.snmp_walk_with_retry(device, LLDP_REM_SYS_NAME)
-
-            for varBind in rem_sys_names:
-                oid_str = str(varBind[0])
-                remote_name = str(varBind[1])
-
-                # 从 OID 中提取索引（时间戳.本地端口.远端索引）
-                # 例如: 1.0.8802.1.1.2.1.4.1.1.9.0.12.456 -> 0.12.456
-                parts = oid_str.split('.')
-                if len(parts) >= 15:
-                    time_mark = parts[-3]
-                    local_port_num = parts[-2]
-                    remote_index = parts[-1]
-
-                    # 构造其他 OID 来获取详细信息
-                    index_suffix = f"{time_mark}.{local_port_num}.{remote_index}"
-
-                    # 获取本地端口描述
-                    local_port_oid = f"{LLDP_LOC_PORT_DESC}.{local_port_num}"
-                    local_port_desc = self.snmp_get_with_retry(device, local_port_oid)
-
-                    # 获取远端端口 ID
-                    remote_port_oid = f"{LLDP_REM_PORT_ID}.{index_suffix}"
-                    remote_port = self.snmp_get_with_retry(device, remote_port_oid)
-
-                    neighbor = {
-                        'local_device': device['name'],
-                        'local_port': local_port_desc or f"Port-{local_port_num}",
-                        'remote_device': remote_name,
-                        'remote_port': remote_port or 'Unknown',
-                        'protocol': 'lldp',
-                        'timestamp': datetime.now().isoformat()
-                    }
-
-                    neighbors.append(neighbor)
-                    logger.debug(f"  发现 LLDP 邻居: {neighbor}")
+            engine, auth, transport, context = self.snmp_pool.session(
+                device, timeout=self.device_health.timeout(name, timeout))
+            self.snmp_pool.take_rtt()
+            errorIndication, errorStatus, errorIndex, varBinds = next(
+                getCmd(engine, auth, transport, context,
+                       *[ObjectType(ObjectIdentity(oid)) for oid in oids],
+                       lookupMib=False)
+            )
+            if errorIndication or errorStatus:
+                raise SnmpRequestError(snmp_error_reason(errorIndication, errorStatus),
+                                       str(errorIndication or errorStatus.prettyPrint()))
+            self.device_health.record_success(name, self.snmp_pool.take_rtt())
+            return [None if isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance)) else value
+                    for _, value in varBinds]
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.debug(f"{name} SNMP get 失败: {e}")
+            # 单次 GET 没有重试，直接计入熔断（设备刚被熔断时记为 SNMP 错误）
+            self.snmp_attempt_failed(device, getattr(e, 'reason', 'exception'), e, False)
+            return None
+
+    def snmp_get_next_many(self, device, oids, timeout=3):
+        """一次 GETNEXT 请求获取多个 OID 各自的下一个对象（不重试，失败返回 None）
+
+        返回与 oids 顺序一致的 (OID, 值) 列表；失败计入设备熔断。
+        """
+        name = device['name']
+        if not self.snmp_allowed(device):
+            return None
 
-            with self.lock:
-                self.metrics['lldp_neighbors'] += len(neighbors)
-            
-            logger.debug(f"{device['name']} 发现 {len(neighbors)} 个 LLDP 邻居")
-            
+        try:
+            engine, auth, transport, context = self.snmp_pool.session(
+                device, timeout=self.device_health.timeout(name, timeout))
+            self.snmp_pool.take_rtt()
+            errorIndication, errorStatus, errorIndex, varBinds = next(
+                nextCmd(engine, auth, transport, context,
+                        *[ObjectType(ObjectIdentity(oid)) for oid in oids],
+                        lexicographicMode=True, lookupMib=False)
+            )
+            if errorIndication or errorStatus:
+                raise SnmpRequestError(snmp_error_reason(errorIndication, errorStatus),
+                                       str(errorIndication or errorStatus.prettyPrint()))
+            self.device_health.record_success(name, self.snmp_pool.take_rtt())
+            return [(oid, value) for oid, value in varBinds]
         except Exception as e:
-            logger.error(f"{device['name']} LLDP 采集失败: {e}")
+            logger.debug(f"{name} SNMP getnext 失败: {e}")
+            self.snmp_attempt_failed(device, getattr(e, 'reason', 'exception'), e, False)
+            return None
+
+    def snmp_request(self, device, kind, argument):
+        """执行采集步骤产出的一个 SNMP 请求：get / getnext 为 OID 列表，bulk 为 {列名: 列 OID}"""
+        if kind == 'get':
+            return self.snmp_get_many(device, argument)
+        if kind == 'getnext':
+            return self.snmp_get_next_many(device, argument)
+        return self.snmp_bulk_columns(device, argument)
+
+    def run_steps(self, device, steps):
+        """同步执行采集步骤：逐个完成 steps 产出的 SNMP 请求并把结果（或异常）送回，返回 steps 的返回值
+
+        采集流程（增量判断、协议选择与回退、错误统计）写成只产出请求、不做 I/O 的生成器，
+        线程池和异步引擎（async_discovery.AsyncDiscoveryEngine.run_steps）共用同一份流程，只各自实现 I/O。
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = self.snmp_request(device, *request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+    def snmp_bulk_columns(self, device, columns, max_retries=3):
+        """GETBULK 批量获取多列（带重试机制）
+
+        columns: {列名: 列 OID}，所有列放在同一个 GETBULK 请求里一起推进，
+        往返次数只取决于最长的一列（行数 / max-repetitions），与列数无关。
+        设备熔断后立即放弃，不再重试。
+        返回: {列名: {行索引后缀: 值}}
+        """
+        name = device['name']
+        names = list(columns)
+        prefixes = [tuple(int(x) for x in columns[column].split('.')) for column in names]
+        max_repetitions = int(device.get('snmp_max_repetitions', self.max_repetitions))
+
+        for attempt in range(max_retries):
+            if not self.snmp_allowed(device):
+                break
+            if attempt:
+                count_collection_stat('retries')
+            results = {column: {} for column in names}
+            error = None
+            try:
+                engine, auth, transport, context = self.snmp_pool.session(
+                    device, timeout=self.device_health.timeout(name, 5))
+                self.snmp_pool.take_rtt()
+                for (errorIndication,
+                     errorStatus,
+                     errorIndex,
+                     varBinds) in bulkCmd(engine, auth, transport, context,
+                                          0, max_repetitions,
+                                          *[ObjectType(ObjectIdentity(columns[column])) for column in names],
+                                          lexicographicMode=False,
+                                          lookupMib=False):
+
+                    if errorIndication or errorStatus:
+                        error = (snmp_error_reason(errorIndication, errorStatus),
+                                 errorIndication or errorStatus.prettyPrint())
+                        break
+
+                    self.device_health.record_success(name, self.snmp_pool.take_rtt())
+
+                    for column, prefix, (oid, value) in zip(names, prefixes, varBinds):
+                        # 已结束的列会以 endOfMibView 占位
+                        if isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance)):
+                            continue
+                        oid = tuple(oid)
+                        if oid[:len(prefix)] != prefix:
+                            continue
+                        index = '.'.join(str(x) for x in oid[len(prefix):])
+                        results[column][index] = str(value)
+
+                if error is None:
+                    return results
+                if self.snmp_attempt_failed(device, error[0], error[1], attempt == max_retries - 1):
+                    break
+
+            except Exception as e:
+                if self.snmp_attempt_failed(device, 'exception', f"bulk 查询失败: {e}",
+                                            attempt == max_retries - 1):
+                    break
+                # 指数退避
+                wait_time = 2 ** attempt
+                logger.warning(f"{name} 查询失败，{wait_time}秒后重试 ({attempt + 1}/{max_retries})")
+                time.sleep(wait_time)
+
+        return {column: {} for column in names}
+
+    def parse_lldp_neighbors(self, device, columns):
+        """按索引合并 LLDP 各列"""
+        neighbors = []
+        local_ports = columns['loc_port_desc']
+        remote_ports = columns['rem_port_id']
+
+        for index, remote_name in columns['rem_sys_name'].items():
+            # 索引格式: 时间戳.本地端口.远端索引，例如 0.12.456
+            parts = index.split('.')
+            if len(parts) != 3:
+                continue
+            local_port_num = parts[1]
+
+            neighbor = {
+                'local_device': device['name'],
+                'local_port': local_ports.get(local_port_num) or f"Port-{local_port_num}",
+                'local_port_num': local_port_num,
+                'remote_device': remote_name,
+                'remote_port': remote_ports.get(index) or 'Unknown',
+                'protocol': 'lldp',
+                'timestamp': datetime.now().isoformat()
+            }
+            neighbors.append(neighbor)
+            logger.debug(f"  发现 LLDP 邻居: {neighbor}")
 
         return neighbors
 
-    def get_cdp_neighbors(self, device):
-        """获取设备的 CDP 邻居信息（Cisco Discovery Protocol）"""
-        # CDP MIB OIDs
-        CDP_CACHE_TABLE = '1.3.6.1.4.1.9.9.23.1.2.1.1'
-        CDP_CACHE_ADDRESS = '1.3.6.1.4.1.9.9.23.1.2.1.1.4'
-        CDP_CACHE_VERSION = '1.3.6.1.4.1.9.9.23.1.2.1.1.5'
-        CDP_CACHE_DEVICE_ID = '1.3.6.1.4.1.9.9.23.1.2.1.1.6'
-        CDP_CACHE_DEVICE_PORT = '1.3.6.1.4.1.9.9.23.1.2.1.1.7'
-        CDP_CACHE_PLATFORM = '1.3.6.1.4.1.9.9.23.1.2.1.1.8'
+    def parse_cdp_neighbors(self, device, columns):
+        """按索引合并 CDP 各列（索引: ifIndex.deviceIndex）"""
+        neighbors = []
+        if_descr = columns['if_descr']
+
+        for index, device_id in columns['device_id'].items():
+            if not device_id:
+                continue
+            if_index = index.split('.')[0]
+
+            neighbor = {
+                'local_device': device['name'],
+                'local_port': if_descr.get(if_index) or 'Unknown',
+                'local_if_index': if_index,
+                'remote_device': device_id,
+                'remote_port': columns['device_port'].get(index) or 'Unknown',
+                'protocol': 'cdp',
+                'platform': columns['platform'].get(index) or 'Unknown',
+                'timestamp': datetime.now().isoformat()
+            }
+            neighbors.append(neighbor)
+            logger.debug(f"  发现 CDP 邻居: {neighbor}")
+
+        return neighbors
 
+    def parse_private_neighbors(self, device, columns, protocol):
+        """按索引合并私有 MIB（NDP/LNP）各列，三列共用同一索引"""
         neighbors = []
 
-        try:
-            logger.debug(f"正在采集 {device['name']} 的 CDP 邻居...")
-            cdp_entries = self.snmp_walk_with_retry(device, CDP_CACHE_TABLE)
-
-            for varBind in cdp_entries:
-                oid_str = str(varBind[0])
-                parts = oid_str.split('.')
-                if len(parts) >= 12:
-                    index = parts[-1]
-                    
-                    device_id_oid = f"{CDP_CACHE_DEVICE_ID}.{index}"
-                    device_id = self.snmp_get_with_retry(device, device_id_oid)
-                    
-                    remote_port_oid = f"{CDP_CACHE_DEVICE_PORT}.{index}"
-                    remote_port = self.snmp_get_with_retry(device, remote_port_oid)
-                    
-                    local_port_oid = f"{CDP_CACHE_TABLE}.{index}"
-                    local_port = self.snmp_get_with_retry(device, local_port_oid)
-                    
-                    platform_oid = f"{CDP_CACHE_PLATFORM}.{index}"
-                    platform = self.snmp_get_with_retry(device, platform_oid)
-
-                    if device_id:
-                        neighbor = {
-                            'local_device': device['name'],
-                            'local_port': local_port or 'Unknown',
-                            'remote_device': device_id,
-                            'remote_port': remote_port or 'Unknown',
-                            'protocol': 'cdp',
-                            'platform': platform or 'Unknown',
-                            'timestamp': datetime.now().isoformat()
-                        }
-
-                        neighbors.append(neighbor)
-                        logger.debug(f"  发现 CDP 邻居: {neighbor}")
+        for index, neighbor_name in columns['neighbor_name'].items():
+            if not neighbor_name:
+                continue
 
-            with self.lock:
-                self.metrics['cdp_neighbors'] += len(neighbors)
-            
-            logger.debug(f"{device['name']} 发现 {len(neighbors)} 个 CDP 邻居")
-            
-        except Exception as e:
-            logger.error(f"{device['name']} CDP 采集失败: {e}")
+            neighbor = {
+                'local_device': device['name'],
+                'local_port': columns['local_port'].get(index) or 'Unknown',
+                'remote_device': neighbor_name,
+                'remote_port': columns['neighbor_port'].get(index) or 'Unknown',
+                'protocol': protocol,
+                'timestamp': datetime.now().isoformat()
+            }
+            neighbors.append(neighbor)
+            logger.debug(f"  发现 {protocol.upper()} 邻居: {neighbor}")
 
         return neighbors
 
-    def get_ndp_neighbors(self, device):
-        """获取设备的 NDP 邻居信息（华为 Neighbor Discovery Protocol）"""
-        # 华为 NDP MIB OIDs
-        # HW_NDP_TABLE = '1.3.6.1.4.1.2011.5.25.41.1.2.1'
-        # 华为 NDP 实现类似 CDP，使用私有 MIB
-        NDP_TABLE = '1.3.6.1.4.1.2011.5.25.41.1.2.1'
-        NDP_NEIGHBOR_ID = '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.3'
-        NDP_NEIGHBOR_PORT = '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.4'
-        NDP_LOCAL_PORT = '1.3.6.1.4.1.2011.5.25.41.1.2.1.1.2'
+    def parse_neighbors(self, protocol, device, columns):
+        """将 snmp_bulk_columns 的结果转换为邻居列表"""
+        if protocol == 'lldp':
+            return self.parse_lldp_neighbors(device, columns)
+        if protocol == 'cdp':
+            return self.parse_cdp_neighbors(device, columns)
+        return self.parse_private_neighbors(device, columns, protocol)
+
+    def get_protocol_neighbors(self, device, protocol, fingerprint=None):
+        """批量获取某协议的邻居表并在内存中按索引合并"""
+        return self.run_steps(device, self.protocol_neighbor_steps(device, protocol, fingerprint))
+
+    def protocol_neighbor_steps(self, device, protocol, fingerprint=None):
+        """采集步骤：批量获取某协议的邻居表并在内存中按索引合并
 
+        传入 fingerprint 时顺便记录该协议指纹列的哈希（供下一次增量判断）
+        """
         neighbors = []
 
         try:
-            logger.debug(f"正在采集 {device['name']} 的 NDP 邻居...")
-            ndp_entries = self.snmp_walk_with_retry(device, NDP_TABLE)
-
-            for varBind in ndp_entries:
-                oid_str = str(varBind[0])
-                parts = oid_str.split('.')
-                if len(parts) >= 15:
-                    index = parts[-1]
-                    
-                    neighbor_id_oid = f"{NDP_NEIGHBOR_ID}.{index}"
-                    neighbor_id = self.snmp_get_with_retry(device, neighbor_id_oid)
-                    
-                    neighbor_port_oid = f"{NDP_NEIGHBOR_PORT}.{index}"
-                    neighbor_port = self.snmp_get_with_retry(device, neighbor_port_oid)
-                    
-                    local_port_oid = f"{NDP_LOCAL_PORT}.{index}"
-                    local_port = self.snmp_get_with_retry(device, local_port_oid)
-
-                    if neighbor_id:
-                        neighbor = {
-                            'local_device': device['name'],
-                            'local_port': local_port or 'Unknown',
-                            'remote_device': neighbor_id,
-                            'remote_port': neighbor_port or 'Unknown',
-                            'protocol': 'ndp',
-                            'timestamp': datetime.now().isoformat()
-                        }
-
-                        neighbors.append(neighbor)
-                        logger.debug(f"  发现 NDP 邻居: {neighbor}")
+            logger.debug(f"正在采集 {device['name']} 的 {protocol.upper()} 邻居...")
+            with self.phase(f'collect_{protocol}'), self.collection_stats(device, protocol) as stats:
+                columns = yield 'bulk', NEIGHBOR_COLUMNS[protocol]
+            neighbors = self.parse_neighbors(protocol, device, columns)
+            stats['neighbors'] = len(neighbors)
+            if fingerprint is not None and neighbors:
+                fingerprint['column_hash'] = column_hash(protocol, columns)
 
             with self.lock:
-                self.metrics['ndp_neighbors'] += len(neighbors)
-            
-            logger.debug(f"{device['name']} 发现 {len(neighbors)} 个 NDP 邻居")
-            
+                self.metrics[f'{protocol}_neighbors'] += len(neighbors)
+
+            logger.debug(f"{device['name']} 发现 {len(neighbors)} 个 {protocol.upper()} 邻居")
+
         except Exception as e:
-            logger.error(f"{device['name']} NDP 采集失败: {e}")
+            logger.error(f"{device['name']} {protocol.upper()} 采集失败: {e}")
 
         return neighbors
 
-    def get_lnp_neighbors(self, device):
-        """获取设备的 LNP 邻居信息（华三 Link Neighbor Protocol）"""
-        # 华三 LNP MIB OIDs
-        LNP_TABLE = '1.3.6.1.4.1.25506.2.12.1.1.2'
-        LNP_NEIGHBOR_NAME = '1.3.6.1.4.1.25506.2.12.1.1.2.1.3'
-        LNP_NEIGHBOR_PORT = '1.3.6.1.4.1.25506.2.12.1.1.2.1.4'
-        LNP_LOCAL_PORT = '1.3.6.1.4.1.25506.2.12.1.1.2.1.2'
-
-        neighbors = []
+    def merged_neighbor_steps(self, device, protocols, fingerprint=None):
+        """采集步骤：在同一个 GETBULK 请求中同时推进设备所有协议的邻居表，按本地端口合并
 
+        往返次数只取决于最长的一张表（而不是各协议之和）。返回 (邻居, 首选来源协议, 有邻居的协议列表)。
+        """
         try:
-            logger.debug(f"正在采集 {device['name']} 的 LNP 邻居...")
-            lnp_entries = self.snmp_walk_with_retry(device, LNP_TABLE)
-
-            for varBind in lnp_entries:
-                oid_str = str(varBind[0])
-                parts = oid_str.split('.')
-                if len(parts) >= 15:
-                    index = parts[-1]
-                    
-                    neighbor_name_oid = f"{LNP_NEIGHBOR_NAME}.{index}"
-                    neighbor_name = self.snmp_get_with_retry(device, neighbor_name_oid)
-                    
-                    neighbor_port_oid = f"{LNP_NEIGHBOR_PORT}.{index}"
-                    neighbor_port = self.snmp_get_with_retry(device, neighbor_port_oid)
-                    
-                    local_port_oid = f"{LNP_LOCAL_PORT}.{index}"
-                    local_port = self.snmp_get_with_retry(device, local_port_oid)
-
-                    if neighbor_name:
-                        neighbor = {
-                            'local_device': device['name'],
-                            'local_port': local_port or 'Unknown',
-                            'remote_device': neighbor_name,
-                            'remote_port': neighbor_port or 'Unknown',
-                            'protocol': 'lnp',
-                            'timestamp': datetime.now().isoformat()
-                        }
-
-                        neighbors.append(neighbor)
-                        logger.debug(f"  发现 LNP 邻居: {neighbor}")
+            logger.debug(f"正在同时采集 {device['name']} 的 {'/'.join(p.upper() for p in protocols)} 邻居...")
+            with self.phase('collect_merged'), self.collection_stats(device, 'merged') as stats:
+                columns = split_protocol_columns((yield 'bulk', merged_collection_columns(protocols)))
+            return self.merge_collected_neighbors(device, protocols, columns, fingerprint, stats)
 
-            with self.lock:
-                self.metrics['lnp_neighbors'] += len(neighbors)
-            
-            logger.debug(f"{device['name']} 发现 {len(neighbors)} 个 LNP 邻居")
-            
         except Exception as e:
-            logger.error(f"{device['name']} LNP 采集失败: {e}")
+            logger.error(f"{device['name']} 多协议采集失败: {e}")
+            return [], None, []
 
-        return neighbors
+    def merge_collected_neighbors(self, device, protocols, columns, fingerprint, stats):
+        """解析各协议的邻居表并按协议优先级合并"""
+        protocol_neighbors = {protocol: self.parse_neighbors(protocol, device, columns[protocol])
+                              for protocol in protocols}
+        sources = [protocol for protocol in protocols if protocol_neighbors[protocol]]
+        neighbors, overlaps, conflicts = merge_neighbors(protocols, protocol_neighbors, port_key_resolver(columns))
+        stats['neighbors'] = len(neighbors)
+
+        hash_protocols = [protocol for protocol in sources if protocol != 'lldp']
+        if fingerprint is not None and hash_protocols:
+            fingerprint['column_hash'] = protocols_column_hash(hash_protocols, columns)
+
+        with self.lock:
+            for neighbor in neighbors:
+                self.metrics[f"{neighbor['protocol']}_neighbors"] += 1
+            self.metrics['protocol_overlap_ports'] += overlaps
+            self.metrics['protocol_overlap_conflicts'] += conflicts
+
+        if conflicts:
+            logger.debug(f"{device['name']} 有 {conflicts} 个端口在不同协议中的邻居不一致，按协议优先级 {protocols} 取舍")
+        logger.debug(f"{device['name']} 合并 {sources} 后共 {len(neighbors)} 个邻居（{overlaps} 个端口重叠）")
+        return neighbors, (sources[0] if sources else None), sources
+
+    def fingerprint_steps(self, device):
+        """采集步骤：一次 GET 获取设备指纹（sysUpTime + lldpStatsRemTablesLastChangeTime）"""
+        values = yield 'get', [SYS_UPTIME, LLDP_REM_TABLES_LAST_CHANGE]
+        if values is None or values[0] is None:
+            return None
+        return {
+            'sys_uptime': int(values[0]),
+            'lldp_last_change': int(values[1]) if values[1] is not None else None
+        }
+
+    def check_fingerprint_steps(self, device, protocols, fingerprint):
+        """采集步骤：判断设备邻居表自上一次运行以来是否未变化"""
+        previous = self.previous_state.get(device['name'])
+        if not self.incremental or not fingerprint or not previous:
+            return False
+
+        hash_protocols = fingerprint_hash_protocols(previous, protocols)
+        if hash_protocols:
+            columns = yield 'bulk', merge_protocol_columns(fingerprint_columns(hash_protocols))
+            fingerprint['column_hash'] = protocols_column_hash(hash_protocols, split_protocol_columns(columns))
+
+        return fingerprint_unchanged(previous, protocols, fingerprint)
+
+    def reuse_neighbors(self, device):
+        """复用上一次运行的邻居（邻居表未变化）"""
+        previous = self.previous_state[device['name']]
+        neighbors = previous.get('neighbors', [])
+        protocol = previous.get('protocol')
+        with self.lock:
+            for neighbor in neighbors:
+                self.metrics[f"{neighbor.get('protocol', protocol)}_neighbors"] += 1
+            self.metrics['devices_skipped'] += 1
+        if protocol:
+            with self.collection_stats(device, 'merged' if previous.get('sources') else protocol) as stats:
+                stats['neighbors'] = len(neighbors)
+        logger.debug(f"{device['name']} 邻居表未变化，复用 {len(neighbors)} 个邻居")
+        return list(neighbors)
+
+    def record_device_state(self, device, protocols, protocol, fingerprint, neighbors, errors_before=0,
+                            capabilities=None, sources=None):
+        """记录本次运行的设备状态
+
+        采集过程中出现 SNMP 错误时不保存指纹，保证下一次必定完整采集；协议能力与指纹无关，照常保存。
+        sources 为多协议合并采集时有邻居的协议（增量判断需要逐一比较）。
+        """
+        state = {
+            'protocols': protocols,
+            'protocol': protocol,
+            'neighbors': neighbors
+        }
+        if sources:
+            state['sources'] = sources
+        if capabilities:
+            state['capabilities'] = capabilities
+        if fingerprint and self.device_errors.get(device['name'], 0) == errors_before:
+            state.update(fingerprint)
+        with self.lock:
+            self.device_state[device['name']] = state
+
+    def cached_capabilities(self, device, protocols, fingerprint):
+        """上一次的协议能力探测结果仍有效时返回（记录本次的 sysUpTime），否则返回 None"""
+        previous = self.previous_state.get(device['name'], {}).get('capabilities')
+        if not capabilities_valid(previous, probe_candidates(protocols), fingerprint, self.probe_interval):
+            return None
+        capabilities = dict(previous)
+        if fingerprint and fingerprint.get('sys_uptime') is not None:
+            capabilities['sys_uptime'] = fingerprint['sys_uptime']
+        return capabilities
+
+    def record_probe(self, protocols, varbinds, fingerprint):
+        """记录一次协议探测，返回新的协议能力（探测失败返回 None）"""
+        with self.lock:
+            self.metrics['protocol_probes'] += 1
+        if varbinds is None:
+            return None
+        return {
+            'protocols': probe_results(protocols, varbinds),
+            'probed_at': int(time.time()),
+            'sys_uptime': fingerprint.get('sys_uptime')
+        }
+
+    def protocol_capability_steps(self, device, protocols, fingerprint):
+        """采集步骤：设备的协议能力，缓存有效时直接使用，否则用一次 GETNEXT 探测
+
+        返回 None 表示能力未知（关闭探测、取不到 sysUpTime 或探测失败），按原顺序尝试所有协议。
+        """
+        if self.probe_interval <= 0:
+            return None
+        capabilities = self.cached_capabilities(device, protocols, fingerprint)
+        candidates = probe_candidates(protocols)
+        if capabilities is not None or not fingerprint or not candidates:
+            return capabilities
+        with self.collection_stats(device, 'probe'):
+            varbinds = yield 'getnext', [PROTOCOL_MIB_ROOTS[p] for p in candidates]
+        return self.record_probe(candidates, varbinds, fingerprint)
+
+    def protocols_to_collect(self, device, protocols, capabilities):
+        """按优先级返回需要采集的协议，跳过探测为不支持的协议（不发任何请求）"""
+        selected = []
+        for protocol in protocols:
+            if protocol not in NEIGHBOR_COLUMNS:
+                continue
+            if capabilities and capabilities['protocols'].get(protocol) is False:
+                logger.debug(f"{device['name']} 不支持 {protocol.upper()}，跳过")
+                with self.lock:
+                    self.metrics['protocol_walks_skipped'] += 1
+                continue
+            selected.append(protocol)
+        return selected
+
+    def get_lldp_neighbors(self, device):
+        """获取设备的 LLDP 邻居信息"""
+        return self.get_protocol_neighbors(device, 'lldp')
+
+    def get_cdp_neighbors(self, device):
+        """获取设备的 CDP 邻居信息（Cisco Discovery Protocol）"""
+        return self.get_protocol_neighbors(device, 'cdp')
+
+    def get_ndp_neighbors(self, device):
+        """获取设备的 NDP 邻居信息（华为 Neighbor Discovery Protocol）"""
+        return self.get_protocol_neighbors(device, 'ndp')
+
+    def get_lnp_neighbors(self, device):
+        """获取设备的 LNP 邻居信息（华三 Link Neighbor Protocol）"""
+        return self.get_protocol_neighbors(device, 'lnp')
 
     def detect_lacp_aggregations(self):
-        """检测链路聚合（LACP）"""
-        # LACP MIB OIDs
-        LACP_AGG_TABLE = '1.2.840.10006.300.43.1.1.1'
-        
+        """检测链路聚合（LACP）：同一设备对之间存在多条并行链路"""
         aggregations = []
-        
+
         try:
-            import networkx as nx
-            
-            # 构建图
-            G = nx.Graph()
-            
-            for device_name, node in self.topology['nodes'].items():
-                G.add_node(device_name, **node)
-            
-            for edge in self.topology['edges']:
-                G.add_edge(edge['source'], edge['target'], **edge)
-            
-            # 检测多重边（可能是链路聚合）
-            for device_name in self.topology['nodes'].keys():
-                neighbors = list(G.neighbors(device_name))
-                
-                # 统计每个邻居的连接数
-                neighbor_count = defaultdict(int)
-                for neighbor in neighbors:
-                    neighbor_count[neighbor] += 1
-                
-                # 如果某个邻居有多个连接，可能是链路聚合
-                for neighbor, count in neighbor_count.items():
-                    if count > 1:
-                        # 获取所有连接的端口
-                        ports = []
-                        for edge in self.topology['edges']:
-                            if (edge['source'] == device_name and edge['target'] == neighbor) or \
-                               (edge['source'] == neighbor and edge['target'] == device_name):
-                                ports.append(edge.get('source_port', 'Unknown'))
-                        
-                        aggregation = {
-                            'device1': device_name,
-                            'device2': neighbor,
-                            'link_count': count,
-                            'ports': ports,
-                            'type': 'lacp'
-                        }
-                        
-                        aggregations.append(aggregation)
-                        logger.info(f"检测到链路聚合: {device_name} <-> {neighbor} ({count} 条链路)")
-            
+            index = self.get_topology_index()
+
+            # 按节点顺序遍历邻接索引，每个设备对只报告一次
+            for device_name in self.topology['nodes']:
+                for neighbor, links in index.adjacency.get(device_name, {}).items():
+                    if len(links) < 2 or index.owners[index.pair_key(device_name, neighbor)] != device_name:
+                        continue
+
+                    ports = [edge.get('source_port', 'Unknown') for edge in links]
+                    aggregation = {
+                        'device1': device_name,
+                        'device2': neighbor,
+                        'link_count': len(links),
+                        'ports': ports,
+                        'remote_ports': [edge.get('target_port', 'Unknown') for edge in links],
+                        'type': 'lacp'
+                    }
+
+                    aggregations.append(aggregation)
+                    logger.info(f"检测到链路聚合: {device_name} <-> {neighbor} ({len(links)} 条链路)")
+
             self.topology['aggregations'] = aggregations
-            
+
             with self.lock:
                 self.metrics['lacp_links'] = len(aggregations)
-                
+
         except Exception as e:
             logger.error(f"链路聚合检测失败: {e}")
 
@@ -540,17 +1334,9 @@ class TopologyDiscovery:
         """检测网络环路"""
         try:
             import networkx as nx
-            
-            # 构建图
-            G = nx.Graph()
-            
-            for device_name, node in self.topology['nodes'].items():
-                G.add_node(device_name, **node)
-            
-            for edge in self.topology['edges']:
-                G.add_edge(edge['source'], edge['target'])
-            
-            # 检测环路
+
+            # 检测环路（并行链路属于链路聚合，不算环路）
+            G = self.get_topology_index().graph()
             loops = list(nx.cycle_basis(G))
             
             if loops:
@@ -579,7 +1365,7 @@ class TopologyDiscovery:
         if added_nodes:
             changes.append({
                 'type': 'node_added',
-                'nodes': list(added_nodes),
+                'nodes': sorted(added_nodes),
                 'count': len(added_nodes)
             })
             logger.info(f"新增节点: {added_nodes}")
@@ -589,16 +1375,13 @@ class TopologyDiscovery:
         if removed_nodes:
             changes.append({
                 'type': 'node_removed',
-                'nodes': list(removed_nodes),
+                'nodes': sorted(removed_nodes),
                 'count': len(removed_nodes)
             })
             logger.warning(f"删除节点: {removed_nodes}")
         
         # 比较边变化
-        current_edges = set()
-        for edge in self.topology['edges']:
-            edge_key = tuple(sorted([edge['source'], edge['target']]))
-            current_edges.add(edge_key)
+        current_edges = self.get_topology_index().pairs()
         
         previous_edges = set()
         for edge in self.previous_topology.get('edges', []):
@@ -610,7 +1393,7 @@ class TopologyDiscovery:
         if added_edges:
             changes.append({
                 'type': 'edge_added',
-                'edges': list(added_edges),
+                'edges': sorted(added_edges),
                 'count': len(added_edges)
             })
             logger.info(f"新增连接: {added_edges}")
@@ -620,7 +1403,7 @@ class TopologyDiscovery:
         if removed_edges:
             changes.append({
                 'type': 'edge_removed',
-                'edges': list(removed_edges),
+                'edges': sorted(removed_edges),
                 'count': len(removed_edges)
             })
             logger.warning(f"删除连接: {removed_edges}")
@@ -632,9 +1415,32 @@ class TopologyDiscovery:
         
         return changes
 
+    def record_device_node(self, device, protocols, discovered=True):
+        """记录设备节点（合并阶段按配置顺序写入拓扑）
+
+        熔断的设备仍保留节点（标签不丢失），但计入失败而不是成功。
+        """
+        with self.lock:
+            self.device_nodes[device['name']] = {
+                'name': device['name'],
+                'host': device['host'],
+                'type': device.get('type', 'switch'),
+                'tier': device.get('tier', 'unknown'),
+                'location': device.get('location', 'unknown'),
+                'vendor': device.get('vendor', 'unknown'),
+                'protocols_supported': protocols
+            }
+            self.metrics['devices_discovered' if discovered else 'devices_failed'] += 1
+
     def collect_device_neighbors(self, device):
         """采集单个设备的邻居信息（支持多协议）"""
+        return self.run_steps(device, self.collection_steps(device))
+
+    def collection_steps(self, device):
+        """采集步骤：单个设备的完整采集流程（增量判断、协议探测、按优先级回退或合并采集）"""
         neighbors = []
+        start = time.perf_counter()
+        self.start_device_stats(device)
         
         try:
             # 获取支持的协议列表
@@ -642,112 +1448,152 @@ class TopologyDiscovery:
             
             logger.debug(f"{device['name']} 支持协议: {protocols}")
             
-            # 按协议优先级尝试采集
-            for protocol in protocols:
-                if protocol == 'lldp':
-                    lldp_neighbors = self.get_lldp_neighbors(device)
-                    neighbors.extend(lldp_neighbors)
-                    if lldp_neighbors:
-                        break  # LLDP 成功，不再尝试其他协议
-                elif protocol == 'cdp':
-                    cdp_neighbors = self.get_cdp_neighbors(device)
-                    neighbors.extend(cdp_neighbors)
-                    if cdp_neighbors:
-                        break
-                elif protocol == 'ndp':
-                    ndp_neighbors = self.get_ndp_neighbors(device)
-                    neighbors.extend(ndp_neighbors)
-                    if ndp_neighbors:
-                        break
-                elif protocol == 'lnp':
-                    lnp_neighbors = self.get_lnp_neighbors(device)
-                    neighbors.extend(lnp_neighbors)
-                    if lnp_neighbors:
-                        break
-            
-            # 添加设备节点
-            if device['name'] not in self.topology['nodes']:
+            # 邻居表未变化则直接复用上一次的结果
+            errors_before = self.device_errors.get(device['name'], 0)
+            with self.phase('fingerprint'), self.collection_stats(device, 'fingerprint'):
+                fingerprint = yield from self.fingerprint_steps(device)
+                unchanged = yield from self.check_fingerprint_steps(device, protocols, fingerprint)
+            source = None
+            if unchanged:
+                neighbors = self.reuse_neighbors(device)
+                source = self.previous_state[device['name']].get('protocol')
+                sources = self.previous_state[device['name']].get('sources')
+                fingerprint['column_hash'] = self.previous_state[device['name']].get('column_hash')
+                capabilities = self.previous_state[device['name']].get('capabilities')
+            else:
                 with self.lock:
-                    self.topology['nodes'][device['name']] = {
-                        'name': device['name'],
-                        'host': device['host'],
-                        'type': device.get('type', 'switch'),
-                        'tier': device.get('tier', 'unknown'),
-                        'location': device.get('location', 'unknown'),
-                        'vendor': device.get('vendor', 'unknown'),
-                        'protocols_supported': protocols
-                    }
-            
-            with self.lock:
-                self.metrics['devices_discovered'] += 1
-                
+                    self.metrics['devices_polled'] += 1
+                if fingerprint:
+                    fingerprint.pop('column_hash', None)
+
+                # 按协议优先级尝试采集（跳过探测为不支持的协议）
+                capabilities = yield from self.protocol_capability_steps(device, protocols, fingerprint)
+                selected = self.protocols_to_collect(device, protocols, capabilities)
+                sources = None
+                if self.merge_protocols and len(selected) > 1:
+                    neighbors, source, sources = yield from self.merged_neighbor_steps(device, selected, fingerprint)
+                else:
+                    for protocol in selected:
+                        protocol_neighbors = yield from self.protocol_neighbor_steps(device, protocol, fingerprint)
+                        neighbors.extend(protocol_neighbors)
+                        if protocol_neighbors:
+                            source = protocol
+                            break  # 当前协议成功，不再尝试其他协议
+
+            self.record_device_state(device, protocols, source, fingerprint, neighbors, errors_before,
+                                     capabilities, sources)
+            self.record_device_node(device, protocols, not self.device_health.is_open(device['name']))
+
         except Exception as e:
             logger.error(f"{device['name']} 采集失败: {e}")
             with self.lock:
                 self.metrics['devices_failed'] += 1
 
+        self.observe_device_latency(device, time.perf_counter() - start)
         return neighbors
 
-    def discover_topology(self, max_workers=10):
-        """发现整体拓扑（并发查询，支持多协议）"""
-        logger.info("=" * 60)
-        logger.info("开始网络拓扑发现（支持 LLDP + CDP + NDP + LNP + Redfish）...")
-        logger.info(f"设备数量: {len(self.devices)}, 并发数: {max_workers}")
-        logger.info("=" * 60)
-
-        self.metrics['start_time'] = time.time()
-        all_neighbors = []
-
-        # 加载并添加 Redfish 服务器到拓扑
-        redfish_servers = self.load_redfish_servers()
-        if redfish_servers:
-            logger.info(f"添加 {len(redfish_servers)} 台 Redfish 服务器到拓扑")
-            for server in redfish_servers:
-                server_name = server['name']
-                if server_name not in self.topology['nodes']:
-                    self.topology['nodes'][server_name] = {
-                        'name': server_name,
-                        'host': server['host'],
-                        'type': server['type'],
-                        'tier': server['tier'],
-                        'location': server.get('location', 'unknown'),
-                        'vendor': server.get('vendor', 'unknown'),
-                        'model': server.get('model', 'unknown'),
-                        'serial_number': server.get('serial_number', ''),
-                        'asset_tag': server.get('asset_tag', ''),
-                        'monitoring_method': server['monitoring_method'],
-                        'protocols_supported': ['redfish']
-                    }
-                    logger.debug(f"添加 Redfish 服务器节点: {server_name}")
-                with self.lock:
-                    self.metrics['devices_discovered'] += 1
+    def collect_with_threads(self, max_workers):
+        """使用线程池并发采集，返回与 self.devices 顺序一致的邻居列表"""
+        results = [[] for _ in self.devices]
 
-        # 使用线程池并发采集
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             # 提交所有设备采集任务
-            future_to_device = {
-                executor.submit(self.collect_device_neighbors, device): device
-                for device in self.devices
+            future_to_index = {
+                executor.submit(self.collect_device_neighbors, device): index
+                for index, device in enumerate(self.devices)
             }
 
             # 收集结果
-            for future in as_completed(future_to_device):
-                device = future_to_device[future]
+            for future in as_completed(future_to_index):
+                index = future_to_index[future]
                 try:
-                    neighbors = future.result()
-                    all_neighbors.extend(neighbors)
+                    results[index] = future.result()
                 except Exception as e:
-                    logger.error(f"{device['name']} 采集异常: {e}")
+                    logger.error(f"{self.devices[index]['name']} 采集异常: {e}")
 
-        # 去重和标准化连接关系
-        seen_edges = set()
-        for neighbor in all_neighbors:
-            # 创建边（无向图，确保不重复）
-            edge_key = tuple(sorted([neighbor['local_device'], neighbor['remote_device']]))
+        # 释放 SNMP 引擎并记录会话池统计
+        self.snmp_pool.close()
+        self.metrics.update(self.snmp_pool.stats)
+
+        return results
+
+    def collect_devices(self, engine='thread', max_workers=10, max_in_flight=1000, per_device_limit=2):
+        """使用指定引擎采集 self.devices，返回与 self.devices 顺序一致的邻居列表"""
+        if engine == 'async':
+            from async_discovery import AsyncDiscoveryEngine
+            return AsyncDiscoveryEngine(self, max_in_flight=max_in_flight,
+                                        per_device_limit=per_device_limit).run()
+        return self.collect_with_threads(max_workers)
+
+    def collect_with_processes(self, processes, options):
+        """多进程分片采集：按设备名稳定哈希分成 N 片，每片一个子进程
+
+        返回与 self.devices 顺序一致的邻居列表，后续合并与单进程完全相同。
+        """
+        shards = defaultdict(list)
+        for index, device in enumerate(self.devices):
+            shards[shard_index(device['name'], processes)].append(index)
+
+        results = [[] for _ in self.devices]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            future_to_shard = {}
+            for shard, indexes in sorted(shards.items()):
+                names = {self.devices[i]['name'] for i in indexes}
+                future = executor.submit(collect_shard, [self.devices[i] for i in indexes],
+                                         self.max_repetitions, options,
+                                         {name: self.previous_state[name]
+                                          for name in names if name in self.previous_state},
+                                         self.incremental, self.device_health.dump(names),
+                                         self.device_health.failure_threshold, self.probe_interval,
+                                         self.merge_protocols)
+                future_to_shard[future] = shard
+
+            for future in as_completed(future_to_shard):
+                shard = future_to_shard[future]
+                indexes = shards[shard]
+                try:
+                    shard_results, device_nodes, metrics, device_state, health = future.result()
+                except Exception as e:
+                    logger.error(f"分片 {shard} 采集异常: {e}")
+                    with self.lock:
+                        self.metrics['devices_failed'] += len(indexes)
+                    continue
+
+                for index, neighbors in zip(indexes, shard_results):
+                    results[index] = neighbors
+                with self.lock:
+                    self.device_nodes.update(device_nodes)
+                    self.device_state.update(device_state)
+                    merge_metrics(self.metrics, metrics)
+                self.device_health.merge(health)
+                logger.debug(f"分片 {shard} 完成: {len(indexes)} 个设备")
+
+        return results
 
-            if edge_key not in seen_edges:
-                seen_edges.add(edge_key)
+    def topology_digest(self):
+        """拓扑内容摘要（不含更新时间），用于核对分片与单进程结果是否一致"""
+        content = {k: v for k, v in self.topology.items() if k != 'updated'}
+        data = json.dumps(content, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
 
+    def merge_collection_results(self, results):
+        """按设备配置顺序合并采集结果（输出与并发完成顺序无关）
+
+        拓扑中放入节点的副本：层级推断会写入 tier 和中心性，device_nodes 中只保留配置的层级，
+        常驻模式下没有重新轮询的设备在下一次发布时仍会重新推断。
+        """
+        all_neighbors = []
+        for device, neighbors in zip(self.devices, results):
+            node = self.device_nodes.get(device['name'])
+            if node and device['name'] not in self.topology['nodes']:
+                self.topology['nodes'][device['name']] = dict(node)
+            all_neighbors.extend(neighbors or [])
+
+        # 去重和标准化连接关系（同时构建拓扑索引）
+        index = self.topology_index = TopologyIndex(self.topology)
+        for neighbor in all_neighbors:
+            if index.accepts(neighbor['local_device'], neighbor['local_port'],
+                             neighbor['remote_device'], neighbor['remote_port']):
                 edge = {
                     'source': neighbor['local_device'],
                     'target': neighbor['remote_device'],
@@ -761,6 +1607,7 @@ class TopologyDiscovery:
                     edge['platform'] = neighbor['platform']
                 
                 self.topology['edges'].append(edge)
+                index.add_edge(edge)
 
                 # 添加远端设备节点（如果不存在）
                 if neighbor['remote_device'] not in self.topology['nodes']:
@@ -770,18 +1617,99 @@ class TopologyDiscovery:
                         'tier': 'unknown'
                     }
 
-        self.topology['updated'] = datetime.now().isoformat()
-        self.metrics['end_time'] = time.time()
-        self.metrics['discovery_duration_seconds'] = self.metrics['end_time'] - self.metrics['start_time']
+    def get_topology_index(self):
+        """返回当前拓扑的索引（拓扑被替换或修改过时重新构建）"""
+        index = self.topology_index
+        if index is None or index.topology is not self.topology or \
+                sum(len(links) for links in index.links.values()) != len(self.topology['edges']):
+            index = self.topology_index = TopologyIndex(self.topology)
+        return index
 
+    def analyze_topology(self):
+        """拓扑分析：链路聚合、环路、拓扑变化"""
         # 链路聚合检测
-        self.detect_lacp_aggregations()
-        
+        with self.phase('lacp'):
+            self.detect_lacp_aggregations()
+
         # 环路检测
-        self.detect_loops()
-        
+        with self.phase('loops'):
+            self.detect_loops()
+
         # 拓扑变化检测
-        self.detect_topology_changes()
+        with self.phase('changes'):
+            self.detect_topology_changes()
+
+    def add_redfish_nodes(self, redfish_servers):
+        """添加 Redfish 服务器节点到拓扑"""
+        if redfish_servers:
+            logger.info(f"添加 {len(redfish_servers)} 台 Redfish 服务器到拓扑")
+            for server in redfish_servers:
+                server_name = server['name']
+                if server_name not in self.topology['nodes']:
+                    self.topology['nodes'][server_name] = {
+                        'name': server_name,
+                        'host': server['host'],
+                        'type': server['type'],
+                        'tier': server['tier'],
+                        'location': server.get('location', 'unknown'),
+                        'vendor': server.get('vendor', 'unknown'),
+                        'model': server.get('model', 'unknown'),
+                        'serial_number': server.get('serial_number', ''),
+                        'asset_tag': server.get('asset_tag', ''),
+                        'monitoring_method': server['monitoring_method'],
+                        'protocols_supported': ['redfish']
+                    }
+                    logger.debug(f"添加 Redfish 服务器节点: {server_name}")
+                with self.lock:
+                    self.metrics['devices_discovered'] += 1
+
+    def discover_topology(self, max_workers=10, engine='thread', max_in_flight=1000, per_device_limit=2,
+                          processes=1):
+        """发现整体拓扑（并发查询，支持多协议）
+
+        engine: thread 为线程池引擎；async 为单事件循环的异步引擎
+        （max_in_flight 为全局在途请求上限，per_device_limit 为单设备在途请求上限）
+        processes > 1 时按设备名稳定哈希分片，每个分片在独立进程中采集
+        """
+        logger.info("=" * 60)
+        logger.info("开始网络拓扑发现（支持 LLDP + CDP + NDP + LNP + Redfish）...")
+        if engine == 'async':
+            logger.info(f"设备数量: {len(self.devices)}, 异步引擎, 在途请求上限: {max_in_flight}, "
+                        f"单设备上限: {per_device_limit}")
+        else:
+            logger.info(f"设备数量: {len(self.devices)}, 并发数: {max_workers}")
+        if processes > 1:
+            logger.info(f"分片进程数: {processes}")
+        logger.info("=" * 60)
+
+        self.metrics['start_time'] = time.time()
+        self.device_nodes = {}
+
+        # 加载并添加 Redfish 服务器到拓扑
+        with self.phase('redfish_load'):
+            self.add_redfish_nodes(self.load_redfish_servers())
+
+        options = {
+            'engine': engine,
+            'max_workers': max_workers,
+            'max_in_flight': max_in_flight,
+            'per_device_limit': per_device_limit
+        }
+        with self.phase('collect'):
+            if processes > 1 and len(self.devices) > 1:
+                results = self.collect_with_processes(processes, options)
+            else:
+                results = self.collect_devices(**options)
+
+        with self.phase('dedup'):
+            self.merge_collection_results(results)
+        self.metrics['topology_digest'] = self.topology_digest()
+
+        self.topology['updated'] = datetime.now().isoformat()
+        self.metrics['end_time'] = time.time()
+        self.metrics['discovery_duration_seconds'] = self.metrics['end_time'] - self.metrics['start_time']
+
+        self.analyze_topology()
 
         logger.info("=" * 60)
         logger.info(f"拓扑发现完成！")
@@ -793,77 +1721,70 @@ class TopologyDiscovery:
         logger.info(f"  采集耗时: {self.metrics['discovery_duration_seconds']:.2f} 秒")
         logger.info(f"  成功设备: {self.metrics['devices_discovered']}")
         logger.info(f"  失败设备: {self.metrics['devices_failed']}")
+        logger.info(f"  增量跳过/完整采集: {self.metrics['devices_skipped']}/{self.metrics['devices_polled']}")
         logger.info(f"  LLDP 邻居: {self.metrics['lldp_neighbors']}")
         logger.info(f"  CDP 邻居: {self.metrics['cdp_neighbors']}")
         logger.info(f"  NDP 邻居: {self.metrics['ndp_neighbors']}")
         logger.info(f"  LNP 邻居: {self.metrics['lnp_neighbors']}")
-        logger.info(f"  SNMP 错误: {self.metrics['snmp_errors']}")
+        logger.info(f"  SNMP 错误: {self.metrics['snmp_errors']} {self.metrics['snmp_errors_by_reason']}")
+        open_devices = self.device_health.open_devices()
+        if open_devices:
+            logger.warning(f"  熔断设备: {len(open_devices)} 个 {open_devices[:10]}")
+        logger.info(f"  SNMP 引擎/socket: {self.metrics['snmp_engines_created']}/{self.metrics['snmp_sockets_created']}, "
+                    f"请求数: {self.metrics['snmp_requests_sent']}")
         logger.info("=" * 60)
 
         return self.topology
 
+    def has_configured_tier(self, device_name, node):
+        """设备是否手动配置了层级（以 device_nodes 中的配置为准，不受上一次推断结果影响）"""
+        source = self.device_nodes.get(device_name, node)
+        return source.get('tier') not in ('unknown', None)
+
     def calculate_tiers(self):
         """计算网络层级（核心、汇聚、接入）- 基于图算法"""
+        index = self.get_topology_index()
         try:
             import networkx as nx
-            
-            # 构建图
-            G = nx.Graph()
-            
-            # 添加节点
-            for device_name, node in self.topology['nodes'].items():
-                G.add_node(device_name, **node)
-            
-            # 添加边
-            for edge in self.topology['edges']:
-                G.add_edge(edge['source'], edge['target'])
-            
-            # 计算中心性指标
-            degree_centrality = nx.degree_centrality(G)
-            betweenness_centrality = nx.betweenness_centrality(G)
-            closeness_centrality = nx.closeness_centrality(G)
-            
+
+            # 共用拓扑索引中的图（并行链路折叠为一条边）
+            G = index.graph()
+
+            # 计算中心性指标（图未变化时复用上一次的结果）
+            start = time.time()
+            degree_centrality, betweenness_centrality, closeness_centrality = self.get_centrality(G)
+            with self.lock:
+                self.metrics['tier_calculation_seconds'] = round(time.time() - start, 3)
+
             # 基于中心性计算层级
             for device_name, node in self.topology['nodes'].items():
                 # 如果手动配置了 tier，优先使用
-                if node.get('tier') not in ['unknown', None]:
+                if self.has_configured_tier(device_name, node):
                     continue
-                
+
                 # 综合中心性指标
                 degree = degree_centrality.get(device_name, 0)
                 betweenness = betweenness_centrality.get(device_name, 0)
                 closeness = closeness_centrality.get(device_name, 0)
-                
-                # 计算综合得分
-                score = (degree * 0.3 + betweenness * 0.5 + closeness * 0.2)
-                
-                # 根据得分判断层级
-                if score >= 0.3:
-                    node['tier'] = 'core'
-                elif score >= 0.1:
-                    node['tier'] = 'aggregation'
-                else:
-                    node['tier'] = 'access'
-                
+
+                # 计算综合得分并判断层级
+                score = centrality_score(degree, betweenness, closeness)
+                node['tier'] = score_tier(score)
+
                 # 保存中心性指标（用于可视化）
                 node['centrality_score'] = round(score, 4)
                 node['degree_centrality'] = round(degree, 4)
                 node['betweenness_centrality'] = round(betweenness, 4)
-                
+
+            index.invalidate_labels()
             logger.info("层级计算完成（基于图算法）")
             
         except ImportError:
             logger.warning("NetworkX 未安装，使用简单层级推断")
-            # 降级到简单算法
-            connections = defaultdict(int)
-            
-            for edge in self.topology['edges']:
-                connections[edge['source']] += 1
-                connections[edge['target']] += 1
-            
+            # 降级到简单算法（按不同邻居设备数）
             for device_name, node in self.topology['nodes'].items():
-                if node.get('tier') == 'unknown':
-                    conn_count = connections[device_name]
+                if not self.has_configured_tier(device_name, node):
+                    conn_count = index.neighbor_count(device_name)
                     
                     if conn_count >= 10:
                         node['tier'] = 'core'
@@ -871,15 +1792,57 @@ class TopologyDiscovery:
                         node['tier'] = 'aggregation'
                     else:
                         node['tier'] = 'access'
+            index.invalidate_labels()
+
+    def resolve_tier_mode(self, node_count):
+        """auto 模式：小图精确计算，大图使用近似中心性"""
+        if self.tier_mode == 'auto':
+            return 'fast' if node_count > FAST_TIER_NODE_THRESHOLD else 'exact'
+        return self.tier_mode
+
+    def get_centrality(self, G):
+        """计算（或复用）度中心性、介数中心性、接近中心性"""
+        mode = self.resolve_tier_mode(G.number_of_nodes())
+        signature = graph_signature(G)
+        cache = self.centrality_cache
+        if cache.get('signature') == signature and cache.get('mode') == mode and \
+                (mode == 'exact' or cache.get('sample_size') == self.tier_sample_size):
+            logger.info("拓扑图未变化，复用上一次的中心性结果")
+            with self.lock:
+                self.metrics['tier_centrality_reused'] = 1
+            values = cache['centrality']
+            return tuple({name: value[i] for name, value in values.items()} for i in range(3))
+
+        if mode == 'fast':
+            centrality = fast_centrality(G, self.tier_sample_size)
+        else:
+            centrality = exact_centrality(G)
+
+        degree, betweenness, closeness = centrality
+        self.centrality_cache = {
+            'signature': signature,
+            'mode': mode,
+            'sample_size': self.tier_sample_size,
+            'centrality': {name: [degree.get(name, 0), betweenness.get(name, 0), closeness.get(name, 0)]
+                           for name in G}
+        }
+        with self.lock:
+            self.metrics['tier_centrality_reused'] = 0
+        logger.debug(f"中心性计算模式: {mode}（{G.number_of_nodes()} 个节点）")
+        return centrality
 
     def save_topology(self, output_file='/data/topology/topology.json'):
         """保存拓扑数据"""
         try:
-            with open(output_file, 'w') as f:
-                json.dump(self.topology, f, indent=2, ensure_ascii=False)
-            logger.info(f"拓扑数据已保存到: {output_file}")
+            written, size = write_topology(self.topology, output_file, self.snapshot_format)
+            if written:
+                logger.info(f"拓扑数据已保存到: {output_file}（{self.snapshot_format} 格式，{size} 字节）")
+            else:
+                logger.info(f"拓扑数据未变化，跳过写入: {output_file}")
+            return written
         except Exception as e:
             logger.error(f"保存拓扑数据失败: {e}")
+            return False
 
     def generate_prometheus_labels(self, output_dir='/etc/prometheus/targets'):
         """生成 Prometheus 标签文件（按设备类型分类的文件服务发现格式）"""
@@ -887,41 +1850,14 @@ class TopologyDiscovery:
         switches = []   # 交换机/路由器 → SNMP
         servers = []    # 服务器 → node_exporter
 
+        index = self.get_topology_index()
         for device_name, node in self.topology['nodes'].items():
-            # 找到该设备连接的交换机
-            connected_switches = []
-            connected_ports = []
-
-            for edge in self.topology['edges']:
-                if edge['source'] == device_name:
-                    connected_switches.append(edge['target'])
-                    connected_ports.append(edge['source_port'])
-                elif edge['target'] == device_name:
-                    connected_switches.append(edge['source'])
-                    connected_ports.append(edge['target_port'])
-
-            # 生成标签（统一的标签集）
-            labels = {
-                'device_name': device_name,
-                'device_type': node.get('type', 'unknown'),
-                'device_tier': node.get('tier', 'unknown'),
-                'device_location': node.get('location', 'unknown'),
-                'device_vendor': node.get('vendor', 'unknown'),
-                'topology_discovered': 'true'
-            }
-
-            # 添加连接信息（统一命名）
-            if connected_switches:
-                labels['connected_switch'] = connected_switches[0]
-                labels['connected_switches'] = ','.join(connected_switches)
-
-            if connected_ports:
-                labels['connected_switch_port'] = connected_ports[0]
-
             # 根据设备类型生成不同格式的 targets
             if 'host' not in node:
                 continue
 
+            labels = index.labels(device_name)
+
             device_type = node.get('type', 'unknown')
 
             # 交换机/路由器 → SNMP Exporter（裸 IP）
@@ -940,63 +1876,43 @@ class TopologyDiscovery:
                 }
                 servers.append(target_entry)
 
-        # 保存交换机配置（用于 SNMP）
+        # 保存交换机配置（用于 SNMP）；内容未变化时不改写文件，避免 vmagent 重载和 target 抖动
+        changed = []
         switches_file = f"{output_dir}/topology-switches.json"
         try:
-            with open(switches_file, 'w') as f:
-                json.dump(switches, f, indent=2, ensure_ascii=False)
-            logger.info(f"交换机拓扑标签已生成: {switches_file}")
-            logger.info(f"  包含 {len(switches)} 个交换机")
+            if write_json_atomic(switches_file, switches):
+                changed.append(switches_file)
+                logger.info(f"交换机拓扑标签已生成: {switches_file}")
+                logger.info(f"  包含 {len(switches)} 个交换机")
+            else:
+                logger.info(f"交换机拓扑标签未变化: {switches_file}")
         except Exception as e:
             logger.error(f"生成交换机标签文件失败: {e}")
 
         # 保存服务器配置（用于 Node Exporter）
         servers_file = f"{output_dir}/topology-servers.json"
         try:
-            with open(servers_file, 'w') as f:
-                json.dump(servers, f, indent=2, ensure_ascii=False)
-            logger.info(f"服务器拓扑标签已生成: {servers_file}")
-            logger.info(f"  包含 {len(servers)} 个服务器")
+            if write_json_atomic(servers_file, servers):
+                changed.append(servers_file)
+                logger.info(f"服务器拓扑标签已生成: {servers_file}")
+                logger.info(f"  包含 {len(servers)} 个服务器")
+            else:
+                logger.info(f"服务器拓扑标签未变化: {servers_file}")
         except Exception as e:
             logger.error(f"生成服务器标签文件失败: {e}")
+        return changed
 
     def generate_telegraf_labels(self, output_file='/data/topology/telegraf-labels.json'):
         """生成 Telegraf 标签映射文件（hostname → labels）"""
         # Telegraf 使用主机名作为 key
         label_map = {}
 
+        index = self.get_topology_index()
         for device_name, node in self.topology['nodes'].items():
-            # 找到该设备连接的交换机
-            connected_switches = []
-            connected_ports = []
-
-            for edge in self.topology['edges']:
-                if edge['source'] == device_name:
-                    connected_switches.append(edge['target'])
-                    connected_ports.append(edge['source_port'])
-                elif edge['target'] == device_name:
-                    connected_switches.append(edge['source'])
-                    connected_ports.append(edge['target_port'])
-
-            # 生成标签（与其他方式一致）
-            labels = {
-                'device_name': device_name,
-                'device_type': node.get('type', 'unknown'),
-                'device_tier': node.get('tier', 'unknown'),
-                'device_location': node.get('location', 'unknown'),
-                'device_vendor': node.get('vendor', 'unknown'),
-                'topology_discovered': 'true'
-            }
-
-            if connected_switches:
-                labels['connected_switch'] = connected_switches[0]
-                labels['connected_switches'] = ','.join(connected_switches)
-
-            if connected_ports:
-                labels['connected_switch_port'] = connected_ports[0]
-
             # 使用设备名和 host 作为 key（支持多种匹配）
             if 'host' in node:
+                # 与 file_sd 共用同一份缓存标签
+                labels = index.labels(device_name)
                 # 使用 IP 地址作为 key
                 label_map[node['host']] = labels
                 # 也使用设备名作为 key（支持 hostname 匹配）
@@ -1006,12 +1922,16 @@ class TopologyDiscovery:
 
         # 保存标签映射
         try:
-            with open(output_file, 'w') as f:
-                json.dump(label_map, f, indent=2, ensure_ascii=False)
-            logger.info(f"Telegraf 标签映射已生成: {output_file}")
-            logger.info(f"  包含 {len(label_map)} 个映射条目")
+            written = write_json_atomic(output_file, label_map)
+            if written:
+                logger.info(f"Telegraf 标签映射已生成: {output_file}")
+                logger.info(f"  包含 {len(label_map)} 个映射条目")
+            else:
+                logger.info(f"Telegraf 标签映射未变化: {output_file}")
+            return written
         except Exception as e:
             logger.error(f"生成 Telegraf 标签映射失败: {e}")
+            return False
 
     def generate_grafana_graph(self, output_file='/data/topology/graph.json'):
         """生成 Grafana Node Graph 数据"""
@@ -1047,11 +1967,43 @@ class TopologyDiscovery:
             graph_data['edges'].append(graph_edge)
 
         try:
-            with open(output_file, 'w') as f:
-                json.dump(graph_data, f, indent=2, ensure_ascii=False)
-            logger.info(f"Grafana 图数据已生成: {output_file}")
+            written = write_json_atomic(output_file, graph_data)
+            logger.info(f"Grafana 图数据已生成: {output_file}" if written else f"Grafana 图数据未变化: {output_file}")
+            return written
         except Exception as e:
             logger.error(f"生成 Grafana 图数据失败: {e}")
+            return False
+
+    def write_outputs(self, data_dir='/data/topology', targets_dir='/etc/prometheus/targets'):
+        """写出所有输出文件（原子替换，内容未变化的文件跳过），返回内容有变化的 file_sd 文件列表
+
+        自身指标最后写出，使其包含本轮各输出文件的写出耗时
+        """
+        # 保存拓扑数据
+        with self.phase('write_topology'):
+            self.save_topology(f'{data_dir}/topology.json')
+
+        # 保存设备状态（增量发现）与中心性缓存
+        with self.phase('write_device_state'):
+            self.save_device_state(f'{data_dir}/discovery-state.json')
+        with self.phase('write_centrality_cache'):
+            self.save_centrality_cache(f'{data_dir}/centrality-cache.json')
+
+        # 生成 Prometheus 标签（按设备类型分类）
+        with self.phase('write_file_sd'):
+            file_sd_changed = self.generate_prometheus_labels(targets_dir)
+
+        # 生成 Telegraf 标签映射
+        with self.phase('write_telegraf_labels'):
+            self.generate_telegraf_labels(f'{data_dir}/telegraf-labels.json')
+
+        # 生成 Grafana 图数据
+        with self.phase('write_grafana_graph'):
+            self.generate_grafana_graph(f'{data_dir}/graph.json')
+
+        # 保存自身指标
+        self.save_metrics(f'{data_dir}/metrics.json')
+        return file_sd_changed
 
     def get_health_status(self):
         """获取健康状态"""
@@ -1067,38 +2019,524 @@ class TopologyDiscovery:
         }
 
     def save_metrics(self, output_file='/data/topology/metrics.json'):
-        """保存自身指标"""
+        """保存自身指标（在锁内取快照，采集线程可以继续更新）"""
+        with self.lock:
+            metrics = copy.deepcopy(self.metrics)
+            if self.reset_metrics_on_save:
+                self.reset_cycle_metrics()
         try:
-            with open(output_file, 'w') as f:
-                json.dump(self.metrics, f, indent=2, ensure_ascii=False)
-            logger.info(f"自身指标已保存: {output_file}")
+            written = write_json_atomic(output_file, metrics)
+            logger.info(f"自身指标已保存: {output_file}" if written else f"自身指标未变化: {output_file}")
+            return written
         except Exception as e:
             logger.error(f"保存自身指标失败: {e}")
+            return False
+
+def centrality_score(degree, betweenness, closeness):
+    """综合中心性得分"""
+    return degree * 0.3 + betweenness * 0.5 + closeness * 0.2
+
+def score_tier(score):
+    """根据综合得分判断层级"""
+    if score >= 0.3:
+        return 'core'
+    if score >= 0.1:
+        return 'aggregation'
+    return 'access'
+
+def graph_signature(G):
+    """图结构摘要（节点 + 边），用于判断中心性能否复用"""
+    digest = hashlib.sha1()
+    for name in sorted(G):
+        digest.update(f"{name}\n".encode('utf-8'))
+    for edge in sorted(tuple(sorted(edge)) for edge in G.edges()):
+        digest.update(f"{edge[0]}\0{edge[1]}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def exact_centrality(G):
+    """精确中心性（介数 O(V·E)，接近中心性需要从每个节点 BFS）"""
+    import networkx as nx
+    return (nx.degree_centrality(G),
+            nx.betweenness_centrality(G),
+            nx.closeness_centrality(G))
+
+def closeness_from_total(total, reachable, n):
+    """与 networkx closeness_centrality（wf_improved=True）一致的归一化"""
+    if total <= 0 or n <= 1:
+        return 0.0
+    return (reachable - 1) / total * (reachable - 1) / (n - 1)
+
+def fast_centrality(G, sample_size=DEFAULT_TIER_SAMPLE_SIZE, seed=0):
+    """近似中心性（大规模拓扑）
+
+    1. 度中心性：精确计算（O(V)）
+    2. 度数预筛选：叶子节点（度数 ≤ 1，如服务器）的介数恒为 0，接近中心性由唯一邻居
+       的距离和推导（sum(v) = sum(u) + r - 2），不参与 BFS
+    3. 介数中心性：k 个采样 pivot 的 Brandes 近似（固定随机种子，结果可复现）
+    4. 接近中心性：非叶子节点不超过 sample_size 时逐个 BFS 精确计算，
+       否则用 k 个 pivot 的平均距离估计距离和
+    """
+    import random
+    import networkx as nx
+
+    n = G.number_of_nodes()
+    degree = nx.degree_centrality(G)
+    if n == 0:
+        return degree, {}, {}
+
+    if n <= sample_size:
+        betweenness = nx.betweenness_centrality(G)
+    else:
+        betweenness = nx.betweenness_centrality(G, k=sample_size, seed=seed)
+
+    leaves = {name for name, d in G.degree() if d <= 1}
+    candidates = [name for name in G if name not in leaves]
+    for name in leaves:
+        betweenness[name] = 0.0
+
+    component_size = {}
+    for component in nx.connected_components(G):
+        for name in component:
+            component_size[name] = len(component)
+
+    # 非叶子节点的距离和
+    totals = {}
+    if len(candidates) <= sample_size:
+        for name in candidates:
+            totals[name] = sum(nx.single_source_shortest_path_length(G, name).values())
+    else:
+        pivots = random.Random(seed).sample(sorted(G), sample_size)
+        distance_sum = defaultdict(int)
+        pivot_count = defaultdict(int)
+        for pivot in pivots:
+            for name, distance in nx.single_source_shortest_path_length(G, pivot).items():
+                if name != pivot:
+                    distance_sum[name] += distance
+                    pivot_count[name] += 1
+        for name in candidates:
+            if pivot_count[name]:
+                totals[name] = distance_sum[name] / pivot_count[name] * (component_size[name] - 1)
+            else:
+                # 所在连通分量没有采样到 pivot（通常是很小的分量），直接精确计算
+                totals[name] = sum(nx.single_source_shortest_path_length(G, name).values())
+
+    closeness = {name: closeness_from_total(totals[name], component_size[name], n) for name in candidates}
+    for name in leaves:
+        neighbors = list(G[name])
+        if not neighbors:
+            closeness[name] = 0.0
+        elif neighbors[0] in totals:
+            reachable = component_size[name]
+            closeness[name] = closeness_from_total(totals[neighbors[0]] + reachable - 2, reachable, n)
+        else:
+            # 两个叶子互连的孤立分量
+            closeness[name] = closeness_from_total(1, 2, n)
+
+    return degree, betweenness, closeness
+
+def column_hash(protocol, columns):
+    """邻居表指纹列（远端名称 + 远端端口，含行索引）的哈希"""
+    digest = hashlib.sha1()
+    for name in FINGERPRINT_COLUMNS[protocol]:
+        for index, value in sorted(columns.get(name, {}).items()):
+            digest.update(f"{name}\0{index}\0{value}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def merge_protocol_columns(protocol_columns):
+    """{协议: {列名: OID}} -> {协议/列名: OID}，多个协议的列放进同一个 GETBULK 请求"""
+    return {f'{protocol}/{name}': oid
+            for protocol, columns in protocol_columns.items() for name, oid in columns.items()}
+
+def split_protocol_columns(results):
+    """merge_protocol_columns 的逆操作：{协议/列名: 值} -> {协议: {列名: 值}}"""
+    columns = defaultdict(dict)
+    for key, values in results.items():
+        protocol, name = key.split('/', 1)
+        columns[protocol][name] = values
+    return columns
+
+def fingerprint_columns(protocols):
+    """各协议指纹列 -> {协议: {列名: OID}}"""
+    return {protocol: {name: NEIGHBOR_COLUMNS[protocol][name] for name in FINGERPRINT_COLUMNS[protocol]}
+            for protocol in protocols}
+
+def protocols_column_hash(protocols, columns):
+    """多个协议指纹列的合并哈希（只有一个协议时与 column_hash 相同）"""
+    hashes = [column_hash(protocol, columns[protocol]) for protocol in protocols]
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha1('\n'.join(hashes).encode('utf-8')).hexdigest()
+
+def previous_sources(previous):
+    """上一次邻居的来源协议（多协议合并采集时可能有多个）"""
+    if previous.get('sources'):
+        return previous['sources']
+    return [previous['protocol']] if previous.get('protocol') else []
+
+def fingerprint_hash_protocols(previous, protocols):
+    """上一次的邻居来自没有“最后变化时间”的协议时，返回需要做列哈希的协议"""
+    return [protocol for protocol in previous_sources(previous) if protocol != 'lldp']
+
+def merged_collection_columns(protocols):
+    """多协议合并采集的 GETBULK 列：各协议邻居表 + 统一本地端口用的接口表和 lldpLocPortId"""
+    protocol_columns = {protocol: dict(NEIGHBOR_COLUMNS[protocol]) for protocol in protocols}
+    if 'lldp' in protocol_columns:
+        protocol_columns['lldp']['loc_port_id'] = LLDP_LOC_PORT_ID
+    # CDP 已经遍历 ifDescr，不重复放进同一个请求
+    protocol_columns['if'] = {name: oid for name, oid in INTERFACE_COLUMNS.items()
+                              if not (name == 'if_descr' and 'cdp' in protocol_columns)}
+    return merge_protocol_columns(protocol_columns)
+
+def port_key_resolver(columns):
+    """返回多协议合并用的本地端口标识函数：能解析出 ifIndex 时用 ifIndex，否则用端口名
+
+    - CDP：索引本身就是 ifIndex
+    - LLDP：lldpLocPortId 与 ifName/ifDescr 匹配时取对应 ifIndex，否则按 lldpLocPortNum 即 ifIndex 处理（多数实现如此）
+    - NDP/LNP：端口名与 ifName/ifDescr 匹配时取对应 ifIndex
+    """
+    interface_columns = columns.get('if', {})
+    if_descr = interface_columns.get('if_descr') or columns.get('cdp', {}).get('if_descr', {})
+    interfaces = {}
+    for names in (if_descr, interface_columns.get('if_name', {})):  # ifName 优先（后写覆盖）
+        for if_index, name in names.items():
+            if name:
+                interfaces[name] = if_index
+    if_indexes = set(if_descr) | set(interface_columns.get('if_name', {}))
+    lldp_port_ids = columns.get('lldp', {}).get('loc_port_id', {})
+
+    def port_key(neighbor):
+        if neighbor.get('local_if_index'):
+            return f"ifIndex:{neighbor['local_if_index']}"
+        port_num = neighbor.get('local_port_num')
+        if port_num is not None:
+            port_id = lldp_port_ids.get(port_num)
+            if port_id in interfaces:
+                return f"ifIndex:{interfaces[port_id]}"
+            if port_num in if_indexes:
+                return f"ifIndex:{port_num}"
+        port = neighbor.get('local_port')
+        if port in interfaces:
+            return f"ifIndex:{interfaces[port]}"
+        if port and port != 'Unknown':
+            return f"name:{port}"
+        return None
+
+    return port_key
+
+def local_port_name(neighbor):
+    """邻居的本地端口名（未知时返回 None）"""
+    port = neighbor.get('local_port')
+    return port if port != 'Unknown' else None
+
+def merge_neighbors(protocols, protocol_neighbors, port_key=None):
+    """按协议优先级合并多个协议的邻居
+
+    同一本地端口以优先级最高的协议为准，低优先级协议只补充其余端口上的邻居（例如只跑 CDP 的话机、AP）；
+    port_key 把邻居映射为本地端口标识（默认为端口名），标识未知的邻居不参与合并。
+    返回 (邻居, 重叠端口数, 重叠且远端设备不一致的端口数)。
+    """
+    port_key = port_key or local_port_name
+    merged = []
+    owners = {}  # 本地端口 -> 该端口上已采用的远端设备
+    overlaps = conflicts = 0
+    for protocol in protocols:
+        ports = {}
+        for neighbor in protocol_neighbors.get(protocol, []):
+            port = port_key(neighbor)
+            if port:
+                ports.setdefault(port, set()).add(neighbor['remote_device'])
+                if port in owners:
+                    continue
+            merged.append(neighbor)
+        for port, remotes in ports.items():
+            if port in owners:
+                overlaps += 1
+                conflicts += remotes != owners[port]
+            else:
+                owners[port] = remotes
+    return merged, overlaps, conflicts
+
+def fingerprint_unchanged(previous, protocols, fingerprint):
+    """比较本次与上一次的设备指纹
+
+    - 协议列表变化、sysUpTime 回退（重启）或取不到时视为已变化
+    - 邻居来自 LLDP（或只支持 LLDP）时比较 lldpStatsRemTablesLastChangeTime
+    - 邻居来自 CDP/NDP/LNP 时比较指纹列哈希（多协议合并采集时两者都要一致）
+    """
+    if previous.get('protocols') != protocols:
+        return False
+
+    uptime = fingerprint.get('sys_uptime')
+    previous_uptime = previous.get('sys_uptime')
+    if uptime is None or previous_uptime is None or uptime < previous_uptime:
+        return False
+
+    sources = previous_sources(previous)
+    if not sources and protocols == ['lldp']:
+        sources = ['lldp']
+    if not sources:
+        return False
+
+    if 'lldp' in sources:
+        last_change = fingerprint.get('lldp_last_change')
+        if last_change is None or last_change != previous.get('lldp_last_change'):
+            return False
+
+    if any(protocol != 'lldp' for protocol in sources):
+        return fingerprint.get('column_hash') is not None and \
+            fingerprint.get('column_hash') == previous.get('column_hash')
+
+    return True
+
+def probe_candidates(protocols):
+    """需要探测的协议（有邻居表定义且有 MIB 根 OID 的协议）"""
+    return [protocol for protocol in protocols if protocol in NEIGHBOR_COLUMNS and protocol in PROTOCOL_MIB_ROOTS]
+
+def probe_results(protocols, varbinds):
+    """GETNEXT 探测结果：返回的 OID 仍在协议 MIB 子树内即支持 -> {协议: 是否支持}"""
+    results = {}
+    for protocol, (oid, value) in zip(protocols, varbinds):
+        root = tuple(int(x) for x in PROTOCOL_MIB_ROOTS[protocol].split('.'))
+        results[protocol] = (not isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance))
+                             and tuple(oid)[:len(root)] == root)
+    return results
+
+def capabilities_valid(capabilities, protocols, fingerprint, probe_interval, now=None):
+    """协议能力缓存是否仍然有效
+
+    - 候选协议变化（例如修改了 vendor/protocol 配置）或超过有效期时失效
+    - sysUpTime 回退（设备重启，配置或固件可能已变化）时失效；取不到 sysUpTime 时按有效期判断
+    """
+    if not capabilities or probe_interval <= 0:
+        return False
+    if sorted(capabilities.get('protocols', {})) != sorted(protocols):
+        return False
+    now = time.time() if now is None else now
+    if now - capabilities.get('probed_at', 0) > probe_interval:
+        return False
+    uptime = fingerprint.get('sys_uptime') if fingerprint else None
+    previous_uptime = capabilities.get('sys_uptime')
+    if uptime is not None and previous_uptime is not None and uptime < previous_uptime:
+        return False
+    return True
+
+# 分片子进程只返回采集计数类指标，时间类字段由主进程维护
+SHARD_METRICS_EXCLUDE = {'start_time', 'end_time', 'discovery_duration_seconds', 'topology_digest'}
+
+def shard_index(device_name, shards):
+    """按设备名稳定哈希分片（不受 PYTHONHASHSEED 影响）"""
+    digest = hashlib.md5(device_name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+def new_histogram(bounds=DEVICE_LATENCY_BUCKETS):
+    """空直方图：各桶（不累积）计数 + 总和 + 总数
+
+    桶上界用字符串作 key，分片子进程的直方图可以直接由 merge_metrics 逐项累加
+    """
+    buckets = {str(bound): 0 for bound in bounds}
+    buckets['+Inf'] = 0
+    return {'buckets': buckets, 'sum': 0.0, 'count': 0}
+
+def observe_histogram(histogram, value, bounds=DEVICE_LATENCY_BUCKETS):
+    index = bisect_left(bounds, value)
+    key = str(bounds[index]) if index < len(bounds) else '+Inf'
+    histogram['buckets'][key] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+def merge_metrics(target, source):
+    """把分片子进程的指标累加到主进程指标中"""
+    for key, value in source.items():
+        if key in SHARD_METRICS_EXCLUDE:
+            continue
+        if isinstance(value, dict):
+            merge_metrics(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            target[key] = target.get(key, 0) + value
+        else:
+            target[key] = value
+
+def collect_shard(devices, max_repetitions, options, previous_state, incremental, health, circuit_threshold,
+                  probe_interval=DEFAULT_PROBE_INTERVAL, merge_protocols=False):
+    """分片子进程入口：采集一个分片内的设备"""
+    discovery = TopologyDiscovery(max_repetitions=max_repetitions, load_state=False,
+                                  incremental=incremental, circuit_threshold=circuit_threshold,
+                                  probe_interval=probe_interval, merge_protocols=merge_protocols)
+    discovery.devices = devices
+    discovery.previous_state = previous_state
+    discovery.device_health.merge(health)
+    results = discovery.collect_devices(**options)
+    return results, discovery.device_nodes, discovery.metrics, discovery.device_state, \
+        discovery.device_health.dump()
+
+class DiscoveryProfiler:
+    """可选的性能剖析，结果写在 metrics.json 旁边
+
+    cpu：cProfile 原始数据（discovery-profile.pstats，可用 snakeviz 等工具查看）
+         + 按累计耗时排序的前 N 个函数（discovery-profile.txt）
+    memory：tracemalloc 按代码行统计的前 N 个内存分配点和峰值（discovery-tracemalloc.txt）
+
+    cProfile 只记录调用它的线程（Python 3.12 起记录所有线程）：线程池引擎的采集线程
+    在较早的版本中不会出现在结果里，剖析采集阶段时建议使用 --engine async。
+    多进程分片时子进程会继承剖析状态而明显变慢，其结果也不会写出。
+    """
+
+    def __init__(self, modes, output_dir='/data/topology', top=DEFAULT_PROFILE_TOP):
+        self.modes = set(modes)
+        self.output_dir = output_dir
+        self.top = top
+        self.profile = None
+
+    def start(self):
+        if 'memory' in self.modes:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cpu' in self.modes:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        logger.info(f"性能剖析已开启: {', '.join(sorted(self.modes))}")
+
+    def stop(self):
+        """停止剖析并写出结果，返回写出的文件列表"""
+        written = []
+        if self.profile is not None:
+            import io
+            import pstats
+            self.profile.disable()
+            path = os.path.join(self.output_dir, 'discovery-profile.pstats')
+            self.profile.dump_stats(path)
+            written.append(path)
+
+            summary = io.StringIO()
+            pstats.Stats(self.profile, stream=summary).sort_stats('cumulative').print_stats(self.top)
+            path = os.path.join(self.output_dir, 'discovery-profile.txt')
+            write_file_atomic(path, summary.getvalue().encode('utf-8'))
+            written.append(path)
+            self.profile = None
+
+        if 'memory' in self.modes:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                lines = [f"当前 {current} 字节，峰值 {peak} 字节", ""]
+                lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:self.top])
+                path = os.path.join(self.output_dir, 'discovery-tracemalloc.txt')
+                write_file_atomic(path, ('\n'.join(lines) + '\n').encode('utf-8'))
+                written.append(path)
+
+        for path in written:
+            logger.info(f"性能剖析结果已保存: {path}")
+        return written
+
+def parse_profile_modes(value):
+    """解析 --profile（逗号分隔，all 表示全部）"""
+    modes = {mode.strip().lower() for mode in value.split(',') if mode.strip()}
+    if 'all' in modes:
+        return set(PROFILE_MODES)
+    unknown = modes - set(PROFILE_MODES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"未知的剖析类型: {', '.join(sorted(unknown))}")
+    return modes
+
+def parse_args():
+    """命令行参数（默认值可通过环境变量设置）"""
+    parser = argparse.ArgumentParser(description='网络拓扑自动发现')
+    parser.add_argument('--engine', choices=['thread', 'async'],
+                        default=os.environ.get('DISCOVERY_ENGINE', 'thread'),
+                        help='采集引擎：thread 线程池 / async 异步事件循环')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('DISCOVERY_WORKERS', 10)),
+                        help='线程池并发数（thread 引擎）')
+    parser.add_argument('--max-in-flight', type=int,
+                        default=int(os.environ.get('DISCOVERY_MAX_IN_FLIGHT', 1000)),
+                        help='全局在途 SNMP 请求上限（async 引擎）')
+    parser.add_argument('--per-device-limit', type=int,
+                        default=int(os.environ.get('DISCOVERY_PER_DEVICE_LIMIT', 2)),
+                        help='单设备在途 SNMP 请求上限（async 引擎）')
+    parser.add_argument('--processes', type=int,
+                        default=int(os.environ.get('DISCOVERY_PROCESSES', 1)),
+                        help='分片采集的子进程数（1 表示单进程）')
+    parser.add_argument('--full', action='store_true',
+                        default=os.environ.get('DISCOVERY_INCREMENTAL', 'true').lower() == 'false',
+                        help='强制完整采集所有设备（关闭增量发现）')
+    parser.add_argument('--tier-mode', choices=['auto', 'exact', 'fast'],
+                        default=os.environ.get('DISCOVERY_TIER_MODE', DEFAULT_TIER_MODE),
+                        help=f'层级推断：exact 精确中心性 / fast 采样近似 / auto 超过 {FAST_TIER_NODE_THRESHOLD} 个节点时用 fast')
+    parser.add_argument('--tier-sample-size', type=int,
+                        default=int(os.environ.get('DISCOVERY_TIER_SAMPLE_SIZE', DEFAULT_TIER_SAMPLE_SIZE)),
+                        help='fast 模式介数/接近中心性的采样 pivot 数')
+    parser.add_argument('--circuit-threshold', type=int,
+                        default=int(os.environ.get('DISCOVERY_CIRCUIT_THRESHOLD', DEFAULT_CIRCUIT_THRESHOLD)),
+                        help='设备连续失败多少次后熔断（本次运行跳过，下次运行先探测）')
+    parser.add_argument('--probe-interval', type=int,
+                        default=int(os.environ.get('DISCOVERY_PROBE_INTERVAL', DEFAULT_PROBE_INTERVAL)),
+                        help='协议能力缓存有效期（秒）：期间跳过探测为不支持的协议，设备重启时立即重新探测；0 表示不探测')
+    parser.add_argument('--merge-protocols', action='store_true',
+                        default=os.environ.get('DISCOVERY_MERGE_PROTOCOLS', 'false').lower() == 'true',
+                        help='同时采集设备支持的所有协议并按本地端口合并（默认按优先级采集到第一个有邻居的协议为止）')
+    parser.add_argument('--snapshot-format', choices=SNAPSHOT_FORMATS,
+                        default=os.environ.get('DISCOVERY_SNAPSHOT_FORMAT', DEFAULT_SNAPSHOT_FORMAT),
+                        help='topology.json 格式：json 缩进 JSON / compact 列式紧凑 JSON / msgpack 列式二进制')
+    parser.add_argument('--daemon', action='store_true',
+                        default=os.environ.get('DISCOVERY_MODE', 'oneshot') == 'daemon',
+                        help='常驻模式：按设备独立调度轮询，定期发布拓扑（只支持 thread 引擎、单进程）')
+    parser.add_argument('--interval', type=int,
+                        default=int(os.environ.get('DISCOVERY_INTERVAL', 300)),
+                        help='常驻模式下每台设备的基础轮询间隔（秒）')
+    parser.add_argument('--publish-interval', type=int,
+                        default=int(os.environ.get('DISCOVERY_PUBLISH_INTERVAL', 30)),
+                        help='常驻模式下检查并发布拓扑的间隔（秒）')
+    parser.add_argument('--profile', type=parse_profile_modes,
+                        default=os.environ.get('DISCOVERY_PROFILE', ''),
+                        help='性能剖析（逗号分隔）：cpu 为 cProfile / memory 为 tracemalloc / all，'
+                             '结果写在 metrics.json 旁边')
+    args = parser.parse_args()
+    if args.daemon and (args.engine != 'thread' or args.processes > 1):
+        parser.error('常驻模式只支持 thread 引擎和单进程（--engine thread --processes 1）')
+    return args
 
 def main():
     """主函数"""
-    discovery = TopologyDiscovery('/etc/topology/devices.yml')
+    args = parse_args()
+    profiler = DiscoveryProfiler(args.profile) if args.profile else None
+    if profiler:
+        profiler.start()
+
+    discovery = TopologyDiscovery('/etc/topology/devices.yml', incremental=not args.full,
+                                  circuit_threshold=args.circuit_threshold, tier_mode=args.tier_mode,
+                                  tier_sample_size=args.tier_sample_size,
+                                  snapshot_format=args.snapshot_format, probe_interval=args.probe_interval,
+                                  merge_protocols=args.merge_protocols)
+
+    if args.daemon:
+        from discovery_daemon import DiscoveryDaemon
+        DiscoveryDaemon(discovery, interval=args.interval, workers=args.workers,
+                        publish_interval=args.publish_interval,
+                        vmagent_url=os.environ.get('VMAGENT_URL')).run()
+        if profiler:
+            profiler.stop()
+        return
 
     # 发现拓扑（并发查询，支持多协议）
-    discovery.discover_topology(max_workers=10)
+    discovery.discover_topology(max_workers=args.workers, engine=args.engine,
+                                max_in_flight=args.max_in_flight,
+                                per_device_limit=args.per_device_limit,
+                                processes=args.processes)
 
     # 计算层级（基于图算法）
-    discovery.calculate_tiers()
-
-    # 保存拓扑数据
-    discovery.save_topology('/data/topology/topology.json')
-
-    # 保存自身指标
-    discovery.save_metrics('/data/topology/metrics.json')
-
-    # 生成 Prometheus 标签（按设备类型分类）
-    discovery.generate_prometheus_labels('/etc/prometheus/targets')
+    with discovery.phase('tiers'):
+        discovery.calculate_tiers()
 
-    # 生成 Telegraf 标签映射
-    discovery.generate_telegraf_labels('/data/topology/telegraf-labels.json')
+    # 保存拓扑、指标、设备状态并生成各类标签/图数据
+    discovery.write_outputs()
+    if profiler:
+        profiler.stop()
 
-    # 生成 Grafana 图数据
-    discovery.generate_grafana_graph('/data/topology/graph.json')
+    phases = sorted(discovery.metrics['phase_seconds'].items(), key=lambda item: -item[1])
+    logger.info("阶段耗时: " + ', '.join(f"{name} {seconds:.3f}s" for name, seconds in phases))
     
     # 输出健康状态
     health = discovery.get_health_status()
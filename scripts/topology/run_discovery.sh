@@ -8,25 +8,39 @@ set -e
 
 INTERVAL=${DISCOVERY_INTERVAL:-300}  # 默认 5 分钟运行一次
 VMAGENT_URL=${VMAGENT_URL:-http://vmagent:8429}
+TARGETS_DIR=/etc/prometheus/targets
+RUN_STAMP=/tmp/topology-discovery.stamp
 
 echo "拓扑发现服务启动"
 echo "发现间隔: ${INTERVAL} 秒"
 echo "vmagent URL: ${VMAGENT_URL}"
 
+# 常驻模式：进程内按设备调度，拓扑变化时自行通知 vmagent 重载
+if [ "${DISCOVERY_MODE}" = "daemon" ]; then
+    echo "运行模式: 常驻（发布间隔 ${DISCOVERY_PUBLISH_INTERVAL:-30} 秒）"
+    export VMAGENT_URL
+    exec python3 /scripts/lldp_discovery.py --daemon
+fi
+
 while true; do
     echo "=========================================="
     echo "开始拓扑发现: $(date)"
     echo "=========================================="
 
-    # 运行拓扑发现
+    # 运行拓扑发现（输出文件内容未变化时不会改写，mtime 保持不变）
+    touch "${RUN_STAMP}"
     python3 /scripts/lldp_discovery.py
 
-    # 重新加载 vmagent 配置（让它重新读取 file_sd）
-    echo "正在重新加载 vmagent 配置..."
-    if curl -s -X POST "${VMAGENT_URL}/-/reload" > /dev/null 2>&1; then
-        echo "✓ vmagent 配置重载成功"
+    # 只有 file_sd 文件实际变化时才重新加载 vmagent 配置，避免无谓的 target 抖动
+    if [ -n "$(find "${TARGETS_DIR}" -maxdepth 1 -name 'topology-*.json' -newer "${RUN_STAMP}" 2>/dev/null)" ]; then
+        echo "正在重新加载 vmagent 配置..."
+        if curl -s -X POST "${VMAGENT_URL}/-/reload" > /dev/null 2>&1; then
+            echo "✓ vmagent 配置重载成功"
+        else
+            echo "⚠ vmagent 重载失败（可能服务未启动）"
+        fi
     else
-        echo "⚠ vmagent 重载失败（可能服务未启动）"
+        echo "file_sd 文件未变化，跳过 vmagent 重载"
     fi
 
     echo "=========================================="
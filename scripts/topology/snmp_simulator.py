@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SNMP 设备模拟器（拓扑发现基准测试用）
+功能：
+1. 按随机种子生成拓扑模型（fat-tree / ring / star，最多数千台设备），厂商按比例混合
+2. 为每台设备生成邻居表（LLDP，及厂商私有的 CDP / NDP / LNP，列与 NEIGHBOR_COLUMNS 一致）
+   和设备指纹 OID（sysUpTime、lldpStatsRemTablesLastChangeTime）
+3. 在回环地址的 UDP 端口上应答 SNMPv2c GET / GETNEXT / GETBULK，
+   community 即设备名，一个端口可以承载任意多台设备
+4. 可注入响应延迟（含抖动）、随机丢包和完全无响应的设备（超时）
+
+报文直接按 BER 编解码：pyasn1 编码一个含 75 个 varbind 的响应约需 4 毫秒，
+模拟数千台设备时模拟器本身会成为瓶颈；每个 OID 的 varbind 在建模时预先编码，应答时只做拼接。
+
+用法（单独运行，生成 devices.yml 后可以手动运行发现脚本）：
+    python3 snmp_simulator.py --topology fat-tree --size 500 --port 16100 --devices-file /tmp/devices.yml
+"""
+
+import argparse
+import asyncio
+import bisect
+import logging
+import random
+import socket
+import time
+
+from lldp_discovery import INTERFACE_COLUMNS, LLDP_LOC_PORT_ID, LLDP_REM_TABLES_LAST_CHANGE, NEIGHBOR_COLUMNS, SYS_UPTIME
+
+logger = logging.getLogger(__name__)
+
+TOPOLOGY_MODELS = ('fat-tree', 'ring', 'star')
+
+# 厂商比例（未列出的厂商只运行 LLDP）
+VENDOR_MIX = (
+    ('cisco', 0.3),
+    ('huawei', 0.3),
+    ('h3c', 0.2),
+    ('ruijie', 0.1),
+    ('arista', 0.1),
+)
+
+# 厂商私有邻居协议（与 VENDOR_PROTOCOLS 的首选协议一致），所有设备都运行 LLDP
+VENDOR_PRIVATE_PROTOCOL = {
+    'cisco': 'cdp',
+    'huawei': 'ndp',
+    'h3c': 'lnp',
+}
+
+PORT_FORMATS = {
+    'cisco': 'GigabitEthernet1/0/{}',
+    'huawei': 'GE1/0/{}',
+    'h3c': 'GigabitEthernet1/0/{}',
+}
+DEFAULT_PORT_FORMAT = 'Ethernet{}'
+
+# UDP 报文上限（GETBULK 响应超出时减少行数，RFC 3416 允许返回更少的行）
+MAX_RESPONSE_BYTES = 65000
+
+# ========== BER 编解码（只覆盖 SNMPv2c 请求/响应用到的类型） ==========
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_TIMETICKS = 0x43
+TAG_GET = 0xA0
+TAG_GET_NEXT = 0xA1
+TAG_RESPONSE = 0xA2
+TAG_GET_BULK = 0xA5
+
+NO_SUCH_OBJECT = b'\x80\x00'
+END_OF_MIB_VIEW = b'\x82\x00'
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    size = (length.bit_length() + 7) // 8
+    return bytes([0x80 | size]) + length.to_bytes(size, 'big')
+
+
+def encode_tlv(tag, content):
+    return bytes([tag]) + encode_length(len(content)) + content
+
+
+def encode_integer(value, tag=TAG_INTEGER):
+    return encode_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def encode_oid(oid):
+    content = bytearray([oid[0] * 40 + oid[1]])
+    for arc in oid[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        content.extend(reversed(chunk))
+    return encode_tlv(TAG_OID, bytes(content))
+
+
+def encode_varbind(oid, value):
+    """value 为已编码的值（TLV）"""
+    return encode_tlv(TAG_SEQUENCE, encode_oid(oid) + value)
+
+
+VERSION_V2C = encode_integer(1)
+ZERO_INTEGER = encode_integer(0)
+
+
+def encode_response(community, request_id, varbinds):
+    """拼接 GetResponse 报文（varbinds 为已编码的 varbind 列表）"""
+    pdu = encode_integer(request_id) + ZERO_INTEGER + ZERO_INTEGER + encode_tlv(TAG_SEQUENCE, b''.join(varbinds))
+    return encode_tlv(TAG_SEQUENCE, VERSION_V2C + encode_tlv(TAG_OCTET_STRING, community) + encode_tlv(TAG_RESPONSE, pdu))
+
+
+def read_tlv(data, pos):
+    """读取 pos 处的 TLV，返回 (tag, 内容起始, 内容结束)"""
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    if pos + length > len(data):
+        raise ValueError("报文长度不足")
+    return tag, pos, pos + length
+
+
+def decode_oid(content):
+    first = content[0]
+    oid = [min(first // 40, 2), first - 40 * min(first // 40, 2)]
+    arc = 0
+    for byte in content[1:]:
+        arc = (arc << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            oid.append(arc)
+            arc = 0
+    return tuple(oid)
+
+
+def decode_request(data):
+    """解析 SNMPv2c 请求，返回 (community, PDU 类型, request-id, 第 1 个整数, 第 2 个整数, [OID...])
+
+    GETBULK 的两个整数为 non-repeaters / max-repetitions，其它 PDU 为 error-status / error-index。
+    报文无法解析时抛出 ValueError。
+    """
+    try:
+        tag, pos, end = read_tlv(data, 0)
+        if tag != TAG_SEQUENCE:
+            raise ValueError("不是 SNMP 报文")
+        tag, start, pos = read_tlv(data, pos)
+        if tag != TAG_INTEGER or int.from_bytes(data[start:pos], 'big') != 1:
+            raise ValueError("只支持 SNMPv2c")
+        tag, start, pos = read_tlv(data, pos)
+        community = data[start:pos]
+        pdu_type, pos, _ = read_tlv(data, pos)
+        integers = []
+        for _ in range(3):
+            tag, start, pos = read_tlv(data, pos)
+            integers.append(int.from_bytes(data[start:pos], 'big', signed=True))
+        tag, pos, end = read_tlv(data, pos)
+        oids = []
+        while pos < end:
+            _, start, pos = read_tlv(data, pos)
+            _, oid_start, oid_end = read_tlv(data, start)
+            oids.append(decode_oid(data[oid_start:oid_end]))
+    except IndexError:
+        raise ValueError("报文被截断")
+    return community, pdu_type, integers[0], integers[1], integers[2], oids
+
+
+def oid_tuple(oid):
+    return tuple(int(x) for x in oid.split('.'))
+
+
+# ========== 拓扑模型 ==========
+
+class TopologyModel:
+    """按随机种子生成的拓扑模型：设备（名称、厂商、层级、运行的协议）与链路（两端设备和端口号）"""
+
+    def __init__(self, kind='fat-tree', size=100, seed=0, disabled_ratio=0.0, port_aliases=False):
+        """disabled_ratio: 运行私有协议的设备中，私有协议被关闭（只剩 LLDP）的比例
+
+        port_aliases: 各协议的本地端口名不一致（lldpLocPortDesc 为接口描述，ifDescr 带 " Interface" 后缀，
+        NDP/LNP 与 lldpLocPortId 为 ifName），模拟真实设备上多协议合并时的端口命名差异
+        """
+        if kind not in TOPOLOGY_MODELS:
+            raise ValueError(f"未知的拓扑模型: {kind}")
+        self.kind = kind
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.devices = []
+        self.links = []    # (设备序号, 端口号, 设备序号, 端口号)
+        self.port_counts = []
+        self.disabled_ratio = disabled_ratio
+        self.port_aliases = port_aliases
+        getattr(self, f"build_{kind.replace('-', '_')}")(size)
+
+    def add_device(self, name, tier):
+        vendors, weights = zip(*VENDOR_MIX)
+        vendor = self.rng.choices(vendors, weights)[0]
+        protocols = ['lldp']
+        private = VENDOR_PRIVATE_PROTOCOL.get(vendor)
+        if private and self.rng.random() >= self.disabled_ratio:
+            protocols.insert(0, private)
+        self.devices.append({'name': name, 'vendor': vendor, 'tier': tier, 'protocols': protocols})
+        self.port_counts.append(0)
+        return len(self.devices) - 1
+
+    def add_link(self, a, b):
+        self.port_counts[a] += 1
+        self.port_counts[b] += 1
+        self.links.append((a, self.port_counts[a], b, self.port_counts[b]))
+
+    def build_fat_tree(self, size):
+        """k 叉 fat-tree（k 为偶数，共 5k²/4 台交换机），取设备数不超过 size 的最大 k"""
+        k = 2
+        while 5 * (k + 2) ** 2 // 4 <= size:
+            k += 2
+        half = k // 2
+        cores = [self.add_device(f"core-{i:04d}", 'core') for i in range(half * half)]
+        for pod in range(k):
+            aggs = [self.add_device(f"agg-{pod:03d}-{j:02d}", 'aggregation') for j in range(half)]
+            edges = [self.add_device(f"edge-{pod:03d}-{j:02d}", 'access') for j in range(half)]
+            for j, agg in enumerate(aggs):
+                for core in cores[j * half:(j + 1) * half]:
+                    self.add_link(agg, core)
+                for edge in edges:
+                    self.add_link(edge, agg)
+
+    def build_ring(self, size):
+        nodes = [self.add_device(f"ring-{i:05d}", 'aggregation') for i in range(max(size, 3))]
+        for i, node in enumerate(nodes):
+            self.add_link(node, nodes[(i + 1) % len(nodes)])
+
+    def build_star(self, size):
+        hub = self.add_device('hub-0000', 'core')
+        for i in range(1, max(size, 2)):
+            self.add_link(self.add_device(f"leaf-{i:05d}", 'access'), hub)
+
+    def port_name(self, device, port):
+        return PORT_FORMATS.get(self.devices[device]['vendor'], DEFAULT_PORT_FORMAT).format(port)
+
+    def expected_edges(self):
+        """发现结果应有的连接数（每条链路两端都会上报，合并后只保留一条）"""
+        return len(self.links)
+
+    def neighbor_rows(self):
+        """每台设备的邻居：设备序号 -> [(本端端口号, 对端设备序号, 对端端口号)]"""
+        rows = [[] for _ in self.devices]
+        for a, port_a, b, port_b in self.links:
+            rows[a].append((port_a, b, port_b))
+            rows[b].append((port_b, a, port_a))
+        return rows
+
+    def build_mibs(self):
+        """为每台设备生成按 OID 排序的 MIB：[(OID 元组列表, 预编码的 varbind 列表)]"""
+        columns = {protocol: {name: oid_tuple(oid) for name, oid in table.items()}
+                   for protocol, table in NEIGHBOR_COLUMNS.items()}
+        interfaces = {name: oid_tuple(oid) for name, oid in INTERFACE_COLUMNS.items()}
+        loc_port_id = oid_tuple(LLDP_LOC_PORT_ID)
+        sys_uptime = oid_tuple(SYS_UPTIME)
+        last_change = oid_tuple(LLDP_REM_TABLES_LAST_CHANGE)
+        rng = random.Random(self.seed + 1)
+
+        def text(value):
+            return encode_tlv(TAG_OCTET_STRING, value.encode('utf-8'))
+
+        mibs = []
+        for device, neighbors in enumerate(self.neighbor_rows()):
+            info = self.devices[device]
+            entries = {
+                sys_uptime: encode_integer(rng.randrange(10 ** 6, 10 ** 9), TAG_TIMETICKS),
+                last_change: encode_integer(rng.randrange(10 ** 5), TAG_TIMETICKS),
+            }
+            for port, remote, remote_port in neighbors:
+                local_name = self.port_name(device, port)
+                remote_name = self.devices[remote]['name']
+                remote_port_name = self.port_name(remote, remote_port)
+                # 接口表（ifIndex 即端口号）
+                if_descr = f"{local_name} Interface" if self.port_aliases else local_name
+                entries[interfaces['if_name'] + (port,)] = text(local_name)
+                entries[interfaces['if_descr'] + (port,)] = text(if_descr)
+                for protocol in info['protocols']:
+                    table = columns[protocol]
+                    if protocol == 'lldp':
+                        # 索引: 时间戳.本地端口号.远端索引
+                        entries[table['rem_sys_name'] + (0, port, 1)] = text(remote_name)
+                        entries[table['rem_port_id'] + (0, port, 1)] = text(remote_port_name)
+                        entries[table['loc_port_desc'] + (port,)] = text(
+                            f"to {remote_name}" if self.port_aliases else local_name)
+                        entries[loc_port_id + (port,)] = text(local_name)
+                    elif protocol == 'cdp':
+                        # 索引: ifIndex.deviceIndex
+                        entries[table['device_id'] + (port, 1)] = text(remote_name)
+                        entries[table['device_port'] + (port, 1)] = text(remote_port_name)
+                        entries[table['platform'] + (port, 1)] = text(self.devices[remote]['vendor'])
+                    else:
+                        entries[table['neighbor_name'] + (port, 1)] = text(remote_name)
+                        entries[table['neighbor_port'] + (port, 1)] = text(remote_port_name)
+                        entries[table['local_port'] + (port, 1)] = text(local_name)
+            oids = sorted(entries)
+            mibs.append((oids, [encode_varbind(oid, entries[oid]) for oid in oids]))
+        return mibs
+
+
+class SimulatedAgent:
+    """单台模拟设备的 SNMP 应答逻辑（MIB 按 OID 排序，GETNEXT / GETBULK 用二分查找）"""
+
+    def __init__(self, name, oids, varbinds, unresponsive=False):
+        self.name = name
+        self.oids = oids
+        self.varbinds = varbinds
+        self.unresponsive = unresponsive
+
+    def get(self, oid):
+        i = bisect.bisect_left(self.oids, oid)
+        if i < len(self.oids) and self.oids[i] == oid:
+            return self.varbinds[i]
+        return encode_varbind(oid, NO_SUCH_OBJECT)
+
+    def get_next(self, oid):
+        i = bisect.bisect_right(self.oids, oid)
+        if i < len(self.oids):
+            return self.varbinds[i]
+        return encode_varbind(oid, END_OF_MIB_VIEW)
+
+    def get_bulk(self, oids, non_repeaters, max_repetitions):
+        non_repeaters = max(0, min(non_repeaters, len(oids)))
+        varbinds = [self.get_next(oid) for oid in oids[:non_repeaters]]
+        repeaters = oids[non_repeaters:]
+        positions = [bisect.bisect_right(self.oids, oid) for oid in repeaters]
+        size = sum(map(len, varbinds))
+        total = len(self.oids)
+        for _ in range(max(max_repetitions, 0) if repeaters else 0):
+            row = []
+            for i, position in enumerate(positions):
+                if position < total:
+                    row.append(self.varbinds[position])
+                    positions[i] = position + 1
+                else:
+                    row.append(encode_varbind(repeaters[i], END_OF_MIB_VIEW))
+            row_size = sum(map(len, row))
+            if varbinds and size + row_size > MAX_RESPONSE_BYTES:
+                break
+            varbinds.extend(row)
+            size += row_size
+            if all(position >= total for position in positions):
+                break
+        return varbinds
+
+    def respond(self, pdu_type, first, second, oids):
+        """返回应答的 varbind 列表（不支持的 PDU 类型返回 None）"""
+        if pdu_type == TAG_GET:
+            return [self.get(oid) for oid in oids]
+        if pdu_type == TAG_GET_NEXT:
+            return [self.get_next(oid) for oid in oids]
+        if pdu_type == TAG_GET_BULK:
+            return self.get_bulk(oids, first, second)
+        return None
+
+
+class SnmpResponder(asyncio.DatagramProtocol):
+    """一个 UDP 端口上的应答器：按 community 分发给模拟设备，按配置注入延迟和丢包"""
+
+    def __init__(self, agents, latency=0.0, jitter=0.0, loss=0.0, seed=0):
+        self.agents = agents  # community（bytes）-> SimulatedAgent
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.transport = None
+        self.stats = {
+            'requests': 0,
+            'responses': 0,
+            'dropped': 0,
+            'unresponsive': 0,
+            'unknown_community': 0,
+            'malformed': 0,
+            'varbinds': 0,
+            'bytes_sent': 0
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        stats = self.stats
+        stats['requests'] += 1
+        try:
+            community, pdu_type, request_id, first, second, oids = decode_request(data)
+        except ValueError as e:
+            stats['malformed'] += 1
+            logger.debug(f"丢弃无法解析的请求 {addr}: {e}")
+            return
+
+        agent = self.agents.get(community)
+        if agent is None:
+            stats['unknown_community'] += 1
+            return
+        if agent.unresponsive:
+            stats['unresponsive'] += 1
+            return
+        if self.loss and self.rng.random() < self.loss:
+            stats['dropped'] += 1
+            return
+
+        varbinds = agent.respond(pdu_type, first, second, oids)
+        if varbinds is None:
+            stats['malformed'] += 1
+            return
+        response = encode_response(community, request_id, varbinds)
+        stats['responses'] += 1
+        stats['varbinds'] += len(varbinds)
+        stats['bytes_sent'] += len(response)
+
+        delay = self.latency + (self.rng.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def error_received(self, exc):
+        logger.debug(f"模拟器 socket 错误: {exc}")
+
+
+class SnmpSimulator:
+    """在一个事件循环中运行若干个回环端口的应答器，设备按序号轮流分配到各端口"""
+
+    def __init__(self, model, responders=1, latency=0.0, jitter=0.0, loss=0.0, timeout_ratio=0.0,
+                 seed=0, host='127.0.0.1', base_port=0):
+        """latency / jitter 单位为秒；timeout_ratio 为完全无响应的设备比例"""
+        self.model = model
+        self.responder_count = max(1, responders)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.host = host
+        self.base_port = base_port
+        self.ports = []
+        self.responders = []
+        self.transports = []
+        self.cpu_start = None
+
+        rng = random.Random(seed + 2)
+        unresponsive = set(rng.sample(range(len(model.devices)), round(len(model.devices) * timeout_ratio)))
+        self.agent_groups = [{} for _ in range(self.responder_count)]
+        for i, (device, (oids, varbinds)) in enumerate(zip(model.devices, model.build_mibs())):
+            agent = SimulatedAgent(device['name'], oids, varbinds, i in unresponsive)
+            self.agent_groups[i % self.responder_count][device['name'].encode('utf-8')] = agent
+        self.seed = seed
+
+    async def start(self):
+        """打开所有端口，返回端口列表"""
+        loop = asyncio.get_running_loop()
+        self.cpu_start = time.process_time()
+        for i, agents in enumerate(self.agent_groups):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                # 突发请求（数千台设备同时采集）时避免内核丢包
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            except OSError:
+                pass
+            sock.bind((self.host, self.base_port + i if self.base_port else 0))
+            sock.setblocking(False)
+            responder = SnmpResponder(agents, self.latency, self.jitter, self.loss, self.seed + 3 + i)
+            transport, _ = await loop.create_datagram_endpoint(lambda: responder, sock=sock)
+            self.responders.append(responder)
+            self.transports.append(transport)
+            self.ports.append(sock.getsockname()[1])
+        logger.info(f"模拟器已启动: {len(self.model.devices)} 台设备, {len(self.model.links)} 条链路, 端口 {self.ports}")
+        return self.ports
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def stats(self):
+        """各端口统计合计，附带启动以来模拟器进程的 CPU 时间"""
+        totals = {}
+        for responder in self.responders:
+            for key, value in responder.stats.items():
+                totals[key] = totals.get(key, 0) + value
+        totals['cpu_seconds'] = round(time.process_time() - (self.cpu_start or 0), 3)
+        return totals
+
+
+def device_configs(model, ports, host='127.0.0.1'):
+    """与 devices.yml 相同结构的设备配置（community 为设备名，按序号轮流分配端口）"""
+    return [{
+        'name': device['name'],
+        'host': host,
+        'snmp_port': ports[i % len(ports)],
+        'snmp_community': device['name'],
+        'type': 'switch',
+        'vendor': device['vendor'],
+        'tier': device['tier']
+    } for i, device in enumerate(model.devices)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SNMP 设备模拟器（拓扑发现基准测试用）')
+    parser.add_argument('--topology', choices=TOPOLOGY_MODELS, default='fat-tree', help='拓扑模型')
+    parser.add_argument('--size', type=int, default=100, help='设备数（fat-tree 取不超过该值的最大规模）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--port', type=int, default=16100, help='第一个端口（0 表示随机端口）')
+    parser.add_argument('--responders', type=int, default=1, help='应答端口数')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='响应延迟（毫秒）')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='响应延迟抖动（毫秒，均匀分布）')
+    parser.add_argument('--loss', type=float, default=0.0, help='请求丢包率')
+    parser.add_argument('--timeout-ratio', type=float, default=0.0, help='完全无响应的设备比例')
+    parser.add_argument('--disabled-ratio', type=float, default=0.0, help='私有协议（CDP/NDP/LNP）被关闭的设备比例')
+    parser.add_argument('--port-aliases', action='store_true', help='各协议的本地端口名不一致（lldpLocPortDesc 为接口描述）')
+    parser.add_argument('--devices-file', help='把设备配置写到该文件（devices.yml 格式）')
+    parser.add_argument('--duration', type=float, help='运行时长（秒），默认一直运行')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    model = TopologyModel(args.topology, args.size, args.seed, args.disabled_ratio, args.port_aliases)
+    simulator = SnmpSimulator(model, args.responders, args.latency_ms / 1000, args.jitter_ms / 1000,
+                              args.loss, args.timeout_ratio, args.seed, base_port=args.port)
+
+    async def run():
+        await simulator.start()
+        if args.devices_file:
+            import yaml
+            with open(args.devices_file, 'w') as f:
+                yaml.safe_dump({'devices': device_configs(model, simulator.ports)}, f,
+                               allow_unicode=True, sort_keys=False)
+            logger.info(f"设备配置已写入: {args.devices_file}")
+        start = time.time()
+        try:
+            if args.duration:
+                await asyncio.sleep(args.duration)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            simulator.close()
+            logger.info(f"运行 {time.time() - start:.1f} 秒，统计: {simulator.stats()}")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("收到停止信号，正在关闭...")
+
+
+if __name__ == '__main__':
+    main()
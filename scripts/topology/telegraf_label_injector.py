@@ -10,7 +10,11 @@ import sys
 import json
 import logging
 import os
-from datetime import datetime
+import re
+import select
+import time
+from collections import OrderedDict
+from threading import Event, Thread
 
 # 配置日志（输出到 stderr，不影响 stdout 的 metrics）
 logging.basicConfig(
@@ -20,95 +24,285 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 用于匹配拓扑标签的 tag（按优先级）
+MATCH_TAGS = (
+    'esxi_host',    # VMware ESXi
+    'host',         # 通用 host
+    'vcenter',      # vCenter
+    'source',       # source
+    'hostname',     # hostname
+    'instance',     # instance
+)
+
+DEFAULT_CACHE_SIZE = 100000  # 改写结果 LRU 缓存的 series 数
+
+# series key 中查找 host 类 tag 用的字节串（",host=" 等）
+MATCH_NEEDLES = tuple(f",{tag}=".encode() for tag in MATCH_TAGS)
+
+MISSING = object()  # 缓存未命中的标记（None 表示 series 没有匹配的 host）
+
+READ_CHUNK_SIZE = 1 << 20  # 批处理模式每次从 stdin 读取的最大字节数
+
+STATS_INTERVAL = 60  # 缓存统计输出到 stderr 的间隔（秒）
+
+# ========== Line protocol 词法（bytes，转义感知，预编译正则） ==========
+# 不使用占有量词/原子组（Python 3.11 才支持，Telegraf 镜像中的 python3 版本不确定，需兼容 3.8+）：
+# 各分支的首字符互斥（普通字符 / 反斜杠），且整个模式总能匹配成功，贪婪匹配第一次即成功，不会回溯
+# 整个处理流程都在 bytes 上进行，不对每行做 UTF-8 解码/编码
+# （UTF-8 多字节字符的后续字节不会与空格、逗号、等号、引号、反斜杠冲突）
+# series key：到第一个未转义的空格为止（measurement 中可以有 "\ " 和 "\,"）
+SERIES_RE = re.compile(rb'(?:[^\\ ]+|\\.?)*')
+# fields：key=value 用逗号连接，到第一个未转义、不在字符串值内的空格为止
+# （只有紧跟在 "=" 后的双引号才开始字符串值，字符串内可以有空格、逗号、\" 和 \\）
+FIELD_KEY = rb'(?:[^\\ ,=]+|\\.?)*'
+FIELD_VALUE = rb'(?:"(?:[^\\"]+|\\.?)*"?|(?:[^\\ ,]+|\\.?)*)'
+FIELDS_RE = re.compile(FIELD_KEY + rb'(?:=' + FIELD_VALUE + rb')?(?:,' + FIELD_KEY + rb'(?:=' + FIELD_VALUE + rb')?)*')
+UNESCAPED_COMMA_RE = re.compile(rb'(?<!\\),')
+UNESCAPED_EQUALS_RE = re.compile(rb'(?<!\\)=')
+TAG_ESCAPE_RE = re.compile(rb'\\([, =\\])')
+
+
+def escape_tag(value):
+    """按 line protocol 规则转义 tag 的 key/value（逗号、等号、空格）"""
+    return str(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def unescape_tag(value):
+    """去掉 tag key/value（bytes）中的转义"""
+    return TAG_ESCAPE_RE.sub(rb'\1', value) if b'\\' in value else value
+
+
+def series_end(line):
+    """series key 的结束位置（第一个未转义的空格），没有字段部分时返回 -1"""
+    space = line.find(b' ')
+    if space < 0:
+        return -1
+    # 常见情况：空格之前没有反斜杠，第一个空格就是分隔符
+    if line.find(b'\\', 0, space) < 0:
+        return space
+    end = SERIES_RE.match(line).end()
+    return end if end < len(line) else -1
+
+
+def split_series(series):
+    """拆分 series key，返回 (measurement, [原始 tag...])，按未转义的逗号分割"""
+    parts = series.split(b',') if b'\\' not in series else UNESCAPED_COMMA_RE.split(series)
+    return parts[0], parts[1:]
+
+
+def split_tag(tag):
+    """拆分单个 tag 为 (key, value)（保留转义），没有未转义的等号时返回 None"""
+    if b'\\' not in tag:
+        key, sep, value = tag.partition(b'=')
+    else:
+        parts = UNESCAPED_EQUALS_RE.split(tag, 1)
+        key, sep, value = parts[0], len(parts) > 1, parts[-1]
+    return (key, value) if sep else None
+
+
+def tokenize_line(line):
+    """单遍切分一行 line protocol（bytes）
+
+    返回 (measurement, [(tag key, tag value)...], fields, timestamp)，均保留原始转义；
+    空行、注释或缺少字段部分时返回 None
+    """
+    line = line.strip()
+    if not line or line[0] == 0x23:  # '#'
+        return None
+    end = series_end(line)
+    if end <= 0:
+        return None
+    rest = line[end + 1:].lstrip(b' ')
+    if b'"' not in rest and b'\\' not in rest:
+        # 常见情况：没有字符串字段和转义，第一个空格就是 fields 的结束
+        fields, _, timestamp = rest.partition(b' ')
+    else:
+        fields_end = FIELDS_RE.match(rest).end()
+        fields, timestamp = rest[:fields_end], rest[fields_end:]
+    if not fields:
+        return None
+    series = line[:end]
+    if b'\\' not in series:
+        measurement, *tag_strs = series.split(b',')
+        tags = [(key, value) for key, sep, value in (tag.partition(b'=') for tag in tag_strs) if sep]
+    else:
+        measurement, tag_strs = split_series(series)
+        tags = [tag for tag in map(split_tag, tag_strs) if tag is not None]
+    return measurement, tags, fields, timestamp.strip()
+
+
+def compile_labels(labels):
+    """把一组拓扑标签预编译为 (标签 key 集合, 按 key 排序的 (key, b'key=value') 片段)"""
+    fragments = sorted((key.encode(), f"{escape_tag(key)}={escape_tag(value)}".encode())
+                       for key, value in labels.items())
+    return frozenset(key for key, _ in fragments), tuple(fragments)
+
+
 class TopologyLabelInjector:
     """拓扑标签注入器"""
 
-    def __init__(self, label_file='/data/topology/telegraf-labels.json'):
+    def __init__(self, label_file='/data/topology/telegraf-labels.json', cache_size=DEFAULT_CACHE_SIZE):
         self.label_file = label_file
-        self.label_map = {}
-        self.last_load_time = 0
-        self.reload_interval = 60  # 每 60 秒重新加载一次
+        self.reload_interval = 5  # 检查标签文件变化的间隔（秒，只做 stat，变化时才重新加载）
+        # 当前标签状态：标签映射、预编译的标签片段（label_map key（bytes）-> 片段）、
+        # 改写缓存（series key -> 注入标签后的 series key，没有匹配的 series 记为 None；
+        # 同一份标签映射下 host 由 series key 唯一确定，因此只用 series key 作为缓存 key）
+        # 及其对应的文件版本。后台线程构造好新状态后整体替换，处理线程每块只取一次
+        self.state = self.build_state({})
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.reload_count = 0
+        self.reload_seconds = 0.0
+        self.stopping = Event()
+
+    @property
+    def label_map(self):
+        return self.state['label_map']
+
+    @property
+    def compiled(self):
+        return self.state['compiled']
+
+    @property
+    def cache(self):
+        return self.state['cache']
+
+    def label_version(self):
+        """标签文件版本（inode + mtime + 大小），文件被替换或修改时变化；文件不存在返回 None"""
+        try:
+            stat = os.stat(self.label_file)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
     def load_labels(self):
-        """加载标签映射"""
+        """加载标签映射：读取、解析、预编译后原子替换当前状态（不阻塞处理线程）"""
+        start = time.perf_counter()
         try:
-            if os.path.exists(self.label_file):
-                with open(self.label_file, 'r') as f:
-                    self.label_map = json.load(f)
-                logger.info(f"加载标签映射: {len(self.label_map)} 个条目")
-                self.last_load_time = datetime.now().timestamp()
-                return True
-            else:
-                logger.warning(f"标签文件不存在: {self.label_file}")
-                return False
+            with open(self.label_file, 'rb') as f:
+                # 版本取自已打开的文件，读取期间文件被替换时下一轮会再次加载
+                stat = os.fstat(f.fileno())
+                label_map = json.loads(f.read())
+        except FileNotFoundError:
+            logger.warning(f"标签文件不存在: {self.label_file}")
+            return False
         except Exception as e:
             logger.error(f"加载标签映射失败: {e}")
             return False
 
-    def should_reload(self):
-        """检查是否需要重新加载"""
-        now = datetime.now().timestamp()
-        return (now - self.last_load_time) > self.reload_interval
+        state = self.build_state(label_map, (stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        self.state = state
+        self.reload_seconds = time.perf_counter() - start
+        self.reload_count += 1
+        logger.info(f"加载标签映射: {len(label_map)} 个条目（{len(set(map(id, state['compiled'].values())))} 组标签），"
+                    f"耗时 {self.reload_seconds:.3f} 秒")
+        return True
+
+    def reload(self):
+        """标签文件有变化时重新加载，返回是否替换"""
+        version = self.label_version()
+        if version is None or version == self.state['version']:
+            return False
+        return self.load_labels()
+
+    def watch(self):
+        """后台监视标签文件（stat 轮询），定期输出缓存统计"""
+        last_stats = time.monotonic()
+        while not self.stopping.wait(self.reload_interval):
+            try:
+                if self.reload():
+                    self.log_stats()
+                    last_stats = time.monotonic()
+            except Exception as e:
+                logger.error(f"重新加载标签映射失败: {e}")
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                self.log_stats()
+                last_stats = time.monotonic()
+
+    def start_watcher(self):
+        """启动后台监视线程"""
+        watcher = Thread(target=self.watch, name='label-watcher', daemon=True)
+        watcher.start()
+        return watcher
+
+    def build_state(self, label_map, version=None):
+        """构造标签状态并预编译标签片段
+
+        IP/设备名/FQDN 对应同一组标签：按内容去重，每组只编译一次、只保留一份
+        （从 JSON 加载的各组标签是不同的 dict 对象，不能按 id 去重）
+        """
+        compiled_by_labels = {}
+        compiled = {}
+        for key, labels in label_map.items():
+            labels_key = tuple(labels.items())
+            fragments = compiled_by_labels.get(labels_key)
+            if fragments is None:
+                fragments = compiled_by_labels[labels_key] = compile_labels(labels)
+            compiled[key.encode()] = fragments
+        # 标签可能已变化，之前的改写结果全部作废，新状态使用新的缓存
+        return {'label_map': label_map, 'compiled': compiled, 'cache': OrderedDict(), 'version': version}
+
+    def set_label_map(self, label_map):
+        """替换标签映射（不对应标签文件的版本）"""
+        self.state = self.build_state(label_map)
+
+    def log_stats(self):
+        """把缓存命中和标签加载统计输出到 stderr"""
+        total = self.cache_hits + self.cache_misses
+        hit_rate = self.cache_hits / total * 100 if total else 0.0
+        logger.info(f"改写缓存: 命中 {self.cache_hits}，未命中 {self.cache_misses}（命中率 {hit_rate:.1f}%），"
+                    f"淘汰 {self.cache_evictions}，当前 {len(self.cache)}/{self.cache_size} 条；"
+                    f"标签映射 {len(self.label_map)} 个条目，已加载 {self.reload_count} 次，"
+                    f"最近一次耗时 {self.reload_seconds:.3f} 秒")
 
     def parse_line_protocol(self, line):
-        """解析 InfluxDB Line Protocol"""
-        # 格式：measurement,tag1=value1,tag2=value2 field1=value1,field2=value2 timestamp
-        line = line.strip()
-        if not line or line.startswith('#'):
-            return None
-
-        try:
-            # 分割 measurement+tags 和 fields
-            parts = line.split(' ', 2)
-            if len(parts) < 2:
-                return None
-
-            measurement_tags = parts[0]
-            fields = parts[1]
-            timestamp = parts[2] if len(parts) == 3 else ''
-
-            # 分割 measurement 和 tags
-            measurement_parts = measurement_tags.split(',', 1)
-            measurement = measurement_parts[0]
-            tags_str = measurement_parts[1] if len(measurement_parts) > 1 else ''
-
-            # 解析 tags
-            tags = {}
-            if tags_str:
-                for tag in tags_str.split(','):
-                    if '=' in tag:
-                        k, v = tag.split('=', 1)
-                        tags[k] = v
-
-            return {
-                'measurement': measurement,
-                'tags': tags,
-                'fields': fields,
-                'timestamp': timestamp
-            }
-        except Exception as e:
-            logger.error(f"解析 line protocol 失败: {line}, 错误: {e}")
+        """解析 InfluxDB Line Protocol（tag 和字段保留原始转义，便于原样重建）"""
+        # 格式：measurement,tag1=value1,tag2=value2 field1=value1,field2="string value" timestamp
+        tokens = tokenize_line(line.encode('utf-8'))
+        if tokens is None:
             return None
+        measurement, tags, fields, timestamp = tokens
+        return {
+            'measurement': measurement.decode('utf-8'),
+            'tags': {key.decode('utf-8'): value.decode('utf-8') for key, value in tags},
+            'fields': fields.decode('utf-8'),
+            'timestamp': timestamp.decode('utf-8')
+        }
 
     def find_labels(self, tags):
         """根据 tags 查找对应的拓扑标签"""
         # 尝试多种匹配方式
-        match_keys = [
-            tags.get('esxi_host'),           # VMware ESXi
-            tags.get('host'),                # 通用 host
-            tags.get('vcenter'),             # vCenter
-            tags.get('source'),              # source
-            tags.get('hostname'),            # hostname
-            tags.get('instance'),            # instance
-        ]
-
-        # 尝试匹配
-        for key in match_keys:
+        for tag in MATCH_TAGS:
+            key = tags.get(tag)
+            if key:
+                key = unescape_tag(key.encode('utf-8')).decode('utf-8')
             if key and key in self.label_map:
                 return self.label_map[key]
 
         return None
 
+    def find_host_key(self, series, compiled=None):
+        """不解析全部 tag，直接在 series key（bytes）中查找可匹配的 host 值（返回 compiled 中的 key）"""
+        if compiled is None:
+            compiled = self.compiled
+        for needle in MATCH_NEEDLES:
+            start = series.find(needle)
+            # 跳过转义逗号（"\,host=" 属于前一个 tag 的值）
+            while start > 0 and series[start - 1] == 0x5C:  # '\\'
+                start = series.find(needle, start + 1)
+            if start < 0:
+                continue
+            start += len(needle)
+            end = series.find(b',', start)
+            while end > 0 and series[end - 1] == 0x5C:
+                end = series.find(b',', end + 1)
+            key = unescape_tag(series[start:end] if end >= 0 else series[start:])
+            if key and key in compiled:
+                return key
+        return None
+
     def inject_labels(self, metric_data):
         """注入拓扑标签"""
         if not metric_data:
@@ -119,8 +313,8 @@ class TopologyLabelInjector:
         if not topology_labels:
             return metric_data  # 没有找到标签，返回原始数据
 
-        # 注入标签
-        metric_data['tags'].update(topology_labels)
+        # 注入标签（转义后与原有 tag 的表示一致）
+        metric_data['tags'].update({escape_tag(k): escape_tag(v) for k, v in topology_labels.items()})
         return metric_data
 
     def build_line_protocol(self, metric_data):
@@ -138,19 +332,91 @@ class TopologyLabelInjector:
 
         return line
 
-    def process_line(self, line):
-        """处理单行 metric"""
-        # 解析
-        metric_data = self.parse_line_protocol(line)
-        if not metric_data:
-            return line  # 解析失败，返回原始行
+    def rewrite_series(self, series, host, compiled=None):
+        """把预编译的标签片段合并进 series key（同名 tag 以拓扑标签为准，按 key 排序）"""
+        label_keys, fragments = (self.compiled if compiled is None else compiled)[host]
+        measurement, tag_strs = split_series(series)
+        tags = []
+        for tag in tag_strs:
+            parsed = split_tag(tag)
+            if parsed is not None and unescape_tag(parsed[0]) not in label_keys:
+                tags.append((parsed[0], tag))
+        tags.extend(fragments)
+        tags.sort()
+        return b','.join([measurement] + [fragment for _, fragment in tags])
 
-        # 注入标签
-        metric_data = self.inject_labels(metric_data)
-
-        # 重新构建
-        new_line = self.build_line_protocol(metric_data)
-        return new_line if new_line else line
+    def process_line(self, line):
+        """处理单行 metric（str，不含换行符），供逐行调用方使用"""
+        return self.process_bytes(line.encode('utf-8')).decode('utf-8')
+
+    def process_chunk(self, data):
+        """批处理：处理一块以换行分隔的完整行（bytes），返回输出（行数和顺序不变）"""
+        # 整块使用同一份标签状态，处理期间后台线程替换状态不影响本块
+        state = self.state
+        process = self.process_bytes
+        return b'\n'.join([process(line, state) for line in data.split(b'\n')])
+
+    def process_bytes(self, line, state=None):
+        """处理单行 metric（bytes，不含换行符）
+
+        快速路径：取出 series key（第一个未转义的空格之前），查 LRU 缓存：
+        没有匹配的 series（大多数 measurement）原样返回，不做解析和重建；
+        匹配的 series 取改写后的 series key，再拼接原有的 fields 和时间戳。
+        缓存未命中时才在 series key 中查找 host 类 tag 并改写。
+        state 为调用方已取出的标签状态（默认取当前状态）。
+        """
+        space = series_end(line)
+        if space < 0:
+            return line
+        series = line[:space]
+
+        if state is None:
+            state = self.state
+        cache = state['cache']
+        rewritten = cache.get(series, MISSING)
+        if rewritten is MISSING:
+            self.cache_misses += 1
+            compiled = state['compiled']
+            host = self.find_host_key(series, compiled)
+            rewritten = self.rewrite_series(series, host, compiled) if host is not None else None
+            cache[series] = rewritten
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+                self.cache_evictions += 1
+        else:
+            self.cache_hits += 1
+            cache.move_to_end(series)
+        return line if rewritten is None else rewritten + line[space:]
+
+
+def run_batch(injector, fd, out):
+    """批处理主循环：按块读取 stdin，每块只处理完整的行（整块 bytes 处理，不逐行解码）
+
+    输出写入缓冲区，stdin 暂时没有数据（空闲）时才 flush；
+    标签由后台线程重新加载，主循环中没有文件 IO 和 JSON 解析。
+    """
+    pending = b''
+    while True:
+        if not select.select([fd], [], [], 0)[0]:
+            out.flush()
+        chunk = os.read(fd, READ_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        data = pending + chunk if pending else chunk
+        cut = data.rfind(b'\n')
+        if cut < 0:
+            pending = data
+            continue
+        pending = data[cut + 1:]
+        out.write(injector.process_chunk(data[:cut]))
+        out.write(b'\n')
+
+    # 最后一行没有换行符
+    if pending:
+        out.write(injector.process_bytes(pending))
+        out.write(b'\n')
+    out.flush()
 
 
 def main():
@@ -162,24 +428,19 @@ def main():
     logger.info(f"标签文件: {label_file}")
     logger.info("=" * 60)
 
-    injector = TopologyLabelInjector(label_file)
+    injector = TopologyLabelInjector(label_file, int(os.environ.get('TOPOLOGY_LABEL_CACHE_SIZE', DEFAULT_CACHE_SIZE)))
 
     # 初始加载
     if not injector.load_labels():
         logger.warning("初始标签加载失败，将继续运行")
+    # 后台监视标签文件，变化时在处理线程之外重新加载
+    injector.start_watcher()
 
-    # 从 stdin 读取 metrics，处理后输出到 stdout
+    # 从 stdin 读取 metrics，处理后输出到 stdout（二进制流，批处理）
     try:
-        for line in sys.stdin:
-            # 定期重新加载标签
-            if injector.should_reload():
-                injector.load_labels()
-
-            # 处理并输出
-            processed_line = injector.process_line(line)
-            if processed_line:
-                print(processed_line)
-                sys.stdout.flush()  # 确保立即输出
+        run_batch(injector, sys.stdin.fileno(), sys.stdout.buffer)
+        injector.stopping.set()
+        injector.log_stats()
 
     except KeyboardInterrupt:
         logger.info("收到停止信号，正在关闭...")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+层级推断对比报告
+功能：在同一拓扑图上分别运行精确中心性与近似中心性（fast 模式），
+对比两者推断出的层级，输出一致率、混淆矩阵、耗时和不一致的节点
+
+用法：
+    python3 tier_report.py --topology /data/topology/topology.json --sample-size 256
+"""
+
+import argparse
+import json
+import logging
+import time
+from collections import defaultdict
+
+from lldp_discovery import (
+    DEFAULT_TIER_SAMPLE_SIZE,
+    TopologyIndex,
+    centrality_score,
+    exact_centrality,
+    fast_centrality,
+    score_tier
+)
+from topology_snapshot import read_topology
+
+logger = logging.getLogger(__name__)
+
+TIERS = ('core', 'aggregation', 'access')
+
+
+def inferred_nodes(topology):
+    """需要推断层级的节点（topology.json 中带 centrality_score 的节点即为推断所得）"""
+    return [name for name, node in topology['nodes'].items()
+            if 'centrality_score' in node or node.get('tier') in ('unknown', None)]
+
+
+def assign_tiers(centrality, names):
+    degree, betweenness, closeness = centrality
+    scores = {name: centrality_score(degree.get(name, 0), betweenness.get(name, 0), closeness.get(name, 0))
+              for name in names}
+    return scores, {name: score_tier(score) for name, score in scores.items()}
+
+
+def compare_tier_modes(topology, sample_size=DEFAULT_TIER_SAMPLE_SIZE, seed=0, max_mismatches=50):
+    """对比精确与近似中心性的层级推断结果，返回报告 dict"""
+    G = TopologyIndex(topology).graph()
+    names = inferred_nodes(topology)
+
+    start = time.time()
+    exact = exact_centrality(G)
+    exact_seconds = time.time() - start
+
+    start = time.time()
+    fast = fast_centrality(G, sample_size, seed)
+    fast_seconds = time.time() - start
+
+    exact_scores, exact_tiers = assign_tiers(exact, names)
+    fast_scores, fast_tiers = assign_tiers(fast, names)
+
+    confusion = {tier: defaultdict(int) for tier in TIERS}
+    mismatches = []
+    for name in names:
+        confusion[exact_tiers[name]][fast_tiers[name]] += 1
+        if exact_tiers[name] != fast_tiers[name]:
+            mismatches.append({
+                'node': name,
+                'exact_tier': exact_tiers[name],
+                'fast_tier': fast_tiers[name],
+                'exact_score': round(exact_scores[name], 4),
+                'fast_score': round(fast_scores[name], 4)
+            })
+    mismatches.sort(key=lambda m: abs(m['exact_score'] - m['fast_score']), reverse=True)
+
+    errors = [abs(exact_scores[name] - fast_scores[name]) for name in names]
+    return {
+        'nodes': G.number_of_nodes(),
+        'edges': G.number_of_edges(),
+        'inferred_nodes': len(names),
+        'sample_size': sample_size,
+        'exact_seconds': round(exact_seconds, 3),
+        'fast_seconds': round(fast_seconds, 3),
+        'speedup': round(exact_seconds / fast_seconds, 1) if fast_seconds > 0 else None,
+        'agreement': round(1 - len(mismatches) / len(names), 4) if names else 1.0,
+        'score_mean_abs_error': round(sum(errors) / len(errors), 5) if errors else 0.0,
+        'score_max_abs_error': round(max(errors), 5) if errors else 0.0,
+        'confusion': {tier: {t: confusion[tier][t] for t in TIERS} for tier in TIERS},
+        'mismatch_count': len(mismatches),
+        'mismatches': mismatches[:max_mismatches]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='层级推断：精确 vs 近似中心性对比报告')
+    parser.add_argument('--topology', default='/data/topology/topology.json', help='拓扑文件')
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_TIER_SAMPLE_SIZE, help='采样 pivot 数')
+    parser.add_argument('--seed', type=int, default=0, help='采样随机种子')
+    parser.add_argument('--output', help='报告输出文件（默认打印到标准输出）')
+    args = parser.parse_args()
+
+    topology = read_topology(args.topology)
+
+    report = compare_tier_modes(topology, args.sample_size, args.seed)
+    logger.info(f"节点 {report['nodes']}，精确 {report['exact_seconds']} 秒，近似 {report['fast_seconds']} 秒，"
+                f"层级一致率 {report['agreement'] * 100:.2f}%")
+
+    data = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+        logger.info(f"报告已保存: {args.output}")
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,26 @@
 # -*- coding: utf-8 -*-
 """
 Topology Exporter - 将拓扑数据暴露为 Prometheus 指标
-功能：读取 topology.json 和 metrics.json，生成拓扑和自身指标
+功能：读取 topology.json（json / compact / msgpack 快照）和 metrics.json，生成拓扑和自身指标
+（每个数据版本只渲染一次，缓存编码后的字节及 gzip 版本）
 """
 
+import gzip
+import io
 import json
+import socket
 import time
 import logging
+import selectors
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from threading import Thread
+from threading import BoundedSemaphore, Lock, Thread
 import os
 
+from topology_snapshot import read_topology
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -19,57 +29,172 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 带 device_name 标签的设备级指标最多输出多少台设备（取最近一次采集最慢的），0 表示不输出
+DEFAULT_DEVICE_METRICS_LIMIT = 100
+
+# 按设备/协议的采集统计：(metrics.json 中的字段, 说明)
+COLLECTION_STAT_METRICS = (
+    ('duration_seconds', 'Time spent collecting'),
+    ('requests', 'SNMP requests sent (round trips, including retransmissions)'),
+    ('bytes_received', 'SNMP response bytes received'),
+    ('retries', 'SNMP queries retried after a failed attempt'),
+    ('timeouts', 'SNMP attempts that timed out'),
+    ('neighbors', 'Neighbors found'),
+)
+
 class TopologyExporter:
-    """拓扑指标导出器"""
+    """拓扑指标导出器
+
+    后台线程按 mtime/大小 检测数据文件变化，在请求路径之外解析 JSON 并渲染，
+    然后整体替换 self.snapshot（单次属性赋值，请求线程只会看到完整的旧快照或新快照）。
+    """
 
-    def __init__(self, topology_file='/data/topology/topology.json', metrics_file='/data/topology/metrics.json'):
+    def __init__(self, topology_file='/data/topology/topology.json', metrics_file='/data/topology/metrics.json',
+                 device_metrics_limit=DEFAULT_DEVICE_METRICS_LIMIT):
         self.topology_file = topology_file
         self.metrics_file = metrics_file
+        self.device_metrics_limit = device_metrics_limit
         self.topology = {'nodes': {}, 'edges': [], 'updated': None}
         self.discovery_metrics = {}
-        self.metrics = ""
-        self.last_load_time = 0
-        self.reload_interval = 60  # 每 60 秒重新加载一次
+        self.render_count = 0
+        self.request_stats = RequestStats()
+        self.cycle_stats = DiscoveryCycleStats()
+        self.watch_interval = 0.5  # 检查数据文件变化的间隔（秒）
+        # 当前快照：数据、渲染好的文本/字节及其对应的数据版本
+        self.snapshot = {
+            'topology': self.topology,
+            'discovery_metrics': self.discovery_metrics,
+            'metrics': '',
+            'payload': b'',
+            'payload_gzip': b'',
+            'version': None,
+            'loaded_at': None
+        }
 
     def load_topology(self):
-        """加载拓扑数据"""
-        try:
-            if os.path.exists(self.topology_file):
-                with open(self.topology_file, 'r') as f:
-                    self.topology = json.load(f)
-                logger.info(f"加载拓扑数据: {len(self.topology.get('nodes', {}))} 个节点, "
-                           f"{len(self.topology.get('edges', []))} 条连接")
-                self.last_load_time = time.time()
-                return True
-            else:
-                logger.warning(f"拓扑文件不存在: {self.topology_file}")
-                return False
-        except Exception as e:
-            logger.error(f"加载拓扑数据失败: {e}")
-            return False
+        """加载拓扑数据（文件不存在返回 None，解析失败抛出异常）"""
+        if not os.path.exists(self.topology_file):
+            logger.warning(f"拓扑文件不存在: {self.topology_file}")
+            return None
+        # 自动识别快照格式；列式快照以只读视图加载，不为每个节点构造 dict
+        topology = read_topology(self.topology_file, lazy=True)
+        logger.info(f"加载拓扑数据: {len(topology.get('nodes', {}))} 个节点, "
+                    f"{len(topology.get('edges', []))} 条连接")
+        return topology
 
     def load_metrics(self):
-        """加载自身指标"""
+        """加载自身指标（文件不存在返回 None，解析失败抛出异常）"""
+        if not os.path.exists(self.metrics_file):
+            logger.warning(f"自身指标文件不存在: {self.metrics_file}")
+            return None
+        with open(self.metrics_file, 'r') as f:
+            discovery_metrics = json.load(f)
+        logger.debug(f"加载自身指标: {discovery_metrics}")
+        return discovery_metrics
+
+    def data_version(self):
+        """数据文件版本（mtime + 大小），文件未变化时无需重新加载和渲染"""
+        version = []
+        for path in (self.topology_file, self.metrics_file):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def reload(self):
+        """数据文件有变化时重新加载、渲染并原子替换快照，返回是否替换"""
+        version = self.data_version()
+        if version == self.snapshot['version']:
+            return False
+
         try:
-            if os.path.exists(self.metrics_file):
-                with open(self.metrics_file, 'r') as f:
-                    self.discovery_metrics = json.load(f)
-                logger.debug(f"加载自身指标: {self.discovery_metrics}")
-                return True
-            else:
-                logger.warning(f"自身指标文件不存在: {self.metrics_file}")
-                return False
+            topology = self.load_topology()
+            discovery_metrics = self.load_metrics()
         except Exception as e:
-            logger.error(f"加载自身指标失败: {e}")
+            # 多半是文件正在被写入，下一轮再试，继续提供旧快照
+            logger.error(f"加载拓扑数据失败: {e}")
             return False
+        if self.data_version() != version:
+            # 读取期间文件又发生了变化，下一轮重新读取
+            return False
+        if discovery_metrics is not None:
+            self.cycle_stats.observe(discovery_metrics)
+
+        previous = self.snapshot
+        snapshot = self.render(previous['topology'] if topology is None else topology,
+                               previous['discovery_metrics'] if discovery_metrics is None else discovery_metrics)
+        snapshot['version'] = version
+        self.snapshot = snapshot
+        self.topology, self.discovery_metrics = snapshot['topology'], snapshot['discovery_metrics']
+        return True
+
+    def watch(self):
+        """后台监视数据文件（stat 轮询），新拓扑在 watch_interval 内生效"""
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"重新加载拓扑数据失败: {e}")
+            time.sleep(self.watch_interval)
+
+    def start_watcher(self):
+        """启动后台监视线程"""
+        watcher = Thread(target=self.watch, name='topology-watcher', daemon=True)
+        watcher.start()
+        return watcher
 
     def generate_metrics(self):
-        """生成 Prometheus 格式的指标"""
-        # 检查是否需要重新加载
-        if time.time() - self.last_load_time > self.reload_interval:
-            self.load_topology()
-            self.load_metrics()
+        """返回 Prometheus 格式的指标文本（当前快照的预渲染结果）"""
+        return self.snapshot['metrics']
+
+    def get_payload(self, accept_gzip=False):
+        """返回预渲染的响应体：(bytes, 是否 gzip)，不会触发加载或渲染"""
+        snapshot = self.snapshot
+        if accept_gzip:
+            return snapshot['payload_gzip'], True
+        return snapshot['payload'], False
+
+    def render(self, topology, discovery_metrics):
+        """把数据渲染为 exposition 文本并缓存编码后的字节，返回新快照（每个数据版本只执行一次）"""
+        start = time.perf_counter()
+        metrics = self.render_lines(topology, discovery_metrics)
+        render_seconds = time.perf_counter() - start
+        loaded_at = time.time()
+
+        # 渲染自身指标（描述的是本次渲染）
+        self.render_count += 1
+        metrics.append("")
+        metrics.append("# HELP topology_exporter_render_seconds Time spent rendering the metrics payload")
+        metrics.append("# TYPE topology_exporter_render_seconds gauge")
+        metrics.append(f"topology_exporter_render_seconds {render_seconds:.6f}")
+        metrics.append("")
+        metrics.append("# HELP topology_exporter_renders_total Number of times the metrics payload was rendered")
+        metrics.append("# TYPE topology_exporter_renders_total counter")
+        metrics.append(f"topology_exporter_renders_total {self.render_count}")
+        metrics.append("")
+        metrics.append("# HELP topology_exporter_snapshot_timestamp_seconds Time the current snapshot was loaded")
+        metrics.append("# TYPE topology_exporter_snapshot_timestamp_seconds gauge")
+        metrics.append(f"topology_exporter_snapshot_timestamp_seconds {loaded_at:.3f}")
 
+        text = '\n'.join(metrics) + '\n'
+        payload = text.encode('utf-8')
+        payload_gzip = gzip.compress(payload, compresslevel=6, mtime=0)
+        logger.debug(f"指标已渲染: {len(payload)} 字节（gzip {len(payload_gzip)} 字节），耗时 {render_seconds:.3f} 秒")
+
+        return {
+            'topology': topology,
+            'discovery_metrics': discovery_metrics,
+            'metrics': text,
+            'payload': payload,
+            'payload_gzip': payload_gzip,
+            'version': None,
+            'loaded_at': loaded_at
+        }
+
+    def render_lines(self, topology, discovery_metrics):
+        """生成 Prometheus 格式的指标行"""
         metrics = []
 
         # ========== 拓扑指标 ==========
@@ -78,7 +203,7 @@ class TopologyExporter:
         metrics.append("# TYPE topology_device_info gauge")
 
         # 设备节点指标
-        for device_name, node in self.topology.get('nodes', {}).items():
+        for device_name, node in topology.get('nodes', {}).items():
             labels = {
                 'device_name': device_name,
                 'device_type': node.get('type', 'unknown'),
@@ -97,7 +222,7 @@ class TopologyExporter:
         metrics.append("# HELP topology_connection Network device connections")
         metrics.append("# TYPE topology_connection gauge")
 
-        for edge in self.topology.get('edges', []):
+        for edge in topology.get('edges', []):
             labels = {
                 'source_device': edge.get('source', 'unknown'),
                 'target_device': edge.get('target', 'unknown'),
@@ -113,128 +238,596 @@ class TopologyExporter:
         metrics.append("")
         metrics.append("# HELP topology_devices_total Total number of devices")
         metrics.append("# TYPE topology_devices_total gauge")
-        metrics.append(f"topology_devices_total {len(self.topology.get('nodes', {}))}")
+        metrics.append(f"topology_devices_total {len(topology.get('nodes', {}))}")
 
         metrics.append("")
         metrics.append("# HELP topology_connections_total Total number of connections")
         metrics.append("# TYPE topology_connections_total gauge")
-        metrics.append(f"topology_connections_total {len(self.topology.get('edges', []))}")
+        metrics.append(f"topology_connections_total {len(topology.get('edges', []))}")
 
         # ========== 自身指标 ==========
         metrics.append("")
         metrics.append("# HELP topology_discovery_duration_seconds Discovery duration in seconds")
         metrics.append("# TYPE topology_discovery_duration_seconds gauge")
-        metrics.append(f"topology_discovery_duration_seconds {self.discovery_metrics.get('discovery_duration_seconds', 0)}")
+        metrics.append(f"topology_discovery_duration_seconds {discovery_metrics.get('discovery_duration_seconds', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_devices_discovered Total devices discovered")
         metrics.append("# TYPE topology_devices_discovered gauge")
-        metrics.append(f"topology_devices_discovered {self.discovery_metrics.get('devices_discovered', 0)}")
+        metrics.append(f"topology_devices_discovered {discovery_metrics.get('devices_discovered', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_devices_failed Total devices failed")
         metrics.append("# TYPE topology_devices_failed gauge")
-        metrics.append(f"topology_devices_failed {self.discovery_metrics.get('devices_failed', 0)}")
+        metrics.append(f"topology_devices_failed {discovery_metrics.get('devices_failed', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_lldp_neighbors Total LLDP neighbors")
         metrics.append("# TYPE topology_lldp_neighbors gauge")
-        metrics.append(f"topology_lldp_neighbors {self.discovery_metrics.get('lldp_neighbors', 0)}")
+        metrics.append(f"topology_lldp_neighbors {discovery_metrics.get('lldp_neighbors', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_cdp_neighbors Total CDP neighbors")
         metrics.append("# TYPE topology_cdp_neighbors gauge")
-        metrics.append(f"topology_cdp_neighbors {self.discovery_metrics.get('cdp_neighbors', 0)}")
+        metrics.append(f"topology_cdp_neighbors {discovery_metrics.get('cdp_neighbors', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_ndp_neighbors Total NDP neighbors")
         metrics.append("# TYPE topology_ndp_neighbors gauge")
-        metrics.append(f"topology_ndp_neighbors {self.discovery_metrics.get('ndp_neighbors', 0)}")
+        metrics.append(f"topology_ndp_neighbors {discovery_metrics.get('ndp_neighbors', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_lnp_neighbors Total LNP neighbors")
         metrics.append("# TYPE topology_lnp_neighbors gauge")
-        metrics.append(f"topology_lnp_neighbors {self.discovery_metrics.get('lnp_neighbors', 0)}")
+        metrics.append(f"topology_lnp_neighbors {discovery_metrics.get('lnp_neighbors', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_snmp_errors Total SNMP errors")
         metrics.append("# TYPE topology_snmp_errors counter")
-        metrics.append(f"topology_snmp_errors {self.discovery_metrics.get('snmp_errors', 0)}")
+        metrics.append(f"topology_snmp_errors {discovery_metrics.get('snmp_errors', 0)}")
+
+        metrics.append("")
+        metrics.append("# HELP topology_snmp_errors_by_reason SNMP errors by reason")
+        metrics.append("# TYPE topology_snmp_errors_by_reason counter")
+        for reason, count in sorted(discovery_metrics.get('snmp_errors_by_reason', {}).items()):
+            metrics.append(f'topology_snmp_errors_by_reason{{reason="{reason}"}} {count}')
+
+        metrics.append("")
+        metrics.append("# HELP topology_snmp_errors_by_device SNMP errors by device")
+        metrics.append("# TYPE topology_snmp_errors_by_device counter")
+        for device, count in sorted(discovery_metrics.get('snmp_errors_by_device', {}).items()):
+            metrics.append(f'topology_snmp_errors_by_device{{device_name="{device}"}} {count}')
+
+        metrics.append("")
+        metrics.append("# HELP topology_devices_circuit_open Devices skipped by the SNMP circuit breaker")
+        metrics.append("# TYPE topology_devices_circuit_open gauge")
+        metrics.append(f"topology_devices_circuit_open {discovery_metrics.get('devices_circuit_open', 0)}")
+
+        metrics.append("")
+        metrics.append("# HELP topology_discovery_protocol_probes Protocol capability probes (one GETNEXT per device) in the last cycle")
+        metrics.append("# TYPE topology_discovery_protocol_probes gauge")
+        metrics.append(f"topology_discovery_protocol_probes {discovery_metrics.get('protocol_probes', 0)}")
+
+        metrics.append("")
+        metrics.append("# HELP topology_discovery_protocol_walks_skipped Neighbor table walks skipped for unsupported protocols")
+        metrics.append("# TYPE topology_discovery_protocol_walks_skipped gauge")
+        metrics.append(f"topology_discovery_protocol_walks_skipped {discovery_metrics.get('protocol_walks_skipped', 0)}")
+
+        metrics.append("")
+        metrics.append("# HELP topology_discovery_protocol_overlap_ports Local ports reported by more than one protocol in merged collection")
+        metrics.append("# TYPE topology_discovery_protocol_overlap_ports gauge")
+        metrics.append(f"topology_discovery_protocol_overlap_ports {discovery_metrics.get('protocol_overlap_ports', 0)}")
+
+        metrics.append("")
+        metrics.append("# HELP topology_discovery_protocol_overlap_conflicts Overlapping local ports whose neighbors differ between protocols")
+        metrics.append("# TYPE topology_discovery_protocol_overlap_conflicts gauge")
+        metrics.append(f"topology_discovery_protocol_overlap_conflicts {discovery_metrics.get('protocol_overlap_conflicts', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_lacp_links Total LACP aggregation links")
         metrics.append("# TYPE topology_lacp_links gauge")
-        metrics.append(f"topology_lacp_links {self.discovery_metrics.get('lacp_links', 0)}")
+        metrics.append(f"topology_lacp_links {discovery_metrics.get('lacp_links', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_loops_detected Total network loops detected")
         metrics.append("# TYPE topology_loops_detected gauge")
-        metrics.append(f"topology_loops_detected {self.discovery_metrics.get('loops_detected', 0)}")
+        metrics.append(f"topology_loops_detected {discovery_metrics.get('loops_detected', 0)}")
 
         metrics.append("")
         metrics.append("# HELP topology_topology_changes Total topology changes detected")
         metrics.append("# TYPE topology_topology_changes gauge")
-        metrics.append(f"topology_topology_changes {self.discovery_metrics.get('topology_changes', 0)}")
+        metrics.append(f"topology_topology_changes {discovery_metrics.get('topology_changes', 0)}")
 
         # 计算成功率
-        total = self.discovery_metrics.get('devices_discovered', 0) + self.discovery_metrics.get('devices_failed', 0)
-        success_rate = (self.discovery_metrics.get('devices_discovered', 0) / total * 100) if total > 0 else 0
+        total = discovery_metrics.get('devices_discovered', 0) + discovery_metrics.get('devices_failed', 0)
+        success_rate = (discovery_metrics.get('devices_discovered', 0) / total * 100) if total > 0 else 0
         
         metrics.append("")
         metrics.append("# HELP topology_discovery_success_rate Discovery success rate percentage")
         metrics.append("# TYPE topology_discovery_success_rate gauge")
         metrics.append(f"topology_discovery_success_rate {success_rate:.2f}")
 
-        self.metrics = '\n'.join(metrics)
-        return self.metrics
+        # 最近一轮各阶段耗时
+        metrics.append("")
+        metrics.append("# HELP topology_discovery_phase_last_seconds Time spent in each discovery phase in the last cycle")
+        metrics.append("# TYPE topology_discovery_phase_last_seconds gauge")
+        for phase, seconds in sorted(discovery_metrics.get('phase_seconds', {}).items()):
+            metrics.append(f'topology_discovery_phase_last_seconds{{phase="{phase}"}} {seconds}')
+
+        # 跨轮累积的阶段耗时和设备采集耗时直方图
+        metrics.extend(self.cycle_stats.render_lines())
+
+        # 按设备/协议的采集统计
+        metrics.extend(self.render_device_stats(discovery_metrics.get('device_stats', {})))
+
+        return metrics
+
+    def render_device_stats(self, device_stats):
+        """按协议和厂商汇总全部设备；带 device_name 标签的序列只输出最慢的 device_metrics_limit 台设备"""
+        totals = defaultdict(lambda: defaultdict(float))   # (协议, 厂商) -> 字段 -> 合计
+        for entry in device_stats.values():
+            vendor = entry.get('vendor', 'unknown')
+            for protocol, stats in entry.get('protocols', {}).items():
+                total = totals[(protocol, vendor)]
+                total['devices'] += 1
+                for field, _ in COLLECTION_STAT_METRICS:
+                    total[field] += stats.get(field, 0)
+
+        lines = []
+        for field, description in COLLECTION_STAT_METRICS:
+            name = f"topology_discovery_protocol_{field}"
+            lines.append("")
+            lines.append(f"# HELP {name} {description}, summed over all devices by protocol and vendor")
+            lines.append(f"# TYPE {name} gauge")
+            for (protocol, vendor), total in sorted(totals.items()):
+                lines.append(f'{name}{{protocol="{protocol}",vendor="{vendor}"}} {total[field]:g}')
+        lines.append("")
+        lines.append("# HELP topology_discovery_protocol_devices Devices that collected each protocol by vendor")
+        lines.append("# TYPE topology_discovery_protocol_devices gauge")
+        for (protocol, vendor), total in sorted(totals.items()):
+            lines.append(f'topology_discovery_protocol_devices{{protocol="{protocol}",vendor="{vendor}"}} '
+                         f'{total["devices"]:g}')
+
+        slowest = sorted(device_stats.items(), key=lambda item: (-item[1].get('duration_seconds', 0), item[0]))
+        slowest = slowest[:max(self.device_metrics_limit, 0)]
+        lines.append("")
+        lines.append("# HELP topology_discovery_device_metrics_omitted Devices left out of the per-device series "
+                     "by the cardinality limit")
+        lines.append("# TYPE topology_discovery_device_metrics_omitted gauge")
+        lines.append(f"topology_discovery_device_metrics_omitted {len(device_stats) - len(slowest)}")
+        if not slowest:
+            return lines
+
+        lines.append("")
+        lines.append("# HELP topology_discovery_device_duration_seconds Time spent in the last collection of the device")
+        lines.append("# TYPE topology_discovery_device_duration_seconds gauge")
+        for device_name, entry in slowest:
+            lines.append(f'topology_discovery_device_duration_seconds{{device_name="{device_name}",'
+                         f'vendor="{entry.get("vendor", "unknown")}"}} {entry.get("duration_seconds", 0)}')
+        for field, description in COLLECTION_STAT_METRICS:
+            name = f"topology_discovery_device_protocol_{field}"
+            lines.append("")
+            lines.append(f"# HELP {name} {description} in the last collection of the device, by protocol")
+            lines.append(f"# TYPE {name} gauge")
+            for device_name, entry in slowest:
+                vendor = entry.get('vendor', 'unknown')
+                for protocol, stats in sorted(entry.get('protocols', {}).items()):
+                    lines.append(f'{name}{{device_name="{device_name}",protocol="{protocol}",vendor="{vendor}"}} '
+                                 f'{stats.get(field, 0)}')
+        return lines
 
     def health_check(self):
         """健康检查"""
+        topology = self.snapshot['topology']
         return {
             'status': 'healthy',
-            'topology_updated': self.topology.get('updated'),
-            'nodes': len(self.topology.get('nodes', {})),
-            'edges': len(self.topology.get('edges', {}))
+            'topology_updated': topology.get('updated'),
+            'nodes': len(topology.get('nodes', {})),
+            'edges': len(topology.get('edges', {}))
         }
 
+# 请求耗时直方图的桶上界（秒）
+REQUEST_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 只为已知端点单独计数，其余路径归入 other，避免标签基数随路径膨胀
+KNOWN_ENDPOINTS = ('/metrics', '/health')
+
+# 发现流程各阶段耗时直方图的桶上界（秒）
+PHASE_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def histogram_lines(name, bounds, counts, total, count, labels=''):
+    """直方图的 exposition 行：counts 为与 bounds 对应的各桶（不累积）计数"""
+    prefix = f'{labels},' if labels else ''
+    suffix = f'{{{labels}}}' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(bounds, counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {count}')
+    lines.append(f'{name}_sum{suffix} {total:.6f}')
+    lines.append(f'{name}_count{suffix} {count}')
+    return lines
+
+
+class DiscoveryCycleStats:
+    """累积每轮发现的阶段耗时和单设备采集耗时
+
+    metrics.json 每轮整体覆盖写出，只包含本轮的数据；这里以 end_time 区分轮次，
+    每轮只累加一次，得到可以用 rate()/histogram_quantile() 计算的直方图。
+    """
+
+    def __init__(self, buckets=PHASE_DURATION_BUCKETS):
+        self.buckets = buckets
+        self.cycles = 0
+        self.last_cycle = None
+        self.phases = {}            # 阶段 -> [各桶计数..., 超出最大桶的计数, 总耗时, 总数]
+        self.device_buckets = {}    # 桶上界 -> 累计次数（桶上界取自 metrics.json）
+        self.device_sum = 0.0
+        self.device_count = 0
+
+    def observe(self, discovery_metrics):
+        """累加一轮发现的数据，同一轮的指标重复加载时忽略，返回是否为新的一轮"""
+        cycle = discovery_metrics.get('end_time')
+        if cycle is None or cycle == self.last_cycle:
+            return False
+        self.last_cycle = cycle
+        self.cycles += 1
+
+        for phase, seconds in discovery_metrics.get('phase_seconds', {}).items():
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = [0] * (len(self.buckets) + 3)
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+        device = discovery_metrics.get('device_collection_seconds') or {}
+        for bound, count in device.get('buckets', {}).items():
+            if bound != '+Inf':
+                self.device_buckets[float(bound)] = self.device_buckets.get(float(bound), 0) + count
+        self.device_sum += device.get('sum', 0)
+        self.device_count += device.get('count', 0)
+        return True
+
+    def render_lines(self):
+        lines = ["",
+                 "# HELP topology_discovery_cycles_total Discovery cycles observed by the exporter",
+                 "# TYPE topology_discovery_cycles_total counter",
+                 f"topology_discovery_cycles_total {self.cycles}"]
+
+        lines.append("")
+        lines.append("# HELP topology_discovery_phase_seconds Time spent in each discovery phase per cycle")
+        lines.append("# TYPE topology_discovery_phase_seconds histogram")
+        for phase, histogram in sorted(self.phases.items()):
+            lines.extend(histogram_lines('topology_discovery_phase_seconds', self.buckets, histogram,
+                                         histogram[-2], histogram[-1], f'phase="{phase}"'))
+
+        lines.append("")
+        lines.append("# HELP topology_discovery_device_collection_seconds Time spent collecting neighbors per device")
+        lines.append("# TYPE topology_discovery_device_collection_seconds histogram")
+        bounds = sorted(self.device_buckets)
+        lines.extend(histogram_lines('topology_discovery_device_collection_seconds', bounds,
+                                     [self.device_buckets[bound] for bound in bounds],
+                                     self.device_sum, self.device_count))
+        return lines
+
+
+class RequestStats:
+    """按端点统计请求数（按状态码）和耗时直方图，供 /metrics 实时输出"""
+
+    def __init__(self, buckets=REQUEST_DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.requests = defaultdict(int)    # (端点, 状态码) -> 请求数
+        self.histograms = {}                # 端点 -> [各桶计数..., 超出最大桶的计数, 总耗时, 总数]
+        self.in_flight = 0
+        self.rejected = 0
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def observe(self, endpoint, code, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[(endpoint, code)] += 1
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = [0] * (len(self.buckets) + 3)
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def render(self):
+        """渲染为 exposition 文本（体积很小，每次抓取实时生成）"""
+        with self.lock:
+            requests = sorted(self.requests.items())
+            histograms = {endpoint: list(h) for endpoint, h in sorted(self.histograms.items())}
+            in_flight, rejected = self.in_flight, self.rejected
+
+        lines = ["",
+                 "# HELP topology_exporter_http_requests_total HTTP requests served by endpoint and status code",
+                 "# TYPE topology_exporter_http_requests_total counter"]
+        for (endpoint, code), count in requests:
+            lines.append(f'topology_exporter_http_requests_total{{endpoint="{endpoint}",code="{code}"}} {count}')
+
+        lines.append("")
+        lines.append("# HELP topology_exporter_http_request_duration_seconds HTTP request latency by endpoint")
+        lines.append("# TYPE topology_exporter_http_request_duration_seconds histogram")
+        for endpoint, histogram in histograms.items():
+            lines.extend(histogram_lines('topology_exporter_http_request_duration_seconds', self.buckets, histogram,
+                                         histogram[-2], histogram[-1], f'endpoint="{endpoint}"'))
+
+        lines.append("")
+        lines.append("# HELP topology_exporter_http_requests_in_flight HTTP requests currently being served")
+        lines.append("# TYPE topology_exporter_http_requests_in_flight gauge")
+        lines.append(f"topology_exporter_http_requests_in_flight {in_flight}")
+        lines.append("")
+        lines.append("# HELP topology_exporter_http_connections_rejected_total Connections rejected because the server was saturated or the client hit its connection limit")
+        lines.append("# TYPE topology_exporter_http_connections_rejected_total counter")
+        lines.append(f"topology_exporter_http_connections_rejected_total {rejected}")
+        return '\n'.join(lines) + '\n'
+
+
+class DeadlineSocketReader(io.RawIOBase):
+    """按绝对截止时间读取 socket：每次 recv 前把 socket 超时设为剩余时间
+
+    socket 超时只限制单次 recv，逐字节慢速发送的客户端可以无限期占用线程；
+    这里保证读完请求行和请求头的总时间不超过截止时间。
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('request read deadline exceeded')
+            self.sock.settimeout(remaining)
+        return self.sock.recv_into(buffer)
+
+
 class MetricsHandler(BaseHTTPRequestHandler):
-    """HTTP 请求处理器"""
+    """HTTP 请求处理器
+
+    使用 HTTP/1.1 keep-alive（每个响应都带 Content-Length）。连接上的时间都有上限：
+    - 第一个请求的请求行和请求头必须在 header_timeout 内读完（总时间，不是单次 recv）
+    - keep-alive 连接上的后续请求必须在 idle_timeout 内到达并读完
+    - 写响应受 request_timeout 限制；连接存在超过 connection_lifetime 后不再接受新请求
+    """
+
+    protocol_version = 'HTTP/1.1'
 
     def __init__(self, exporter, *args, **kwargs):
         self.exporter = exporter
+        self.status_code = None
+        self.requests_handled = 0
         super().__init__(*args, **kwargs)
 
+    def setup(self):
+        super().setup()
+        self.connection_deadline = time.monotonic() + self.server.connection_lifetime
+        self.reader = DeadlineSocketReader(self.connection)
+        self.rfile = io.BufferedReader(self.reader)
+
+    def handle_one_request(self):
+        now = time.monotonic()
+        remaining = self.connection_deadline - now
+        if remaining <= 0:
+            self.close_connection = True
+            return
+        wait = self.server.idle_timeout if self.requests_handled else self.server.header_timeout
+        self.reader.deadline = now + min(wait, remaining)
+        super().handle_one_request()
+        self.requests_handled += 1
+
+    def parse_request(self):
+        """请求头读完后取消读截止时间，写响应改用 request_timeout"""
+        parsed = super().parse_request()
+        self.reader.deadline = None
+        self.connection.settimeout(self.server.request_timeout)
+        return parsed
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
     def do_GET(self):
-        """处理 GET 请求"""
-        if self.path == '/metrics':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain; charset=utf-8')
-            self.end_headers()
-            metrics = self.exporter.generate_metrics()
-            self.wfile.write(metrics.encode('utf-8'))
-        elif self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            health = self.exporter.health_check()
-            self.wfile.write(json.dumps(health).encode('utf-8'))
-        else:
-            self.send_response(404)
-            self.end_headers()
+        """处理 GET 请求，并按端点记录请求数和耗时"""
+        start = time.perf_counter()
+        stats = self.exporter.request_stats
+        path = self.path.split('?', 1)[0]
+        endpoint = path if path in KNOWN_ENDPOINTS else 'other'
+        stats.begin()
+        try:
+            if path == '/metrics':
+                self.send_metrics()
+            elif path == '/health':
+                body = json.dumps(self.exporter.health_check()).encode('utf-8')
+                self.send_body(200, 'application/json', body)
+            else:
+                self.send_body(404, 'text/plain; charset=utf-8', b'not found\n')
+        finally:
+            stats.observe(endpoint, self.status_code or 500, time.perf_counter() - start)
+
+    def send_metrics(self):
+        accept_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        payload, gzipped = self.exporter.get_payload(accept_gzip)
+        # 请求统计每次实时渲染后追加在缓存的响应体之后；
+        # gzip 时单独压缩成一个 member 拼接（多 member 的 gzip 流是合法的），大块缓存无需重新压缩
+        tail = self.exporter.request_stats.render().encode('utf-8')
+        if gzipped:
+            tail = gzip.compress(tail, compresslevel=6, mtime=0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(payload) + len(tail)))
+        self.end_headers()
+        # 直接写出缓存的字节，不再逐次拼接/编码
+        self.wfile.write(payload)
+        self.wfile.write(tail)
+
+    def send_body(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def log_message(self, format, *args):
         """禁用默认日志"""
         pass
 
-def start_exporter(exporter, port=9700):
+
+class BoundedThreadingHTTPServer(HTTPServer):
+    """有界线程池 HTTP 服务器
+
+    每个连接交给固定大小线程池中的一个线程处理，慢客户端只占用自己的线程，
+    不会阻塞其他抓取；排队连接数超过上限时直接返回 503 并关闭，内存和线程数都有上界。
+    新连接先由分发线程等待可读，收到数据后才交给线程池：只建连不发请求的客户端不占用工作线程，
+    header_timeout 内没有数据就关闭。进入线程池后占用线程的时间有绝对上限（见 MetricsHandler），
+    单个客户端 IP 同时持有的连接数不超过 max_client_connections。
+    """
+
+    request_queue_size = 128
+    reject_response = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self, server_address, handler_class, stats, workers=16, max_pending=64, request_timeout=10,
+                 header_timeout=2, idle_timeout=1, connection_lifetime=60, max_client_connections=32):
+        super().__init__(server_address, handler_class)
+        self.stats = stats
+        self.request_timeout = request_timeout
+        self.header_timeout = header_timeout
+        self.idle_timeout = idle_timeout
+        self.connection_lifetime = connection_lifetime
+        self.max_client_connections = max_client_connections
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='exporter-http')
+        self.slots = BoundedSemaphore(workers + max_pending)
+        self.client_lock = Lock()
+        self.client_connections = defaultdict(int)
+        self.waiting = selectors.DefaultSelector()
+        self.waiting_lock = Lock()
+        self.dispatcher = Thread(target=self.dispatch_ready, name='exporter-dispatch', daemon=True)
+        self.dispatcher.start()
+
+    def acquire_client(self, host):
+        with self.client_lock:
+            if self.client_connections[host] >= self.max_client_connections:
+                return False
+            self.client_connections[host] += 1
+            return True
+
+    def release_client(self, host):
+        with self.client_lock:
+            self.client_connections[host] -= 1
+            if not self.client_connections[host]:
+                del self.client_connections[host]
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.stats.reject()
+            self.reject_request(request)
+            return
+        if not self.acquire_client(client_address[0]):
+            self.slots.release()
+            self.stats.reject()
+            self.reject_request(request)
+            return
+        with self.waiting_lock:
+            self.waiting.register(request, selectors.EVENT_READ,
+                                  (client_address, time.monotonic() + self.header_timeout))
+
+    def dispatch_ready(self):
+        """等待新连接可读后提交到线程池，超过 header_timeout 仍无数据的连接直接关闭"""
+        while True:
+            # 注册发生在 accept 线程，select 超时较短以便及时纳入新连接
+            try:
+                ready = self.waiting.select(timeout=0.05) if self.waiting.get_map() else None
+            except (OSError, ValueError):
+                return
+            if ready is None:
+                time.sleep(0.05)
+                continue
+            now = time.monotonic()
+            ready_socks = {key.fileobj for key, _ in ready}
+            with self.waiting_lock:
+                if self.waiting.get_map() is None:
+                    return
+                expired = [key for key in self.waiting.get_map().values()
+                           if key.fileobj not in ready_socks and key.data[1] <= now]
+                for key in [key for key, _ in ready] + expired:
+                    self.waiting.unregister(key.fileobj)
+            for key, _ in ready:
+                key.fileobj.settimeout(self.request_timeout)
+                self.executor.submit(self.process_request_thread, key.fileobj, key.data[0])
+            for key in expired:
+                self.close_waiting(key.fileobj, key.data[0])
+
+    def close_waiting(self, request, client_address):
+        self.shutdown_request(request)
+        self.release_client(client_address[0])
+        self.slots.release()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.close_waiting(request, client_address)
+
+    def reject_request(self, request):
+        # 在 accept 线程上执行，只做非阻塞发送，发不出去就直接关闭
+        try:
+            request.setblocking(False)
+            request.send(self.reject_response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        # 客户端超时/断开属于正常情况，不打印堆栈
+        logger.debug(f"处理 {client_address[0]} 的请求出错", exc_info=True)
+
+    def server_close(self):
+        super().server_close()
+        with self.waiting_lock:
+            waiting = list(self.waiting.get_map().values())
+            self.waiting.close()
+        for key in waiting:
+            self.shutdown_request(key.fileobj)
+        self.executor.shutdown(wait=False)
+
+
+def start_exporter(exporter, port=9700, workers=16, request_timeout=10, header_timeout=2, idle_timeout=1,
+                   connection_lifetime=60, max_client_connections=32):
     """启动 HTTP 服务器"""
     server_address = ('', port)
     
     def handler(*args, **kwargs):
         MetricsHandler(exporter, *args, **kwargs)
     
-    httpd = HTTPServer(server_address, handler)
-    logger.info(f"Topology Exporter 启动在端口 {port}")
+    httpd = BoundedThreadingHTTPServer(server_address, handler, exporter.request_stats,
+                                       workers=workers, request_timeout=request_timeout,
+                                       header_timeout=header_timeout, idle_timeout=idle_timeout,
+                                       connection_lifetime=connection_lifetime,
+                                       max_client_connections=max_client_connections)
+    logger.info(f"Topology Exporter 启动在端口 {port}（{workers} 个工作线程，请求头超时 {header_timeout} 秒，"
+                f"写响应超时 {request_timeout} 秒，空闲超时 {idle_timeout} 秒，连接最长 {connection_lifetime} 秒，"
+                f"单客户端最多 {max_client_connections} 个连接）")
     logger.info(f"  指标端点: http://localhost:{port}/metrics")
     logger.info(f"  健康检查: http://localhost:{port}/health")
     httpd.serve_forever()
@@ -243,11 +836,26 @@ def main():
     """主函数"""
     exporter = TopologyExporter(
         topology_file='/data/topology/topology.json',
-        metrics_file='/data/topology/metrics.json'
+        metrics_file='/data/topology/metrics.json',
+        device_metrics_limit=int(os.environ.get('EXPORTER_DEVICE_METRICS_LIMIT', DEFAULT_DEVICE_METRICS_LIMIT))
     )
-    
+
+    # 先同步加载一次，之后由后台线程监视文件变化
+    exporter.reload()
+    exporter.start_watcher()
+
     # 启动 HTTP 服务器
-    server_thread = Thread(target=start_exporter, args=(exporter, 9700), daemon=True)
+    port = int(os.environ.get('EXPORTER_PORT', 9700))
+    workers = int(os.environ.get('EXPORTER_WORKERS', 16))
+    request_timeout = float(os.environ.get('EXPORTER_REQUEST_TIMEOUT', 10))
+    header_timeout = float(os.environ.get('EXPORTER_HEADER_TIMEOUT', 2))
+    idle_timeout = float(os.environ.get('EXPORTER_IDLE_TIMEOUT', 1))
+    connection_lifetime = float(os.environ.get('EXPORTER_CONNECTION_LIFETIME', 60))
+    max_client_connections = int(os.environ.get('EXPORTER_MAX_CLIENT_CONNECTIONS', 32))
+    server_thread = Thread(target=start_exporter,
+                           args=(exporter, port, workers, request_timeout, header_timeout, idle_timeout,
+                                 connection_lifetime, max_client_connections),
+                           daemon=True)
     server_thread.start()
     
     # 保持运行
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+拓扑快照格式
+功能：topology.json 的读写（发现脚本写出，Exporter / 变化检测 / 层级报告读取），
+以及所有输出文件的原子写入（临时文件 + fsync + rename，内容未变化时跳过）
+
+支持三种格式，文件名保持不变，读取方根据内容自动识别：
+- json:    原有的缩进 JSON（默认，兼容所有现有消费方）
+- compact: 紧凑 JSON，节点/连接按列存储（每个字段一个数组，不再为每个节点重复键名）
+- msgpack: 与 compact 相同的列式结构，使用 msgpack 二进制编码（需要安装 msgpack）
+
+列式快照带有 format / version 头，读取方只接受自己认识的版本；
+读取时可以选择惰性视图（lazy=True），只保留列数组，按需构造单个节点/连接的 dict。
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from collections.abc import Mapping, Sequence
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMATS = ('json', 'compact', 'msgpack')
+DEFAULT_SNAPSHOT_FORMAT = 'json'
+
+COLUMNAR_FORMAT = 'topology-columnar'
+COLUMNAR_VERSION = 1
+
+
+# 已写出文件的内容摘要：路径 -> (sha256, mtime_ns, 大小)，stat 未变化时无需重新读取文件比较
+_written_digests = {}
+_written_lock = threading.Lock()
+
+
+class SnapshotFormatError(Exception):
+    """快照格式无法识别或版本不受支持"""
+
+
+def msgpack_module():
+    """msgpack 为可选依赖，未安装时返回 None"""
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def resolve_format(snapshot_format):
+    """写出前确认格式可用：未安装 msgpack 时退回 compact，读取方仍能识别"""
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"未知的快照格式: {snapshot_format}")
+    if snapshot_format == 'msgpack' and msgpack_module() is None:
+        logger.warning("未安装 msgpack，拓扑快照改用 compact 格式")
+        return 'compact'
+    return snapshot_format
+
+
+def to_columns(rows):
+    """把 dict 列表转成列：所有行都有的字段存为数组，其余字段存为 {行号: 值}"""
+    order = {}
+    counts = {}
+    for row in rows:
+        for key in row:
+            order.setdefault(key, len(order))
+            counts[key] = counts.get(key, 0) + 1
+
+    columns = {}
+    sparse = {}
+    for key in order:
+        if counts[key] == len(rows):
+            columns[key] = [row[key] for row in rows]
+        else:
+            sparse[key] = {str(i): row[key] for i, row in enumerate(rows) if key in row}
+    return {'count': len(rows), 'columns': columns, 'sparse': sparse}
+
+
+def encode_columnar(topology):
+    """拓扑 dict -> 列式快照 dict（nodes/edges 以外的字段原样保留）"""
+    nodes = topology.get('nodes', {})
+    snapshot = {
+        'format': COLUMNAR_FORMAT,
+        'version': COLUMNAR_VERSION,
+    }
+    for key, value in topology.items():
+        if key not in ('nodes', 'edges'):
+            snapshot[key] = value
+    snapshot['nodes'] = to_columns(list(nodes.values()))
+    snapshot['nodes']['names'] = list(nodes)
+    snapshot['edges'] = to_columns(topology.get('edges', []))
+    return snapshot
+
+
+def encode_topology(topology, snapshot_format=DEFAULT_SNAPSHOT_FORMAT):
+    """按指定格式编码拓扑，返回 bytes"""
+    if snapshot_format == 'json':
+        return json.dumps(topology, indent=2, ensure_ascii=False).encode('utf-8')
+    snapshot = encode_columnar(topology)
+    if snapshot_format == 'msgpack':
+        return msgpack_module().packb(snapshot, use_bin_type=True)
+    return json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ColumnarTable:
+    """列式存储的一组行，按行号构造单行 dict"""
+
+    def __init__(self, data):
+        self.count = data.get('count', 0)
+        self.columns = data.get('columns', {})
+        # JSON 的对象键只能是字符串，msgpack 解码出来可能是整数，统一成整数
+        self.sparse = {key: {int(i): value for i, value in values.items()}
+                       for key, values in data.get('sparse', {}).items()}
+
+    def row(self, i):
+        row = {key: values[i] for key, values in self.columns.items()}
+        for key, values in self.sparse.items():
+            if i in values:
+                row[key] = values[i]
+        return row
+
+    def rows(self):
+        return [self.row(i) for i in range(self.count)]
+
+
+class ColumnarNodes(Mapping):
+    """节点的只读映射视图（设备名 -> 节点 dict），按需构造"""
+
+    def __init__(self, data):
+        self.table = ColumnarTable(data)
+        self.names = data.get('names', [])
+        self._positions = None
+
+    def __getitem__(self, name):
+        if self._positions is None:
+            self._positions = {name: i for i, name in enumerate(self.names)}
+        return self.table.row(self._positions[name])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        # 顺序遍历时不需要建立名称索引
+        return ((name, self.table.row(i)) for i, name in enumerate(self.names))
+
+    def values(self):
+        return (self.table.row(i) for i in range(len(self.names)))
+
+
+class ColumnarEdges(Sequence):
+    """连接的只读序列视图，按需构造"""
+
+    def __init__(self, data):
+        self.table = ColumnarTable(data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.table.row(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.table.row(i)
+
+    def __len__(self):
+        return self.table.count
+
+
+def decode_columnar(snapshot, lazy=False):
+    """列式快照 dict -> 拓扑（lazy=True 时 nodes/edges 为只读视图）"""
+    if snapshot.get('version') != COLUMNAR_VERSION:
+        raise SnapshotFormatError(f"不支持的拓扑快照版本: {snapshot.get('version')}")
+    topology = {key: value for key, value in snapshot.items()
+                if key not in ('format', 'version', 'nodes', 'edges')}
+    nodes = ColumnarNodes(snapshot.get('nodes', {}))
+    edges = ColumnarEdges(snapshot.get('edges', {}))
+    if lazy:
+        topology['nodes'], topology['edges'] = nodes, edges
+    else:
+        topology['nodes'] = dict(nodes.items())
+        topology['edges'] = edges.table.rows()
+    return topology
+
+
+def decode_topology(data, lazy=False):
+    """根据内容识别格式并解码（JSON 以 '{' 开头，否则按 msgpack 处理）"""
+    if data[:1] in (b'{', b' ', b'\n', b'\r', b'\t'):
+        snapshot = json.loads(bytes(data))
+    else:
+        msgpack = msgpack_module()
+        if msgpack is None:
+            raise SnapshotFormatError("拓扑快照是 msgpack 格式，但未安装 msgpack")
+        # 直接从缓冲区（mmap）解码，不额外复制整个文件
+        snapshot = msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    if not isinstance(snapshot, dict):
+        raise SnapshotFormatError("拓扑快照内容不是对象")
+    if 'format' not in snapshot:
+        return snapshot
+    if snapshot['format'] != COLUMNAR_FORMAT:
+        raise SnapshotFormatError(f"未知的拓扑快照格式: {snapshot['format']}")
+    return decode_columnar(snapshot, lazy)
+
+
+def read_topology(path, lazy=False):
+    """读取拓扑快照（任意格式），文件通过 mmap 映射后解码"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise SnapshotFormatError(f"拓扑文件为空: {path}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_topology(data, lazy)
+
+
+def file_unchanged(path, digest, size):
+    """目标文件内容是否与 digest 相同（stat 与上次写出时一致则直接用缓存的摘要）"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != size:
+        return False
+    with _written_lock:
+        cached = _written_digests.get(path)
+    if cached and cached[1:] == (stat.st_mtime_ns, stat.st_size):
+        return cached[0] == digest
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest() == digest
+
+
+def write_file_atomic(path, data, mode=0o644):
+    """原子写入 bytes：内容未变化时跳过（不改 mtime，不触发下游重载），返回是否写入
+
+    先写同目录下的临时文件并 fsync，再 rename 覆盖目标，
+    读取方（vmagent file_sd、Telegraf 注入器、Exporter）只会看到完整的旧文件或新文件。
+    """
+    digest = hashlib.sha256(data).digest()
+    if file_unchanged(path, digest, len(data)):
+        return False
+
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # rename 本身也要落盘，否则掉电后目录项可能仍指向旧文件
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+    stat = os.stat(path)
+    with _written_lock:
+        _written_digests[path] = (digest, stat.st_mtime_ns, stat.st_size)
+    return True
+
+
+def write_json_atomic(path, data, indent=2):
+    """以 JSON 原子写出，返回是否写入（内容未变化时为 False）"""
+    return write_file_atomic(path, json.dumps(data, indent=indent, ensure_ascii=False).encode('utf-8'))
+
+
+def write_topology(topology, path, snapshot_format=DEFAULT_SNAPSHOT_FORMAT):
+    """按指定格式原子写出拓扑快照，返回 (是否写入, 字节数)"""
+    data = encode_topology(topology, resolve_format(snapshot_format))
+    return write_file_atomic(path, data), len(data)